@@ -7,11 +7,14 @@ __version__ = '19.12.0'
 
 __all__ = ['Twiss', "Beam", "Particle", "get_current", "get_envelope", "generate_parray",           # beam
             "ellipse_from_twiss", "ParticleArray",  "global_slice_analysis", 'gauss_from_twiss',    # beam
+            "BeamMoments", "ParticleStore",                                                     # beam
+            "generate_parray_6d", "sigma_from_twiss",                                            # beam_generator
 
             "save_particle_array", "load_particle_array", "write_lattice",                          # io
 
             'fodo_parameters', 'lattice_transfer_map', 'TransferMap', "Navigator", 'twiss',    # optics
             "get_map", "MethodTM", "SecondTM", "KickTM", "CavityTM", "UndulatorTestTM",        # optics
+            "CompiledField",                                                                   # high_order
 
             'Element', 'Multipole', 'Quadrupole', 'RBend', "Matrix", "UnknownElement",              # elements
             'SBend', 'Bend', 'Drift', 'Undulator', 'Hcor',  "Sequence", "Solenoid", "TDCavity",     # elements
@@ -21,7 +24,8 @@ __all__ = ['Twiss', "Beam", "Particle", "get_current", "get_envelope", "generate
 
             "tracking_step", "create_track_list", "track_nturns", "freq_analysis",           # track
             "contour_da", "track_nturns_mpi", "nearest_particle", "stable_particles",        # track
-            "spectrum", "track",                                                             # track
+            "spectrum", "track", "resume", "Checkpoint", "TrackProfiler", "precision_check",   # track
+            "track_chunked", "apply_maps",                                                   # track
             "pi", "m_e_eV", "m_e_MeV", "m_e_GeV", "speed_of_light",                             # globals
             "compensate_chromaticity",                                                          # chromaticity
             "EbeamParams",                                                                      # beam_params
@@ -29,7 +33,7 @@ __all__ = ['Twiss', "Beam", "Particle", "get_current", "get_envelope", "generate
             "SpaceCharge", "LSC",                                                               # sc
             "Wake", "WakeTable", "WakeKick", "WakeTableDechirperOffAxis",                       # wake
             "BeamTransform", "SmoothBeam", "EmptyProc", "PhysProc", "LaserHeater",
-            "LaserModulator", "SpontanRadEffects",
+            "LaserModulator", "SpontanRadEffects", "AdaptiveStep", "Resample",
             "MagneticLattice", "merger",            # magnetic_lattice
             "np", # numpy
 
@@ -41,9 +45,11 @@ from ocelot.cpbd.magnetic_lattice import MagneticLattice, merger
 
 from ocelot.cpbd.beam import ParticleArray, global_slice_analysis,Particle, Beam, Twiss, get_current, \
     get_envelope, generate_parray, ellipse_from_twiss
+from ocelot.cpbd.beam_generator import generate_parray_6d, sigma_from_twiss
 
 from ocelot.cpbd.optics import lattice_transfer_map, TransferMap, Navigator, twiss, get_map, MethodTM, \
     SecondTM, KickTM, CavityTM, UndulatorTestTM
+from ocelot.cpbd.high_order import CompiledField
 
 from ocelot.cpbd.elements import *
 from ocelot.cpbd.match import match, match_tunes
@@ -58,7 +64,7 @@ from ocelot.cpbd.csr import CSR
 from ocelot.cpbd.wake3D import Wake, WakeTable, WakeKick, WakeTableDechirperOffAxis
 
 from ocelot.cpbd.physics_proc import BeamTransform, SmoothBeam, EmptyProc, PhysProc, LaserHeater, \
-    LaserModulator, SpontanRadEffects
+    LaserModulator, SpontanRadEffects, AdaptiveStep, Resample
 
 
 print('initializing ocelot...')
@@ -1,6 +1,7 @@
 # from numpy.core.umath import sqrt
 from ocelot.common.globals import m_e_eV
 from ocelot.cpbd.beam import *
+from ocelot.common.py_func import read_text_array, write_text_array
 import numpy as np
 
 
@@ -157,7 +158,7 @@ def astraBeam2particleArray(filename, print_params=True):
     :type filename: str
     :return: ParticleArray
     """
-    P0 = np.loadtxt(filename)
+    P0 = read_text_array(filename)
     charge_array = -P0[:, 7] * 1e-9  # charge in nC -> in C
 
     xp = P0[:, :6]
@@ -221,13 +222,13 @@ def particleArray2astraBeam(p_array, filename="tytest.ast", ref_index=0):
     xp[1:Np, 5] = xp[1:Np, 5] - xp[0, 5]
     xp[1:Np, 2] = xp[1:Np, 2] - xp[0, 2]
 
-    charge_array = -p_array.q_array.reshape(len(p_array.q_array), 1) * 1e+9  # charge in C -> in nC
-    flag = np.ones((len(charge_array), 1))
-    astra = np.append(xp, flag * 0, axis=1)  # time in [ns]
-    astra = np.append(astra, charge_array, axis=1)
-    astra = np.append(astra, flag, axis=1)  # 1 - electron, 2 - positron, 3 - protons and 4 - hydrogen ions.
-    astra = np.append(astra, flag * 5, axis=1)  # 5 - standard particle
-    np.savetxt(filename, astra, fmt='%.7e')
+    astra = np.empty((Np, 10))
+    astra[:, :6] = xp
+    astra[:, 6] = 0.  # time in [ns]
+    astra[:, 7] = -p_array.q_array * 1e+9  # charge in C -> in nC
+    astra[:, 8] = 1  # 1 - electron, 2 - positron, 3 - protons and 4 - hydrogen ions.
+    astra[:, 9] = 5  # 5 - standard particle
+    write_text_array(filename, astra)
 
 
 def emittance_analysis(fileprefix="Exfel", trace_space=True, s_offset=None):
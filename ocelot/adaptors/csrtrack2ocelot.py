@@ -5,6 +5,7 @@ S.Tomin and I.Zagorodnov
 """
 from ocelot.common.globals import *
 from ocelot.cpbd.beam import ParticleArray
+from ocelot.common.py_func import read_text_array, write_text_array
 
 def csrtrackBeam2particleArray(filename, orient="H"):
     """
@@ -16,7 +17,7 @@ def csrtrackBeam2particleArray(filename, orient="H"):
     :param orient: str, "H" or "V" horizontal or vertical orientation
     :return: ParticleArray
     """
-    pd = np.loadtxt(filename)
+    pd = read_text_array(filename)
     n = np.shape(pd)[0] - 1
     pd1 = np.zeros((n, 6))
 
@@ -90,4 +91,4 @@ def particleArray2csrtrackBeam(p_array, filename="csr_beam.fmt1"):
     pd[2:, 4] = px[1:] - px[0]
     pd[2:, 5] = py[1:] - py[0]
     pd[2:, 6] = p_array.q_array[1:]
-    np.savetxt(filename, pd, fmt='%.7e')
\ No newline at end of file
+    write_text_array(filename, pd)
\ No newline at end of file
@@ -1,5 +1,6 @@
 import inspect
 import os
+import numpy as np
 
 python_v = "python3"
 
@@ -90,4 +91,101 @@ def deep_sim_dir(path, **kwargs):
     
     path = (path + pathsep + path_g + separator + path_end + pathsep).replace(pathsep + separator, pathsep)
     
-    return path
\ No newline at end of file
+    return path
+
+def format_e7(data):
+    """
+    Vectorized formatting of the 2D array as text in the same way as np.savetxt(fmt="%.7e").
+    Digits are calculated with numpy for all values at once, values close to the rounding boundary are formatted
+    by python. If the block contains inf, nan or exponent with 3 digits, python formatting is used.
+
+    :param data: 2D array
+    :return: bytes
+    """
+    data = np.asarray(data, dtype=np.float64)
+    nrows, ncols = data.shape
+    row_fmt = " ".join(["%.7e"] * ncols) + "\n"
+    x = data.ravel()
+    if not np.all(np.isfinite(x)):
+        return ((row_fmt * nrows) % tuple(x)).encode()
+
+    ax = np.abs(x)
+    nz = ax > 0
+    e = np.zeros(len(x), dtype=np.int64)
+    e[nz] = np.floor(np.log10(ax[nz]))
+    y = ax * np.power(10., 7 - e)
+    # correction of the exponent when log10 is inaccurate near the powers of 10
+    low = nz & (y < 1e7)
+    e[low] -= 1
+    high = nz & (y >= 1e8)
+    e[high] += 1
+    y = ax * np.power(10., 7 - e)
+    m = np.rint(y).astype(np.int64)
+    carry = m >= 100000000
+    m[carry] = 10000000
+    e[carry] += 1
+
+    # exact rounding of the values close to xxx.5 is checked by python
+    frac = y - np.floor(y)
+    for i in np.flatnonzero(nz & (np.abs(frac - 0.5) < 1e-6)):
+        mantissa, exponent = ("%.7e" % ax[i]).split("e")
+        m[i] = int(mantissa.replace(".", ""))
+        e[i] = int(exponent)
+    if np.any(np.abs(e) > 99):
+        return ((row_fmt * nrows) % tuple(x)).encode()
+
+    # fields of 15 bytes: sign (0 - is removed), d.ddddddde+ee, separator
+    out = np.zeros((len(x), 15), dtype=np.uint8)
+    out[:, 0] = np.where(np.signbit(x), ord("-"), 0)
+    for k in range(8):
+        out[:, 1 + k + (k > 0)] = ord("0") + (m // 10 ** (7 - k)) % 10
+    out[:, 2] = ord(".")
+    out[:, 10] = ord("e")
+    out[:, 11] = np.where(e < 0, ord("-"), ord("+"))
+    ae = np.abs(e)
+    out[:, 12] = ord("0") + ae // 10
+    out[:, 13] = ord("0") + ae % 10
+    out[:, 14] = ord(" ")
+    out.reshape(nrows, ncols, 15)[:, -1, 14] = ord("\n")
+    out = out.ravel()
+    return out[out != 0].tobytes()
+
+
+def write_text_array(filename, data, block_size=100000):
+    """
+    Writes 2D array in the text file, the same as np.savetxt(filename, data, fmt="%.7e") but
+    the array is formatted by blocks of rows with format_e7()
+
+    :param filename: path to file
+    :param data: 2D array
+    :param block_size: number of rows formatted at once
+    :return:
+    """
+    with open(filename, "wb") as f:
+        for i0 in range(0, len(data), block_size):
+            f.write(format_e7(data[i0:i0 + block_size]))
+
+
+def read_text_array(filename, block_lines=1000000):
+    """
+    Reads the text file with columns of numbers, the same as np.loadtxt(filename, ndmin=2).
+    np.loadtxt is implemented in C since numpy 1.23 and is used directly,
+    with older numpy the file is parsed by blocks of lines with np.fromstring.
+
+    :param filename: path to file
+    :param block_lines: number of lines parsed at once
+    :return: 2D array
+    """
+    if np.lib.NumpyVersion(np.__version__) >= "1.23.0":
+        return np.loadtxt(filename, ndmin=2)
+    blocks = []
+    ncols = None
+    with open(filename, "r") as f:
+        while True:
+            lines = f.readlines(block_lines * 100)
+            if len(lines) == 0:
+                break
+            if ncols is None:
+                ncols = len(lines[0].split())
+            blocks.append(np.fromstring("".join(lines), sep=" ").reshape(-1, ncols))
+    return np.vstack(blocks)
@@ -10,6 +10,8 @@ from scipy.signal import savgol_filter
 from scipy.stats import truncnorm
 from ocelot.common.ocelog import *
 from ocelot.cpbd.reswake import pipe_wake
+import json
+import zlib
 
 _logger = logging.getLogger(__name__)
 
@@ -22,9 +24,11 @@ except:
 
 try:
     import numba as nb
+    from numba import prange
     nb_flag = True
 except:
     _logger.info("beam.py: module NUMBA is not installed. Install it to speed up calculation")
+    prange = range
     nb_flag = False
 
 """
@@ -575,13 +579,105 @@ class ParticleArray:
     array of particles of fixed size; for optimized performance
     (x, x' = px/p0),(y, y' = py/p0),(ds = c*tau, p = dE/(p0*c))
     p0 - momentum
+
+    dtype of rparticles can be np.float32 (see astype()) to halve the memory and the memory bandwidth,
+    in that case the transfer maps are applied in single precision and the moments, sorting
+    and charges are calculated in double precision.
     """
-    def __init__(self, n=0):
+    def __init__(self, n=0, dtype=np.float64):
         #self.particles = zeros(n*6)
-        self.rparticles = np.zeros((6, n))
+        self.write_counter = 0
+        self.tau_counter = 0
+        self.in_tracking = False
+        self.rparticles = np.zeros((6, n), dtype=dtype)
         self.q_array = np.zeros(n)    # charge
         self.s = 0.0
         self.E = 0.0
+        self._profile = None
+        self._stats = None
+
+    @property
+    def rparticles(self):
+        return self._rparticles
+
+    @rparticles.setter
+    def rparticles(self, value):
+        self._rparticles = value
+        self.modified()
+
+    @property
+    def q_array(self):
+        return self._q_array
+
+    @q_array.setter
+    def q_array(self, value):
+        self._q_array = value
+        self.modified()
+
+    def modified(self, tau=True):
+        """
+        Method invalidates the cached statistics and profile of the beam (see BeamStatistics and BeamProfile).
+
+        The caches follow one rule: they are valid until modified() is called. It is called when rparticles or
+        q_array are replaced, by the transfer maps and by track() after every physics process.
+        Outside of track() the caches are also checked with the checksum of the whole arrays (see signature()),
+        so any in-place change is detected. Inside track() only the counters are checked, a physics process
+        which changes the particles in place and uses the caches in the same apply() has to call modified()
+        after the change.
+
+        :param tau: True, if False tau and the charges were not changed and the profile is kept
+        """
+        self.write_counter = getattr(self, "write_counter", 0) + 1
+        if tau:
+            self.tau_counter = getattr(self, "tau_counter", 0) + 1
+
+    def signature(self, row=None):
+        """
+        Checksum of the particle data which is used to validate the caches outside of track().
+        crc32 of the whole arrays is calculated without copies, it is several times faster than
+        the sorting or binning of the particles.
+
+        :param row: None or index of the coordinate, e.g. 4 for tau. None - all coordinates
+        :return: tuple
+        """
+        X = self.rparticles
+        q = self.q_array
+        crc = zlib.crc32(np.ascontiguousarray(X if row is None else X[row]))
+        return X.shape, q.shape, zlib.crc32(np.ascontiguousarray(q), crc)
+
+    @property
+    def profile(self):
+        """
+        Longitudinal profile of the beam (sorting, currents, binning) shared by the physics processes,
+        see BeamProfile
+        """
+        if getattr(self, "_profile", None) is None:
+            self._profile = BeamProfile(self)
+        return self._profile
+
+    @property
+    def stats(self):
+        """
+        Cached charge-weighted statistics of the beam (means, sigma matrix, emittances, slice parameters),
+        see BeamStatistics
+        """
+        if getattr(self, "_stats", None) is None:
+            self._stats = BeamStatistics(self)
+        return self._stats
+
+    def astype(self, dtype):
+        """
+        Method returns copy of the ParticleArray with the coordinates in the given precision
+
+        :param dtype: np.float32 or np.float64
+        :return: ParticleArray
+        """
+        p = ParticleArray(dtype=dtype)
+        p.rparticles = self.rparticles.astype(dtype)
+        p.q_array = np.copy(self.q_array)
+        p.s = self.s
+        p.E = self.E
+        return p
 
     def rm_tails(self, xlim, ylim, px_lim, py_lim):
         """
@@ -682,7 +778,7 @@ class ParticleArray:
             raise ValueError("Number of particles in new ParticleArray is less then 1")
 
         n_end = n0 + nth*n
-        p = ParticleArray(n)
+        p = ParticleArray(n, dtype=self.rparticles.dtype)
         p.rparticles[:, :] = self.rparticles[:, n0:n_end:nth]
         p.q_array[:] = self.q_array[n0:n_end:nth]*nth
         p.s = self.s
@@ -728,6 +824,308 @@ def recalculate_ref_particle(p_array):
     return p_array
 
 
+class ParticleStore:
+    """
+    Out-of-core storage of the particles for the beams which do not fit in RAM, see track_chunked().
+    The coordinates are kept in the memory-mapped file filename + ".npy" with the shape (6, n),
+    the charges in filename + "_q.npy" and the reference energy and position in filename + ".json".
+    The beam is processed by chunks of chunk_size particles (see chunks()) and the OS keeps in memory
+    only the pages of the recently used chunks.
+
+    :param filename: path to the store without extension
+    :param n: None - open the existing store, otherwise create new store for n particles
+    :param chunk_size: 1000000, number of particles in the chunk
+    :param dtype: np.float64, dtype of the coordinates of the new store, see ParticleArray
+    """
+    def __init__(self, filename, n=None, chunk_size=1000000, dtype=np.float64):
+        self.filename = filename
+        self.chunk_size = int(chunk_size)
+        if n is None:
+            self.rparticles = np.load(filename + ".npy", mmap_mode="r+")
+            self.q_array = np.load(filename + "_q.npy", mmap_mode="r+")
+            with open(filename + ".json") as f:
+                ref = json.load(f)
+            self.E = ref["E"]
+            self.s = ref["s"]
+        else:
+            self.rparticles = np.lib.format.open_memmap(filename + ".npy", mode="w+", dtype=dtype, shape=(6, n))
+            self.q_array = np.lib.format.open_memmap(filename + "_q.npy", mode="w+", dtype=np.float64, shape=(n,))
+            self.E = 0.
+            self.s = 0.
+
+    @classmethod
+    def from_particle_array(cls, p_array, filename, chunk_size=1000000):
+        """
+        Creates the store and writes ParticleArray to it
+
+        :param p_array: ParticleArray
+        :param filename: path to the store without extension
+        :param chunk_size: number of particles in the chunk
+        :return: ParticleStore
+        """
+        store = cls(filename, n=p_array.n, chunk_size=chunk_size, dtype=p_array.rparticles.dtype)
+        store.write(p_array)
+        store.flush()
+        return store
+
+    @property
+    def n(self):
+        return self.rparticles.shape[1]
+
+    def write(self, p_array, i0=0):
+        """
+        Writes the particles to the store starting from the particle i0, e.g. to generate the beam by parts.
+        The reference energy and position of the store are taken from p_array.
+
+        :param p_array: ParticleArray
+        :param i0: index of the first particle
+        :return:
+        """
+        i1 = i0 + p_array.n
+        self.rparticles[:, i0:i1] = p_array.rparticles
+        self.q_array[i0:i1] = p_array.q_array
+        self.E = p_array.E
+        self.s = p_array.s
+
+    def chunks(self):
+        """
+        Generator of the chunks of the beam. The chunk is ParticleArray which coordinates and charges are views
+        of the memory-mapped files, so all in-place changes of the chunk are written to the store.
+
+        :return: ParticleArray
+        """
+        for i0 in range(0, self.n, self.chunk_size):
+            i1 = min(i0 + self.chunk_size, self.n)
+            p_array = ParticleArray(dtype=self.rparticles.dtype)
+            p_array.rparticles = np.asarray(self.rparticles[:, i0:i1])
+            p_array.q_array = np.asarray(self.q_array[i0:i1])
+            p_array.E = self.E
+            p_array.s = self.s
+            yield p_array
+
+    def to_particle_array(self):
+        """
+        :return: ParticleArray, copy of the whole beam in memory
+        """
+        p_array = ParticleArray(dtype=self.rparticles.dtype)
+        p_array.rparticles = np.array(self.rparticles)
+        p_array.q_array = np.array(self.q_array)
+        p_array.E = self.E
+        p_array.s = self.s
+        return p_array
+
+    def flush(self):
+        """
+        Writes the changed pages of the memory-mapped files and the reference energy and position to the disk
+        """
+        self.rparticles.flush()
+        self.q_array.flush()
+        with open(self.filename + ".json", "w") as f:
+            json.dump({"E": float(self.E), "s": float(self.s)}, f)
+
+
+def envelope_coordinates_np(rparticles, disp, mask):
+    if len(mask) == rparticles.shape[1]:
+        rparticles = np.compress(mask, rparticles, axis=1)
+    X = np.empty_like(rparticles)
+    p = rparticles[5]
+    X[0] = rparticles[0] - disp[0] * p
+    px = rparticles[1] - disp[1] * p
+    X[2] = rparticles[2] - disp[2] * p
+    py = rparticles[3] - disp[3] * p
+    X[4] = rparticles[4]
+    X[5] = p
+    if ne_flag:
+        px = ne.evaluate('px * (1. - 0.5 * px * px - 0.5 * py * py)')
+        py = ne.evaluate('py * (1. - 0.5 * px * px - 0.5 * py * py)')
+    else:
+        px = px*(1.-0.5*px*px - 0.5*py*py)
+        py = py*(1.-0.5*px*px - 0.5*py*py)
+    X[1] = px
+    X[3] = py
+    return X
+
+
+def envelope_coordinates_py(rparticles, disp, mask):
+    """
+    Function returns coordinates [x, px, y, py, tau, p] with the subtracted dispersion
+    and px, py correction which are used for the envelope calculation. One pass over the particles.
+
+    :param rparticles: array (6, N)
+    :param disp: array [Dx, Dxp, Dy, Dyp]
+    :param mask: boolean array (N,) of the selected particles or empty array - all particles
+    :return: array (6, M)
+    """
+    n = rparticles.shape[1]
+    masked = len(mask) == n
+    m = np.sum(mask) if masked else n
+    X = np.empty((6, m))
+    j = 0
+    for i in range(n):
+        if masked and not mask[i]:
+            continue
+        p = rparticles[5, i]
+        px = rparticles[1, i] - disp[1] * p
+        py = rparticles[3, i] - disp[3] * p
+        px = px * (1. - 0.5 * px * px - 0.5 * py * py)
+        py = py * (1. - 0.5 * px * px - 0.5 * py * py)
+        X[0, j] = rparticles[0, i] - disp[0] * p
+        X[1, j] = px
+        X[2, j] = rparticles[2, i] - disp[2] * p
+        X[3, j] = py
+        X[4, j] = rparticles[4, i]
+        X[5, j] = p
+        j += 1
+    return X
+
+
+envelope_coordinates = envelope_coordinates_np if not nb_flag else nb.jit(nopython=True)(envelope_coordinates_py)
+
+
+def second_moments_np(X, means, weights, nblocks):
+    Xc = X - means[:, np.newaxis]
+    if len(weights) == X.shape[1]:
+        return np.dot(Xc * weights, Xc.T)
+    return np.dot(Xc, Xc.T)
+
+
+def second_moments_py(X, means, weights, nblocks):
+    """
+    Sums of the products of the deviations from the means in one pass over the particles
+
+    :param X: array (m, N)
+    :param means: array (m,)
+    :param weights: array (N,) or array (1,) - all weights are 1
+    :param nblocks: number of blocks of particles which are processed in parallel
+    :return: array (m, m)
+    """
+    m = X.shape[0]
+    n = X.shape[1]
+    weighted = len(weights) == n
+    S = np.zeros((nblocks, m, m))
+    for b in prange(nblocks):
+        d = np.zeros(m)
+        s = np.zeros((m, m))
+        for i in range(b * n // nblocks, (b + 1) * n // nblocks):
+            w = weights[i] if weighted else 1.
+            for k in range(m):
+                d[k] = X[k, i] - means[k]
+            for k in range(m):
+                wd = w * d[k]
+                for l in range(k, m):
+                    s[k, l] += wd * d[l]
+        S[b, :, :] = s
+    M = np.zeros((m, m))
+    for b in range(nblocks):
+        for k in range(m):
+            for l in range(k, m):
+                M[k, l] += S[b, k, l]
+                M[l, k] = M[k, l]
+    return M
+
+
+second_moments = second_moments_np if not nb_flag else nb.jit(nopython=True, parallel=True)(second_moments_py)
+
+
+class BeamMoments:
+    """
+    Streaming accumulator of the means and the 6x6 matrix of the second central moments of the distribution.
+    The particles can be added by chunks, chunks are merged with the pairwise update formula (Chan et al.),
+    the second moments of each chunk are calculated in one pass over the particles.
+
+    Accumulated coordinates are [x, px, y, py, tau, p] for add_particles() and twiss(),
+    add() accepts any number of coordinates, e.g. tau only.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.weight = 0.
+        # the shapes are defined by the first added particles
+        self.means = 0.
+        self.m2 = 0.
+
+    def add(self, X, weights=None):
+        """
+        Method adds particles to the accumulator
+
+        :param X: array (m, N) of the coordinates
+        :param weights: None or array (N,) of the weights, e.g. charges of the particles
+        """
+        if weights is None:
+            weight = X.shape[1]
+            means = np.mean(X, axis=1, dtype=np.float64)
+        else:
+            weight = np.sum(weights)
+            means = np.dot(X, weights) / weight
+        w = np.ones(1) if weights is None else np.asarray(weights, dtype=float)
+        self.merge(weight, means, second_moments(X, means, w, min(64, X.shape[1] // 20000 + 1)))
+
+    def add_particles(self, rparticles, tws_i=Twiss(), mask=None, weights=None):
+        """
+        Method adds particles with the dispersion subtraction and px, py correction as in get_envelope()
+
+        :param rparticles: array (6, N), ParticleArray.rparticles or its chunk
+        :param tws_i: design Twiss, Dx, Dxp, Dy, Dyp are used
+        :param mask: None or boolean array (N,) of the particles which are added
+        :param weights: None or array (N,) of the weights
+        """
+        disp = np.array([tws_i.Dx, tws_i.Dxp, tws_i.Dy, tws_i.Dyp], dtype=float)
+        if mask is None:
+            mask = np.empty(0, dtype=bool)
+        elif weights is not None:
+            weights = weights[mask]
+        self.add(envelope_coordinates(rparticles, disp, mask), weights)
+
+    def merge(self, weight, means, m2):
+        """
+        Method merges the moments of the group of particles with the accumulated ones
+
+        :param weight: total weight of the group (number of particles or charge)
+        :param means: array (m,) of the means
+        :param m2: array (m, m) of the sums of the products of the deviations from the means
+        """
+        weight_total = self.weight + weight
+        delta = means - self.means
+        self.means = self.means + delta * (weight / weight_total)
+        self.m2 = self.m2 + m2 + np.outer(delta, delta) * (self.weight * weight / weight_total)
+        self.weight = weight_total
+
+    def cov(self):
+        """
+        :return: matrix of the second central moments
+        """
+        return self.m2 / self.weight
+
+    def twiss(self, E):
+        """
+        Method returns Twiss of the accumulated particles
+
+        :param E: reference energy [GeV]
+        :return: Twiss()
+        """
+        tws = Twiss()
+        M = self.cov()
+        tws.x, tws.px, tws.y, tws.py, tws.tau, tws.p = self.means
+        tws.xx = M[0, 0]
+        tws.xpx = M[0, 1]
+        tws.pxpx = M[1, 1]
+        tws.yy = M[2, 2]
+        tws.ypy = M[2, 3]
+        tws.pypy = M[3, 3]
+        tws.tautau = M[4, 4]
+        tws.xy = M[0, 2]
+        tws.E = np.copy(E)
+
+        tws.emit_x = np.sqrt(tws.xx*tws.pxpx-tws.xpx**2)
+        tws.emit_y = np.sqrt(tws.yy*tws.pypy-tws.ypy**2)
+        tws.beta_x = tws.xx/tws.emit_x
+        tws.beta_y = tws.yy/tws.emit_y
+        tws.alpha_x = -tws.xpx/tws.emit_x
+        tws.alpha_y = -tws.ypy/tws.emit_y
+        return tws
+
+
 def get_envelope(p_array, tws_i=Twiss(), bounds=None):
     """
     Function to calculate twiss parameters form the ParticleArray
@@ -737,83 +1135,145 @@ def get_envelope(p_array, tws_i=Twiss(), bounds=None):
     :param bounds: optional, [left_bound, right_bound] - bounds in units of std(p_array.tau())
     :return: Twiss()
     """
-
+    mask = None
     if bounds is not None:
         tau = p_array.tau()
-        z0 = np.mean(tau)
-        sig0 = np.std(tau)
-        inds = np.argwhere((z0 + sig0 * bounds[0] <= tau) * (tau <= z0 + sig0 * bounds[1]))
-        p = p_array.p()[inds]
-        x = p_array.x()[inds]
-        px = p_array.px()[inds]
-        y = p_array.y()[inds]
-        py = p_array.py()[inds]
-        tau = p_array.tau()[inds]
-    else:
-        p = p_array.p()
-        x = p_array.x()
-        px = p_array.px()
-        y = p_array.y()
-        py = p_array.py()
-        tau = p_array.tau()
+        z0, sig0 = p_array.profile.mean_std()
+        mask = (z0 + sig0 * bounds[0] <= tau) * (tau <= z0 + sig0 * bounds[1])
 
-    tws = Twiss()
-    dx = tws_i.Dx*p
-    dy = tws_i.Dy*p
-    dpx = tws_i.Dxp*p
-    dpy = tws_i.Dyp*p
+    moments = BeamMoments()
+    moments.add_particles(p_array.rparticles, tws_i=tws_i, mask=mask)
+    return moments.twiss(p_array.E)
 
-    x = x - dx
-    px = px - dpx
 
-    y = y - dy
-    py = py - dpy
+class BeamStatistics:
+    """
+    Charge-weighted statistics of the ParticleArray: means, 6x6 sigma matrix, projected and normal mode
+    emittances and slice parameters. Coordinates are [x, px, y, py, tau, p] as in ParticleArray.rparticles.
+    The particles with the equal charges (or zero charges) have the equal weights.
 
-    if ne_flag:
-        px = ne.evaluate('px * (1. - 0.5 * px * px - 0.5 * py * py)')
-        py = ne.evaluate('py * (1. - 0.5 * px * px - 0.5 * py * py)')
-    else:
-        px = px*(1.-0.5*px*px - 0.5*py*py)
-        py = py*(1.-0.5*px*px - 0.5*py*py)
-    tws.x = np.mean(x)
-    tws.y = np.mean(y)
-    tws.px = np.mean(px)
-    tws.py = np.mean(py)
-    tws.tau = np.mean(tau)
+    The results are cached until the particles are changed (see ParticleArray.modified()),
+    so repeated calls in the same step are free. The returned arrays are shared and must not be modified.
 
-    if ne_flag:
-        tw_x = tws.x
-        tw_y = tws.y
-        tw_px = tws.px
-        tw_py = tws.py
-        tw_tau = tws.tau
-        tws.xx =  np.mean(ne.evaluate('(x - tw_x) * (x - tw_x)'))
-        tws.xpx = np.mean(ne.evaluate('(x - tw_x) * (px - tw_px)'))
-        tws.pxpx =np.mean(ne.evaluate('(px - tw_px) * (px - tw_px)'))
-        tws.yy =  np.mean(ne.evaluate('(y - tw_y) * (y - tw_y)'))
-        tws.ypy = np.mean(ne.evaluate('(y - tw_y) * (py - tw_py)'))
-        tws.pypy =np.mean(ne.evaluate('(py - tw_py) * (py - tw_py)'))
-        tws.tautau = np.mean(ne.evaluate('(tau - tw_tau) * (tau - tw_tau)'))
-        tws.xy = np.mean(ne.evaluate('(x - tw_x) * (y - tw_y)'))
-    else:
-        tws.xx = np.mean((x - tws.x)*(x - tws.x))
-        tws.xpx = np.mean((x-tws.x)*(px-tws.px))
-        tws.pxpx = np.mean((px-tws.px)*(px-tws.px))
-        tws.yy = np.mean((y-tws.y)*(y-tws.y))
-        tws.ypy = np.mean((y-tws.y)*(py-tws.py))
-        tws.pypy = np.mean((py-tws.py)*(py-tws.py))
-        tws.tautau = np.mean((tau - tws.tau)*(tau - tws.tau))
-        tws.xy = np.mean((x - tws.x) * (y - tws.y))
-    tws.p = np.mean(p)
-    tws.E = np.copy(p_array.E)
-
-    tws.emit_x = np.sqrt(tws.xx*tws.pxpx-tws.xpx**2)
-    tws.emit_y = np.sqrt(tws.yy*tws.pypy-tws.ypy**2)
-    tws.beta_x = tws.xx/tws.emit_x
-    tws.beta_y = tws.yy/tws.emit_y
-    tws.alpha_x = -tws.xpx/tws.emit_x
-    tws.alpha_y = -tws.ypy/tws.emit_y
-    return tws
+    Usage: p_array.stats.emittances()
+    """
+    def __init__(self, p_array):
+        self.p_array = p_array
+        self.key = None
+        self.cache = {}
+
+    def update(self):
+        """
+        Check the write counter of the ParticleArray (and the signature outside of track())
+        and reset the cache if the particles were changed
+
+        :return: cache
+        """
+        p = self.p_array
+        key = (p.write_counter, None if getattr(p, "in_tracking", False) else p.signature())
+        if self.key != key:
+            self.key = key
+            self.cache = {}
+        return self.cache
+
+    def weights(self):
+        q = self.p_array.q_array
+        if len(q) != self.p_array.n or np.sum(q) == 0:
+            return None
+        return q
+
+    def moments(self):
+        """
+        :return: BeamMoments of the particles weighted with charges
+        """
+        cache = self.update()
+        if "moments" not in cache:
+            moments = BeamMoments()
+            moments.add(self.p_array.rparticles, weights=self.weights())
+            cache["moments"] = moments
+        return cache["moments"]
+
+    def means(self):
+        """
+        :return: array (6,) of the mean values
+        """
+        return self.moments().means
+
+    def sigma_matrix(self):
+        """
+        :return: 6x6 sigma matrix, <(X_i - <X_i>)(X_j - <X_j>)>
+        """
+        cache = self.update()
+        if "sigma" not in cache:
+            cache["sigma"] = self.moments().cov()
+        return cache["sigma"]
+
+    def emittances(self):
+        """
+        Projected emittances
+
+        :return: array [emit_x, emit_y, emit_z], emit_z is emittance in (tau, p) plane
+        """
+        cache = self.update()
+        if "emittances" not in cache:
+            S = self.sigma_matrix()
+            cache["emittances"] = np.array([np.sqrt(max(0., np.linalg.det(S[i:i + 2, i:i + 2]))) for i in (0, 2, 4)])
+        return cache["emittances"]
+
+    def normal_emittances(self):
+        """
+        Normal mode (eigen) emittances which are invariant under the coupling linear transformations
+
+        :return: sorted array of the three eigen emittances
+        """
+        cache = self.update()
+        if "normal_emittances" not in cache:
+            J = np.kron(np.eye(3), np.array([[0., 1.], [-1., 0.]]))
+            ev = np.linalg.eigvals(np.dot(self.sigma_matrix(), J))
+            cache["normal_emittances"] = np.sort(np.abs(ev.imag))[::2]
+        return cache["normal_emittances"]
+
+    def slices(self, nslices=100):
+        """
+        Charge-weighted slice parameters for nslices equidistant slices in tau
+
+        :param nslices: number of slices
+        :return: dict with keys "tau" - slice centers, "q" - slice charges, "I" - current [A],
+                "means" - array (6, nslices), "sigmas" - array (6, nslices) of rms sizes,
+                "emit_x", "emit_y" - slice emittances
+        """
+        cache = self.update()
+        key = ("slices", nslices)
+        if key in cache:
+            return cache[key]
+        X = self.p_array.rparticles
+        q = self.weights()
+        q = np.ones(self.p_array.n) if q is None else q
+        tau = X[4]
+        tau_min, tau_max = np.min(tau), np.max(tau)
+        dtau = (tau_max - tau_min) / nslices
+        inds = np.minimum(((tau - tau_min) / dtau).astype(int), nslices - 1)
+
+        w = np.bincount(inds, weights=q, minlength=nslices)
+        nonzero = w > 0
+        w_nz = np.where(nonzero, w, 1.)
+        # shift by the mean values reduces round-off errors of the second moments
+        shift = self.means()
+        D = X - shift[:, np.newaxis]
+        qD = D * q
+        means = np.array([np.bincount(inds, weights=qD[i], minlength=nslices) for i in range(6)]) / w_nz
+
+        def central(i, j):
+            return np.bincount(inds, weights=qD[i] * D[j], minlength=nslices) / w_nz - means[i] * means[j]
+
+        sigmas = np.sqrt(np.maximum(0., np.array([central(i, i) for i in range(6)])))
+        emit_x = np.sqrt(np.maximum(0., sigmas[0]**2 * sigmas[1]**2 - central(0, 1)**2))
+        emit_y = np.sqrt(np.maximum(0., sigmas[2]**2 * sigmas[3]**2 - central(2, 3)**2))
+        means = (means + shift[:, np.newaxis]) * nonzero
+        res = {"tau": tau_min + dtau * (np.arange(nslices) + 0.5), "q": w, "I": w * speed_of_light / dtau,
+               "means": means, "sigmas": sigmas * nonzero, "emit_x": emit_x * nonzero, "emit_y": emit_y * nonzero}
+        cache[key] = res
+        return res
 
 
 def get_current(p_array, num_bins=200, **kwargs):
@@ -981,32 +1441,57 @@ def s2cur_auxil_py(A, xiA, C, N, I):
 
 s2cur_auxil = s2cur_auxil_py if not nb_flag else nb.jit(nopython=True)(s2cur_auxil_py)
 
-def s_to_cur(A, sigma, q0, v):
+def s_to_cur_grid(s_min, s_max, sigma):
     """
-    Function to calculate beam current
+    Grid of the beam current s_to_cur() for the particles within [s_min, s_max]
 
-    :param A: s-coordinates of particles
+    :param s_min: minimal s-coordinate of particles
+    :param s_max: maximal s-coordinate of particles
     :param sigma: smoothing parameter
-    :param q0: bunch charge
-    :param v: mean velocity
-    :return: [s, I]
+    :return: (a, s, N) - start, step and number of points of the grid
     """
-
     Nsigma = 3
-    a = np.min(A) - Nsigma*sigma
-    b = np.max(A) + Nsigma*sigma
+    a = s_min - Nsigma*sigma
+    b = s_max + Nsigma*sigma
     s = 0.25*sigma
     N = int(np.ceil((b - a)/s))
     s = (b - a)/N
-    B = np.zeros((N + 1, 2))
-    C = np.zeros(N + 1)
+    return a, s, N + 1
 
-    B[:, 0] = np.arange(0, (N + 0.5) * s, s) + a
-    N = N + 1 #np.shape(B)[0]
+
+def s_to_cur_deposit(A, C, a, s):
+    """
+    Linear deposition of the particles on the grid of s_to_cur_grid(). Can be called for parts of the beam.
+
+    :param A: s-coordinates of particles
+    :param C: number of particles on the grid, the array is updated
+    :param a: start of the grid
+    :param s: step of the grid
+    :return: C
+    """
     cA = (A - a)/s
     I = np.int_(np.floor(cA))
     xiA = 1 + I - cA
-    s2cur_auxil(A, xiA, C, N, I)
+    s2cur_auxil(A, xiA, C, len(C), I)
+    return C
+
+
+def s_to_cur_finish(C, a, s, sigma, q0, v):
+    """
+    Smoothing and normalization of the deposited particles, see s_to_cur()
+
+    :param C: number of particles on the grid
+    :param a: start of the grid
+    :param s: step of the grid
+    :param sigma: smoothing parameter
+    :param q0: bunch charge
+    :param v: mean velocity
+    :return: [s, I]
+    """
+    Nsigma = 3
+    N = len(C)
+    B = np.zeros((N, 2))
+    B[:, 0] = np.arange(0, (N - 0.5) * s, s) + a
 
     K = np.floor(Nsigma*sigma/s + 0.5)
     G = np.exp(-0.5 * (np.arange(-K, K+1) * s/sigma)**2)
@@ -1016,57 +1501,232 @@ def s_to_cur(A, sigma, q0, v):
     B[:, 1] = koef * B[:, 1]
     return B
 
+
+def s_to_cur(A, sigma, q0, v):
+    """
+    Function to calculate beam current
+
+    :param A: s-coordinates of particles
+    :param sigma: smoothing parameter
+    :param q0: bunch charge
+    :param v: mean velocity
+    :return: [s, I]
+    """
+    a, s, N = s_to_cur_grid(np.min(A), np.max(A), sigma)
+    C = s_to_cur_deposit(A, np.zeros(N), a, s)
+    return s_to_cur_finish(C, a, s, sigma, q0, v)
+
 #s_to_cur = s_to_cur_py if not nb_flag else nb.jit(s_to_cur_py)
 
+
+def s_to_grid(s_array, n_points, filter_order, s_min=None, s_max=None):
+    """
+    Equidistant grid for the linear deposition of the particles on it, see wake3D.s2currents()
+
+    :param s_array: s-coordinates of particles
+    :param n_points: number of sampling points
+    :param filter_order: filter order, the grid is extended by filter_order/2 points on both sides
+    :param s_min: None or bounds of the grid, by default min and max of s_array.
+                The bounds of the whole beam are used if the particles are deposited by parts, see track_chunked()
+    :param s_max: None or bounds of the grid
+    :return: (s, I0, dI0, ds) - grid, grid index of each particle, distance to s[I0] in units of ds and grid step
+    """
+    s0 = np.min(s_array) if s_min is None else s_min
+    s1 = np.max(s_array) if s_max is None else s_max
+    NF2 = int(np.floor(filter_order / 2.))
+    n_points = n_points + 2 * NF2
+
+    ds = (s1 - s0) / (n_points - 2 - 2 * NF2)
+    s = s0 + np.arange(-NF2, n_points - NF2) * ds
+    Ip = (s_array - s0) / ds
+    I0 = np.floor(Ip)
+    dI0 = Ip - I0
+    I0 = I0 + NF2
+    return s, I0, dI0, ds
+
+
+class BeamProfile:
+    """
+    Longitudinal profile of the ParticleArray.
+
+    Several physics processes (CSR, LSC, Wake, SmoothBeam, ...) which are applied at the same step
+    need the same sorting of the particles by tau and the same current profile.
+    BeamProfile calculates them once and keeps them until tau or charges of the particles are changed
+    (see ParticleArray.modified()), the processes which change only the momenta (PhysProc.changes_tau = False)
+    keep the cache for the next processes of the same step.
+    The returned arrays are shared and must not be modified.
+
+    Usage: p_array.profile.argsort()
+    """
+    def __init__(self, p_array):
+        self.p_array = p_array
+        self.key = None
+        self.cache = {}
+
+    def update(self):
+        """
+        Check if tau or charges of the particles were changed and reset the cache in that case
+
+        :return: cache
+        """
+        p = self.p_array
+        key = (getattr(p, "tau_counter", 0), None if getattr(p, "in_tracking", False) else p.signature(row=4))
+        if self.key != key:
+            self.key = key
+            self.cache = {}
+        return self.cache
+
+    @property
+    def tau(self):
+        return np.asarray(self.p_array.tau(), dtype=np.float64)
+
+    @property
+    def q(self):
+        return self.p_array.q_array
+
+    def argsort(self):
+        """
+        :return: indices which sort the particles by tau
+        """
+        cache = self.update()
+        if "argsort" not in cache:
+            cache["argsort"] = np.argsort(self.tau)
+        return cache["argsort"]
+
+    def mean_std(self):
+        """
+        :return: (mean, std) of tau
+        """
+        cache = self.update()
+        if "mean_std" not in cache:
+            cache["mean_std"] = (np.mean(self.tau), np.std(self.tau))
+        return cache["mean_std"]
+
+    def current(self, sigma, v=speed_of_light):
+        """
+        Smoothed beam current, see s_to_cur()
+
+        :param sigma: smoothing parameter
+        :param v: mean velocity
+        :return: [s, I]
+        """
+        cache = self.update()
+        key = ("current", sigma, v)
+        if key not in cache:
+            cache[key] = s_to_cur(self.tau, sigma, np.sum(self.q), v)
+        return cache[key]
+
+    def grid(self, n_points, filter_order):
+        """
+        Binning of the particles on the equidistant grid, see s_to_grid()
+
+        :param n_points: number of sampling points
+        :param filter_order: filter order
+        :return: (s, I0, dI0, ds)
+        """
+        cache = self.update()
+        key = ("grid", n_points, filter_order)
+        if key not in cache:
+            cache[key] = s_to_grid(self.tau, n_points, filter_order)
+        return cache[key]
+
+def moving_window_np(c, m):
+    """
+    Mean values in the moving window [i-m, i+m] calculated from the cumulative sum
+
+    :param c: cumulative sum, np.cumsum(x)
+    :param m: half width of the window
+    :return: array of the mean values
+    """
+    N = len(c)
+    i = np.arange(N)
+    n1 = np.maximum(0, i - m).astype(int)
+    n2 = np.minimum(N - 1, i + m).astype(int)
+    return (c[n2] - c[n1]) / (n2 - n1)
+
+
+def moving_window_py(c, m):
+    N = len(c)
+    res = np.zeros(N)
+    for i in prange(N):
+        n1 = int(max(0, i - m))
+        n2 = int(min(N - 1, i + m))
+        res[i] = (c[n2] - c[n1]) / (n2 - n1)
+    return res
+
+
+moving_window = moving_window_np if not nb_flag else nb.jit(nopython=True, parallel=True)(moving_window_py)
+
+
 def slice_analysis_py(z, x, xs, M, to_sort):
     """
     returns:
     <x>, <xs>, <x^2>, <x*xs>, <xs^2>, np.sqrt(<x^2> * <xs^2> - <x*xs>^2)
     based on M particles in moving window
     Sergey, check please
+
+    :param to_sort: if False, particles must be already sorted by z
     """
-    z = np.copy(z)
     if to_sort:
-        #P=sortrows([z, x, xs])
-        indx = z.argsort()
-        z = z[indx]
+        indx = np.argsort(z)
         x = x[indx]
         xs = xs[indx]
 
-    N=len(x)
-    mx = np.zeros(N)
-    mxs= np.zeros(N)
-    mxx = np.zeros(N)
-    mxxs = np.zeros(N)
-    mxsxs = np.zeros(N)
-    emittx = np.zeros(N)
-    m = np.max(np.array([np.round(M/2), 1]))
-    xc = np.cumsum(x)
-    xsc = np.cumsum(xs)
-    for i in range(N):
-        n1 = int(max(0, i-m))
-        n2 = int(min(N-1, i+m))
-        dq = n2 - n1 # window size
-        mx[i] = (xc[n2] - xc[n1])/dq # average for over window per particle
-        mxs[i] = (xsc[n2] - xsc[n1])/dq
+    m = max(np.round(M / 2), 1)
+    mx = moving_window(np.cumsum(x), m)   # average over window per particle
+    mxs = moving_window(np.cumsum(xs), m)
 
     x = x - mx
     xs = xs - mxs
-    x2c = np.cumsum(x*x)
-    xs2c = np.cumsum(xs*xs)
-    xxsc = np.cumsum(x*xs)
-    for i in range(N):
-        n1 = int(max(0, i-m))
-        n2 = int(min(N-1, i+m))
-        dq = n2 - n1
-        mxx[i] = (x2c[n2] - x2c[n1])/dq
-        mxsxs[i] = (xs2c[n2] - xs2c[n1])/dq
-        mxxs[i] = (xxsc[n2] - xxsc[n1])/dq
+    mxx = moving_window(np.cumsum(x * x), m)
+    mxsxs = moving_window(np.cumsum(xs * xs), m)
+    mxxs = moving_window(np.cumsum(x * xs), m)
 
     emittx = np.sqrt(mxx*mxsxs - mxxs*mxxs)
     return [mx, mxs, mxx, mxxs, mxsxs, emittx]
 
-slice_analysis = slice_analysis_py if not nb_flag else nb.jit(slice_analysis_py)
+
+slice_analysis = slice_analysis_py
+
+
+def smooth_sorted_np(Zs, mslice):
+    """
+    Smoothing of the sorted coordinates in the moving window which width goes to zero at the edges (see SmoothBeam)
+
+    :param Zs: sorted coordinates
+    :param mslice: number of particles in the window
+    :return: smoothed coordinates
+    """
+    N = Zs.shape[0]
+    S = np.zeros(N + 1)
+    S[1:] = np.cumsum(Zs)
+    Zout = np.copy(Zs)
+    i = np.arange(1, N - 1)
+    x = 0.5 * np.minimum(i, N - i + 1)
+    A = 0.5 * mslice
+    m = np.floor(np.where(x < 2 * A, x - x * x / (4 * A), A) + 0.500001).astype(int)
+    Zout[1:N - 1] = (S[i + m + 1] - S[i - m]) / (2 * m + 1)
+    return Zout
+
+
+def smooth_sorted_py(Zs, mslice):
+    N = Zs.shape[0]
+    S = np.zeros(N + 1)
+    S[1:] = np.cumsum(Zs)
+    Zout = np.copy(Zs)
+    A = 0.5 * mslice
+    for i in prange(1, N - 1):
+        x = 0.5 * min(i, N - i + 1)
+        if x < 2 * A:
+            y = x - x * x / (4 * A)
+        else:
+            y = A
+        m = int(np.floor(y + 0.500001))
+        Zout[i] = (S[i + m + 1] - S[i - m]) / (2 * m + 1)
+    return Zout
+
+
+smooth_sorted = smooth_sorted_np if not nb_flag else nb.jit(nopython=True, parallel=True)(smooth_sorted_py)
 
 
 def simple_filter(x, p, iter):
@@ -1104,13 +1764,12 @@ def slice_analysis_transverse(parray, Mslice, Mcur, p, iter):
     q1 = np.sum(parray.q_array)
     _logger.debug("slice_analysis_transverse: charge = " + str(q1))
     n = np.int_(parray.rparticles.size / 6)
-    PD = parray.rparticles
-    PD = sortrows(PD, col=4)
+    PD = parray.rparticles[:, parray.profile.argsort()]
 
     z = np.copy(PD[4])
-    mx, mxs, mxx, mxxs, mxsxs, emittx = slice_analysis(z, PD[0], PD[1], Mslice, True)
+    mx, mxs, mxx, mxxs, mxsxs, emittx = slice_analysis(z, PD[0], PD[1], Mslice, False)
 
-    my, mys, myy, myys, mysys, emitty = slice_analysis(z, PD[2], PD[3], Mslice, True)
+    my, mys, myy, myys, mysys, emitty = slice_analysis(z, PD[2], PD[3], Mslice, False)
 
     mm, mm, mm, mm, mm, emitty0 = moments(PD[2], PD[3])
     gamma0 = parray.E / m_e_GeV
@@ -1175,19 +1834,18 @@ def global_slice_analysis_extended(parray, Mslice, Mcur, p, iter):
     q1 = np.sum(parray.q_array)
     #print("charge", q1)
     n = np.int_(parray.rparticles.size/6)
-    PD = parray.rparticles
-    PD = sortrows(PD, col=4)
+    PD = parray.rparticles[:, parray.profile.argsort()]
 
     z = np.copy(PD[4])
-    mx, mxs, mxx, mxxs, mxsxs, emittx = slice_analysis(z, PD[0], PD[1], Mslice, True)
+    mx, mxs, mxx, mxxs, mxsxs, emittx = slice_analysis(z, PD[0], PD[1], Mslice, False)
     
-    my, mys, myy, myys, mysys, emitty = slice_analysis(z, PD[2], PD[3], Mslice, True)
+    my, mys, myy, myys, mysys, emitty = slice_analysis(z, PD[2], PD[3], Mslice, False)
 
     pc_0 = np.sqrt(parray.E**2 - m_e_GeV**2)
     E1 = PD[5]*pc_0 + parray.E
     pc_1 = np.sqrt(E1**2 - m_e_GeV**2)
     #print(pc_1[:10])
-    mE, mEs, mEE, mEEs, mEsEs, emittE = slice_analysis(z, PD[4], pc_1*1e9, Mslice, True)
+    mE, mEs, mEE, mEEs, mEsEs, emittE = slice_analysis(z, PD[4], pc_1*1e9, Mslice, False)
 
     #print(mE, mEs, mEE, mEEs, mEsEs, emittE)
     mE = mEs #mean energy
@@ -1241,19 +1899,18 @@ def global_slice_analysis(parray, Mslice=5000, Mcur=0.01, p=2, iter=2):
     q1 = np.sum(parray.q_array)
     # print("charge", q1)
     n = np.int_(parray.rparticles.size / 6)
-    PD = parray.rparticles
-    PD = sortrows(PD, col=4)
+    PD = parray.rparticles[:, parray.profile.argsort()]
 
     z = np.copy(PD[4])
-    mx, mxs, mxx, mxxs, mxsxs, emittx = slice_analysis(z, PD[0], PD[1], Mslice, True)
+    mx, mxs, mxx, mxxs, mxsxs, emittx = slice_analysis(z, PD[0], PD[1], Mslice, False)
 
-    my, mys, myy, myys, mysys, emitty = slice_analysis(z, PD[2], PD[3], Mslice, True)
+    my, mys, myy, myys, mysys, emitty = slice_analysis(z, PD[2], PD[3], Mslice, False)
 
     pc_0 = np.sqrt(parray.E ** 2 - m_e_GeV ** 2)
     E1 = PD[5] * pc_0 + parray.E
     pc_1 = np.sqrt(E1 ** 2 - m_e_GeV ** 2)
     # print(pc_1[:10])
-    mE, mEs, mEE, mEEs, mEsEs, emittE = slice_analysis(z, PD[4], pc_1 * 1e9, Mslice, True)
+    mE, mEs, mEE, mEEs, mEsEs, emittE = slice_analysis(z, PD[4], pc_1 * 1e9, Mslice, False)
 
     # print(mE, mEs, mEE, mEEs, mEsEs, emittE)
     mE = mEs  # mean energy
@@ -1266,7 +1923,7 @@ def global_slice_analysis(parray, Mslice=5000, Mcur=0.01, p=2, iter=2):
     _, _, _, _, _, emitt0 = moments(PD[0], PD[1])
     slc.emitxn = emitt0 * gamma0
 
-    _, mp, _, _, _, _ = slice_analysis(z, PD[4], PD[5], Mslice, True)
+    _, mp, _, _, _, _ = slice_analysis(z, PD[4], PD[5], Mslice, False)
 
     z, ind = np.unique(z, return_index=True)
 
@@ -0,0 +1,239 @@
+"""
+generation of the correlated 6D particle distributions with pseudo- and quasi-random numbers
+"""
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy.special import ndtri
+from ocelot.common.math_op import invert_cdf
+from ocelot.common.ocelog import *
+from ocelot.cpbd.beam import ParticleArray
+
+_logger = logging.getLogger(__name__)
+
+try:
+    from scipy.stats import qmc
+    qmc_flag = True
+except:
+    _logger.info("beam_generator.py: scipy.stats.qmc is not available (scipy < 1.7). Sobol sequence is replaced by Halton")
+    qmc_flag = False
+
+HALTON_BASES = (2, 3, 5, 7, 11, 13)
+
+
+def sigma_from_twiss(tws, sigma_tau, sigma_p, chirp=0.):
+    """
+    6x6 sigma matrix of the beam in the ParticleArray coordinates (x, px, y, py, tau, p)
+
+    :param tws: Twiss, uses emit_x, beta_x, alpha_x, emit_y, beta_y, alpha_y, Dx, Dxp, Dy, Dyp
+    :param sigma_tau: std(tau) [m]
+    :param sigma_p: uncorrelated std(p)
+    :param chirp: energy chirp [unitless], linear correlation - p_i += chirp * tau_i/sigma_tau
+    :return: array 6x6
+    """
+    sigma = np.zeros((6, 6))
+    for i, (emit, beta, alpha) in enumerate([(tws.emit_x, tws.beta_x, tws.alpha_x),
+                                             (tws.emit_y, tws.beta_y, tws.alpha_y)]):
+        gamma = (1. + alpha * alpha) / beta if beta != 0 else 0.
+        sigma[2 * i: 2 * i + 2, 2 * i: 2 * i + 2] = emit * np.array([[beta, -alpha], [-alpha, gamma]])
+    k = chirp / sigma_tau if sigma_tau != 0 else 0.
+    sigma[4, 4] = sigma_tau ** 2
+    sigma[4, 5] = sigma[5, 4] = k * sigma_tau ** 2
+    sigma[5, 5] = sigma_p ** 2 + k * k * sigma_tau ** 2
+    # dispersion: x -> x + Dx*p, px -> px + Dxp*p, ...
+    D = np.eye(6)
+    D[0:4, 5] = [tws.Dx, tws.Dxp, tws.Dy, tws.Dyp]
+    return np.dot(D, np.dot(sigma, D.T))
+
+
+def sigma_transform(sigma):
+    """
+    Lower triangular matrix L of the transformation X = L*Z of the standard normal vectors Z to the vectors X
+    with covariance sigma (Cholesky decomposition). Sigma can be singular (e.g. zero emittance in one plane),
+    in this case the columns of L which correspond to the dependent coordinates are zero.
+
+    :param sigma: covariance matrix n x n
+    :return: L, n x n
+    """
+    sigma = np.asarray(sigma, dtype=np.float64)
+    n = len(sigma)
+    L = np.zeros((n, n))
+    for j in range(n):
+        d = sigma[j, j] - np.dot(L[j, :j], L[j, :j])
+        if d < -1e-8 * sigma[j, j]:
+            raise ValueError("sigma_transform: sigma matrix is not positive semi-definite")
+        if d <= 1e-12 * sigma[j, j]:
+            continue
+        L[j, j] = np.sqrt(d)
+        L[j + 1:, j] = (sigma[j + 1:, j] - np.dot(L[j + 1:, :j], L[j, :j])) / L[j, j]
+    return L
+
+
+def flattop_profile(length, sigma_edge=0., npoints=2000):
+    """
+    Flattop current profile with gaussian edges
+
+    :param length: length of the flat part [m]
+    :param sigma_edge: rms length of the gaussian edges [m]
+    :param npoints: number of points
+    :return: tau, current - arrays which can be used as tau_profile in generate_parray_6d()
+    """
+    half = length / 2. + 4. * sigma_edge
+    tau = np.linspace(-half, half, num=npoints)
+    current = np.ones(npoints)
+    if sigma_edge > 0:
+        out = np.abs(tau) > length / 2.
+        current[out] = np.exp(-(np.abs(tau[out]) - length / 2.) ** 2 / (2. * sigma_edge ** 2))
+    return tau, current
+
+
+def halton(n, d, i0=0, shift=None):
+    """
+    Halton sequence with points i0, i0+1, ... i0+n-1.
+    Radical inverse is calculated for all indices at once digit by digit.
+
+    :param n: number of points
+    :param d: dimension, d <= 6
+    :param i0: index of the first point
+    :param shift: None or array d, random shift (Cranley-Patterson rotation) of the sequence
+    :return: array d x n in [0, 1)
+    """
+    u = np.zeros((d, n))
+    for k in range(d):
+        b = HALTON_BASES[k]
+        ind = np.arange(i0, i0 + n, dtype=np.int64)
+        f = 1.
+        while np.any(ind > 0):
+            f /= b
+            u[k] += f * (ind % b)
+            ind //= b
+        if shift is not None:
+            u[k] += shift[k]
+            u[k] -= np.floor(u[k])
+    return u
+
+
+def uniform_samples(n, d, method="random", seed=None, i0=0, scramble=True):
+    """
+    Samples from the uniform distribution on the unit cube.
+    Quasi-random sequences are reproducible for each index of the point,
+    so the samples do not depend on the splitting into chunks.
+
+    :param n: number of points
+    :param d: dimension
+    :param method: "random" - pseudo-random numbers, "sobol" or "halton" - low-discrepancy sequences
+    :param seed: None or int, for "random" np.random.SeedSequence entropy or spawned SeedSequence
+    :param i0: index of the first point in the quasi-random sequence
+    :param scramble: scrambling of the quasi-random sequence, if False the first point (zero) is skipped
+    :return: array d x n in (0, 1)
+    """
+    if method == "random":
+        return np.random.default_rng(seed).random((d, n))
+
+    offset = 0 if scramble else 1
+    if method == "sobol" and qmc_flag:
+        sampler = qmc.Sobol(d=d, scramble=scramble, seed=seed)
+        if i0 + offset > 0:
+            sampler.fast_forward(i0 + offset)
+        with warnings.catch_warnings():
+            # balance properties of the Sobol sequence require n = 2**m, chunks have arbitrary length
+            warnings.simplefilter("ignore", UserWarning)
+            return sampler.random(n).T
+    if method == "sobol":
+        _logger.warning("uniform_samples: scipy.stats.qmc is not available, Halton sequence is used")
+    elif method != "halton":
+        raise ValueError("uniform_samples: method must be 'random', 'sobol' or 'halton'")
+    shift = np.random.default_rng(seed).random(d) if scramble else None
+    return halton(n, d, i0=i0 + offset, shift=shift)
+
+
+def generate_parray_6d(sigma, nparticles=200000, charge=5e-9, energy=0.13, mean=None, p_array=None,
+                       dtype=np.float64, method="random", seed=None, scramble=True, tau_profile=None,
+                       chunk_size=1000000, nthreads=1):
+    """
+    Method generates ParticleArray with correlated 6D distribution with given sigma matrix.
+    Standard normal vectors Z are generated chunk by chunk and transformed X = L*Z (see sigma_transform()),
+    the result is written directly into rparticles.
+
+    Pseudo-random numbers of the chunk k are generated by independent stream np.random.SeedSequence(seed).spawn(),
+    so the result does not depend on nthreads but depends on chunk_size.
+    Quasi-random (low-discrepancy) sequences reduce the shot noise at fixed number of particles and
+    do not depend on chunk_size.
+
+    :param sigma: 6x6 covariance matrix of (x, px, y, py, tau, p), e.g. sigma_from_twiss()
+    :param nparticles: number of particles, ignored if p_array is given
+    :param charge: beam charge in [C]
+    :param energy: beam energy in [GeV]
+    :param mean: None or 6 mean values of the coordinates
+    :param p_array: None or preallocated ParticleArray which is filled
+    :param dtype: np.float64 or np.float32, dtype of rparticles of the new ParticleArray
+    :param method: "random", "sobol" or "halton", see uniform_samples()
+    :param seed: None or int
+    :param scramble: scrambling of the quasi-random sequences
+    :param tau_profile: None or (tau, current) - arbitrary current profile, e.g. flattop_profile().
+                        "tau" is sampled from the profile with invert_cdf() (mean is added to it),
+                        other coordinates keep linear correlations with "tau" given by sigma,
+                        std(tau) is taken from the profile.
+    :param chunk_size: number of particles generated at once
+    :param nthreads: number of threads to generate chunks
+    :return: ParticleArray
+    """
+    sigma = np.array(sigma, dtype=np.float64)
+    # "tau" goes first, then it is determined by the first normal variable only
+    perm = [4, 0, 1, 2, 3, 5]
+    inv_cdf = None
+    if tau_profile is not None:
+        tau, current = np.asarray(tau_profile[0]), np.asarray(tau_profile[1])
+        norm = np.trapz(current, tau)
+        tau_mean = np.trapz(current * tau, tau) / norm
+        tau_std = np.sqrt(np.trapz(current * (tau - tau_mean) ** 2, tau) / norm)
+        if sigma[4, 4] <= 0:
+            raise ValueError("generate_parray_6d: sigma[4, 4] must be positive to use tau_profile")
+        scale = np.ones(6)
+        scale[4] = tau_std / np.sqrt(sigma[4, 4])
+        sigma = sigma * np.outer(scale, scale)
+        inv_cdf = invert_cdf(y=current, x=tau)
+    L = sigma_transform(sigma[perm][:, perm])
+
+    if p_array is None:
+        p_array = ParticleArray(n=nparticles, dtype=dtype)
+    n = p_array.n
+    p_array.E = energy
+    p_array.q_array = np.ones(n) * charge / n
+    shift = np.zeros(6) if mean is None else np.array(mean, dtype=np.float64)
+    if inv_cdf is not None:
+        shift[4] += tau_mean
+    rparticles = p_array.rparticles
+
+    chunks = [(i0, min(i0 + chunk_size, n)) for i0 in range(0, n, chunk_size)]
+    streams = np.random.SeedSequence(seed).spawn(len(chunks))
+    qmc_seed = np.random.SeedSequence(seed).generate_state(1)[0] if seed is None else seed
+
+    def generate_chunk(k):
+        i0, i1 = chunks[k]
+        if method == "random" and inv_cdf is None:
+            Z = np.random.default_rng(streams[k]).standard_normal((6, i1 - i0))
+        else:
+            seed_k = streams[k] if method == "random" else qmc_seed
+            U = uniform_samples(i1 - i0, 6, method=method, seed=seed_k, i0=i0, scramble=scramble)
+            if inv_cdf is not None:
+                tau_k = inv_cdf(U[0])
+                Z = ndtri(U)
+                Z[0] = (tau_k - tau_mean) / tau_std
+            else:
+                Z = ndtri(U)
+        X = np.dot(L, Z)
+        for i, j in enumerate(perm):
+            rparticles[j, i0:i1] = X[i] + shift[j]
+
+    if nthreads > 1 and len(chunks) > 1:
+        if method == "sobol" and qmc_flag:
+            # direction numbers of the Sobol sequence are initialized at the first call which is not thread safe
+            uniform_samples(1, 6, method=method, seed=qmc_seed)
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            list(pool.map(generate_chunk, range(len(chunks))))
+    else:
+        for k in range(len(chunks)):
+            generate_chunk(k)
+    p_array.modified()
+    return p_array
@@ -16,15 +16,18 @@ from ocelot.cpbd.physics_proc import PhysProc
 import copy
 from ocelot.rad.radiation_py import und_field
 import importlib
+from collections import OrderedDict
 
 import logging
 logger = logging.getLogger(__name__)
 
 try:
     import numba as nb
+    from numba import prange
     nb_flag = True
 except:
     logger.info("csr.py: module NUMBA is not installed. Install it to speed up calculation")
+    prange = range
     nb_flag = False
 
 try:
@@ -355,6 +358,77 @@ class SubBinning:
         return SBINB, NBIN
 
 
+def k0_fin_anf_multi_py(indices, traj, wmin, gamma):
+    """
+    K0_fin_anf for several trajectory points, the points are processed in parallel
+
+    :param indices: array of the trajectory point indices
+    :param traj: trajectory
+    :param wmin: the smallest w
+    :param gamma: Lorentz factor
+    :return: (offsets, w, KS) - w and KS of the k-th index are w[offsets[k]:offsets[k+1]]
+    """
+    g2i = 1. / gamma ** 2
+    b2 = 1. - g2i
+    beta = np.sqrt(b2)
+    m = len(indices)
+
+    # search of the retarded points goes back from the observer and stops at the first point with w <= wmin
+    jj = np.zeros(m, dtype=np.int64)
+    for k in prange(m):
+        i = indices[k]
+        j = i - 1
+        while j > 0:
+            n0 = traj[1, i] - traj[1, j]
+            n1 = traj[2, i] - traj[2, j]
+            n2 = traj[3, i] - traj[3, j]
+            if traj[0, j] - traj[0, i] + beta * np.sqrt(n0 * n0 + n1 * n1 + n2 * n2) <= wmin:
+                break
+            j -= 1
+        jj[k] = j
+
+    offsets = np.zeros(m + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(indices - jj)
+    w_out = np.zeros(offsets[m])
+    KS_out = np.zeros(offsets[m])
+    for k in prange(m):
+        i = indices[k]
+        j = jj[k]
+        o = offsets[k]
+        L = i - j
+        K = np.zeros(L)
+        s = np.zeros(L)
+        for c in range(L):
+            jc = j + c
+            s[c] = traj[0, jc] - traj[0, i]
+            n0 = traj[1, i] - traj[1, jc]
+            n1 = traj[2, i] - traj[2, jc]
+            n2 = traj[3, i] - traj[3, jc]
+            R = np.sqrt(n0 * n0 + n1 * n1 + n2 * n2)
+            w = s[c] + beta * R
+            n0 = n0 / R
+            n1 = n1 / R
+            n2 = n2 / R
+            t4 = traj[4, jc]
+            t5 = traj[5, jc]
+            t6 = traj[6, jc]
+            x = n0 * t4 + n1 * t5 + n2 * t6
+            K[c] = ((beta * (x - n0 * traj[4, i] - n1 * traj[5, i] - n2 * traj[6, i]) -
+                     b2 * (1. - t4 * traj[4, i] - t5 * traj[5, i] - t6 * traj[6, i]) - g2i) / R - (1. - beta * x) / w * g2i)
+            w_out[o + c] = w
+        # integrated kernel: KS=int_s^0{K(u)*du}
+        acc = 0.5 * K[L - 1] * s[L - 1]
+        KS_out[o + L - 1] = acc
+        for c in range(L - 2, -1, -1):
+            acc += 0.5 * (K[c] + K[c + 1]) * (s[c + 1] - s[c])
+            KS_out[o + c] = acc
+    return offsets, w_out, KS_out
+
+
+if nb_flag:
+    k0_fin_anf_multi = nb.jit(nopython=True, parallel=True)(k0_fin_anf_multi_py)
+
+
 class K0_fin_anf:
     def __init__(self):
         self.print_log = False
@@ -370,6 +444,22 @@ class K0_fin_anf:
             logger.debug("K0_fin_anf: Python")
             self.eval = self.K0_fin_anf_np
 
+    def eval_multi(self, indices, traj, wmin, gamma):
+        """
+        K0_fin_anf for several trajectory points at once
+
+        :param indices: indices of the trajectory points
+        :param traj: trajectory
+        :param wmin: the smallest w
+        :param gamma: Lorentz factor
+        :return: list of (w, KS)
+        """
+        if not nb_flag:
+            return [self.eval(i, traj, wmin, gamma) for i in indices]
+        indices = np.asarray(indices, dtype=np.int64)
+        offsets, w, KS = k0_fin_anf_multi(indices, traj, wmin, gamma)
+        return [(w[offsets[k]:offsets[k + 1]], KS[offsets[k]:offsets[k + 1]]) for k in range(len(indices))]
+
     def K0_1_jit(self, indx, j, R, n, traj4, traj5, traj6, w, gamma):
         g2i = 1. / gamma ** 2
         b2 = 1. - g2i
@@ -550,13 +640,30 @@ class CSR(PhysProc):
         self.sigma_min = 1.e-4  - minimal sigma if gauss filtering applied
         self.traj_step = 0.0002 [m] - trajectory step or, other words, integration step for calculation of the CSR-wake
         self.apply_step = 0.0005 [m] - step of the calculation CSR kick, to calculate average CSR kick
+        self.kernel_tol = 0. - relative tolerance of the mesh step and gamma within which the CSR kernels are reused,
+                                e.g. 1e-3. If 0, the kernels are reused only for identical mesh steps and energies.
+        self.kernel_cache_size = 20000 - maximal number of the cached kernels
+        self.ref_mesh = None - [N, st] - number of points and step [m] of the reference mesh. If not None and
+                                self.energy is set, the kernels of all trajectory points are calculated in prepare()
+                                and reused for the meshes with the step within kernel_tol and N points or less.
+        self.chunk_hist_bins = 100000 - number of bins of the charge histogram, which replaces the sorting of the
+                                particles for the sub-bin boundaries in the out-of-core tracking, see track_chunked()
+
+    The kernel K1 of the trajectory point i depends on the mesh step st, the energy and the number of the mesh
+    points N. The kernels are cached with the key (i, st, gamma), the kernel for N points is the tail of the kernel
+    for a longer mesh with the same step. If kernel_tol > 0, st and gamma are quantized on a logarithmic grid and
+    the kernel of the quantized step st_q is rescaled as K1 * st/st_q.
     """
+    changes_tau = False
+    n_chunk_passes = 3
+
     def __init__(self):
         PhysProc.__init__(self)
         # binning parameters
         self.x_qbin = 0             # length or charge binning; 0... 1 = length...charge
         self.n_bin = 100            # number of bins
         self.m_bin = 5              # multiple binning(with shifted bins)
+        self.chunk_hist_bins = 100000   # number of bins of the histogram for the sub-binning in track_chunked()
 
         # smoothing
         self.ip_method = 2          # = 0 / 1 / 2 for rectangular / triangular / gauss
@@ -587,6 +694,13 @@ class CSR(PhysProc):
         self.pict_debug = False     # if True trajectory of the reference particle will be produced
                                     # and CSR wakes will be saved in the working folder on each spep
 
+        # kernel caches
+        self.kernel_tol = 0.
+        self.kernel_cache_size = 20000
+        self.ref_mesh = None                # [N, st] - reference mesh for the kernel precalculation
+        self.kernel_cache = OrderedDict()   # K1, key = (i, st, gamma)
+        self.kernel_ref = {}                # K1 precalculated in prepare() on the reference mesh
+
         self.sub_bin = SubBinning(x_qbin=self.x_qbin, n_bin=self.n_bin, m_bin=self.m_bin)
         self.bin_smoth = Smoothing()
         self.k0_fin_anf = K0_fin_anf()
@@ -689,31 +803,48 @@ class CSR(PhysProc):
         return KS
 
 
-    def CSR_K1(self, i, traj, NdW, gamma=None):
+    def quantize(self, value):
         """
-        :param i: index of the trajectories points for the convolution kernel is calculated;
-        :param traj: trajectory. traj[0,:] - longitudinal coordinate,
-                                 traj[1,:], traj[2,:], traj[3,:] - rectangular coordinates, \
-                                 traj[4,:], traj[5,:], traj[6,:] - tangential unit vectors
-        :param NdW: list N[0] 0 number of mesh points, N[1] = dW> 0 - increment, Mesh = Mesh = (N: 0) * dW
-        :param gamma:
-        :return:
+        Quantization of the value on the logarithmic grid with the relative resolution self.kernel_tol
+
+        :param value: positive value or None
+        :return: (key, ref_value) - key for the kernel cache and the value which corresponds to the key
         """
-        # function [ K1 ] = CSR_K1( i,traj,NdW,gamma )
+        if value is None or self.kernel_tol <= 0:
+            return value, value
+        log_base = np.log1p(self.kernel_tol)
+        key = int(np.round(np.log(value) / log_base))
+        return key, np.exp(key * log_base)
 
-        # L_fin=nargin==4 && ~isempty(gamma) && gamma>1
-        if gamma != None:
-            L_fin = True
-        else:
-            L_fin = False
+    def clear_kernel_cache(self):
+        self.kernel_cache.clear()
+        self.kernel_ref.clear()
 
+    def cached_K1(self, key, n):
+        """
+        Kernel from the cache or None. The kernel of the mesh with n points is the tail of the cached kernel.
+        """
+        if key in self.kernel_ref and len(self.kernel_ref[key]) >= n:
+            return self.kernel_ref[key][-n:]
+        if key in self.kernel_cache and len(self.kernel_cache[key]) >= n:
+            self.kernel_cache.move_to_end(key)
+            return self.kernel_cache[key][-n:]
+        return None
+
+    def ws2K1(self, i, traj, NdW, w, KS, gamma=None):
+        """
+        Kernel on the mesh from the integrated kernel KS(w) of the trajectory point i
+
+        :param i: index of the trajectory point
+        :param traj: trajectory
+        :param NdW: mesh, see CSR_K1
+        :param w: w, the output of K0_fin_anf or K0_inf_anf
+        :param KS: integrated kernel, the output of K0_fin_anf or K0_inf_anf
+        :param gamma: Lorentz factor or None
+        :return: K1
+        """
         w_range = np.arange(-NdW[0]-1, 0)*NdW[1]
-
-        if L_fin:
-            w, KS = self.k0_fin_anf.eval(i, traj, w_range[0], gamma)
-        else:
-            w, KS = self.K0_inf_anf(i, traj, w_range[0])
-
+        KS = np.atleast_1d(KS)
         KS1 = KS[0]
 
         w, idx = np.unique(w, return_index=True)
@@ -722,7 +853,7 @@ class CSR(PhysProc):
         # sort and unique takes time, but is required to avoid numerical trouble
         if w_range[0] < w[0]:
             m = np.where(w_range < w[0])[0][-1]
-            if L_fin:
+            if gamma is not None:
                 KS2 = self.K0_fin_inf(i, traj, np.append(w_range[0:m+1], w[0]), gamma)
             else:
                 KS2 = self.K0_inf_inf(i, traj, np.append(w_range[0:m+1], w[0]))
@@ -734,9 +865,56 @@ class CSR(PhysProc):
             KS = interp1(w, KS, w_range)
         four_pi_eps0 = 1./(1e-7*speed_of_light**2)
         K1 = np.diff(np.append(np.diff(np.append(KS, 0)), 0))/NdW[1]/four_pi_eps0
-
         return K1
 
+    def CSR_K1(self, i, traj, NdW, gamma=None):
+        """
+        :param i: index of the trajectories points for the convolution kernel is calculated;
+        :param traj: trajectory. traj[0,:] - longitudinal coordinate,
+                                 traj[1,:], traj[2,:], traj[3,:] - rectangular coordinates, \
+                                 traj[4,:], traj[5,:], traj[6,:] - tangential unit vectors
+        :param NdW: list N[0] 0 number of mesh points, N[1] = dW> 0 - increment, Mesh = Mesh = (N: 0) * dW
+        :param gamma:
+        :return:
+        """
+        return self.CSR_K1_multi([i], traj, NdW, gamma, batch=False)[0]
+
+    def CSR_K1_multi(self, indices, traj, NdW, gamma=None, batch=True):
+        """
+        Kernels of several trajectory points. The kernels which are not in the cache are calculated
+        with the batched retarded time calculation K0_fin_anf.eval_multi.
+
+        :param indices: indices of the trajectory points
+        :param traj: trajectory, see CSR_K1
+        :param NdW: mesh, see CSR_K1
+        :param gamma: Lorentz factor or None
+        :param batch: if False, the kernels are calculated one by one
+        :return: list of K1
+        """
+        gamma_key, gamma = self.quantize(gamma)
+        st_key, st = self.quantize(NdW[1])
+        scale = NdW[1] / st if st != NdW[1] else 1.
+        n = int(NdW[0]) + 1
+        keys = [(i, st_key, gamma_key) for i in indices]
+        K1s = [self.cached_K1(key, n) for key in keys]
+        miss = [k for k in range(len(indices)) if K1s[k] is None]
+
+        if len(miss) > 0:
+            wmin = (-NdW[0] - 1)*st
+            if gamma is None:
+                ws = [self.K0_inf_anf(indices[k], traj, wmin) for k in miss]
+            elif batch and len(miss) > 1:
+                ws = self.k0_fin_anf.eval_multi([indices[k] for k in miss], traj, wmin, gamma)
+            else:
+                ws = [self.k0_fin_anf.eval(indices[k], traj, wmin, gamma) for k in miss]
+
+            for k, (w, KS) in zip(miss, ws):
+                K1s[k] = self.ws2K1(indices[k], traj, [NdW[0], st], w, KS, gamma)
+                self.kernel_cache[keys[k]] = K1s[k]
+            while len(self.kernel_cache) > self.kernel_cache_size:
+                self.kernel_cache.popitem(last=False)
+        return [K1 * scale for K1 in K1s]
+
     def prepare(self, lat):
         """
         calculation of trajectory in rectangular coordinates
@@ -755,6 +933,7 @@ class CSR(PhysProc):
 
 
         self.z_csr_start = sum([p.l for p in lat.sequence[:self.indx0]])
+        traj_prev = getattr(self, "csr_traj", None)
         p = Particle()
         beta = 1. if self.energy == None else np.sqrt(1. - 1./(self.energy/m_e_GeV)**2)
         self.csr_traj = np.transpose([[0, p.x, p.y, p.s, p.px, p.py, 1.]])
@@ -863,6 +1042,13 @@ class CSR(PhysProc):
             else:
                 R_vect = [0, 0, 0.]
                 self.csr_traj = arcline(self.csr_traj, delta_s, step, R_vect )
+
+        # the kernels are reused while the trajectory is the same
+        if traj_prev is None or traj_prev.shape != self.csr_traj.shape or not np.array_equal(traj_prev, self.csr_traj):
+            self.clear_kernel_cache()
+        if self.ref_mesh is not None:
+            self.precompute_kernels()
+
         # plot trajectory of the refernece particle
         if self.pict_debug:
             fig = self.plt.figure(figsize=(10, 8))
@@ -884,19 +1070,40 @@ class CSR(PhysProc):
             # np.savetxt("trajectory_cos.txt", self.csr_traj)
         return self.csr_traj
 
-    def apply(self, p_array, delta_s):
-        if delta_s < self.traj_step:
-            logger.debug("CSR delta_s < self.traj_step")
+    def precompute_kernels(self):
+        """
+        Calculation of the kernels of all trajectory points on the reference mesh self.ref_mesh.
+        The kernels are stored in self.kernel_ref and are not limited by self.kernel_cache_size.
+        """
+        if self.energy is None:
+            logger.warning("CSR: energy is not set, the kernels are not precalculated")
             return
+        Ns, st = self.ref_mesh
+        gamma = self.energy / m_e_GeV
+        gamma_key, _ = self.quantize(gamma)
+        st_key, _ = self.quantize(st)
+        for i in range(1, self.csr_traj.shape[1]):
+            key = (i, st_key, gamma_key)
+            if key in self.kernel_ref and len(self.kernel_ref[key]) >= Ns:
+                continue
+            self.kernel_cache.pop(key, None)
+            self.CSR_K1(i, self.csr_traj, [Ns - 1, st], gamma)
+            self.kernel_ref[key] = self.kernel_cache.pop(key)
+
+    def csr_wake(self, s1, s2, Ns, lam_ds, gamma, delta_s):
+        """
+        CSR wake on the equidistant mesh of the charge density, averaged over the trajectory points of the step
+
+        :param s1: start of the mesh [m]
+        :param s2: end of the mesh [m]
+        :param Ns: number of the mesh points
+        :param lam_ds: charge per mesh step, output of Smoothing.Q2EQUI()
+        :param gamma: Lorentz factor
+        :param delta_s: step [m]
+        :return: (lam_K1, sa, st, itr_ra) - energy change [eV] on the mesh, center of the first mesh step,
+                 mesh step and indices of the trajectory points
+        """
         s_cur = self.z0 - self.z_csr_start
-        z = -p_array.tau()
-        ind_z_sort = np.argsort(z)
-        #SBINB, NBIN = subbin_bound(p_array.q_array, z[ind_z_sort], self.x_qbin, self.n_bin, self.m_bin)
-        #B_params = [self.x_qbin, self.n_bin, self.m_bin, self.ip_method, self.sp, self.sigma_min]
-        #s1, s2, Ns, lam_ds = Q2EQUI(p_array.q_array[ind_z_sort], B_params, SBINB, NBIN)
-        SBINB, NBIN = self.sub_bin.subbin_bound(p_array.q_array, z[ind_z_sort], self.x_qbin, self.n_bin, self.m_bin)
-        B_params = [self.x_qbin, self.n_bin, self.m_bin, self.ip_method, self.sp, self.sigma_min]
-        s1, s2, Ns, lam_ds = self.bin_smoth.Q2EQUI(p_array.q_array[ind_z_sort], B_params, SBINB, NBIN)
         st = (s2 - s1) / Ns
         sa = s1 + st / 2.
         Ndw = [Ns - 1, st]
@@ -904,21 +1111,36 @@ class CSR(PhysProc):
         s_array = self.csr_traj[0, :]
         indx = (np.abs(s_array - s_cur)).argmin()
         indx_prev = (np.abs(s_array - (s_cur - delta_s))).argmin()
-        gamma = p_array.E/m_e_GeV
         h = max(1., self.apply_step/self.traj_step)
 
-        itr_ra = np.unique(-np.round(np.arange(-indx, -indx_prev, h))).astype(np.int)
+        itr_ra = np.unique(-np.round(np.arange(-indx, -indx_prev, h))).astype(int)
 
-        nit = 0
         n_iter = len(itr_ra)
         #start = time.time()
-        K1 = self.CSR_K1(itr_ra[nit], self.csr_traj, Ndw, gamma)
+        K1s = self.CSR_K1_multi(itr_ra, self.csr_traj, Ndw, gamma)
+        K1 = K1s[0]
         for nit in range(1, n_iter):
-            K1 += self.CSR_K1(itr_ra[nit], self.csr_traj, Ndw, gamma=gamma)
+            K1 += K1s[nit]
         K1 = K1/n_iter
 
-
         lam_K1 = csr_convolution(lam_ds, K1[::-1]) / st * delta_s
+        return lam_K1, sa, st, itr_ra
+
+    def apply(self, p_array, delta_s):
+        if delta_s < self.traj_step:
+            logger.debug("CSR delta_s < self.traj_step")
+            return
+        z = -p_array.tau()
+        ind_z_sort = p_array.profile.argsort()[::-1]
+        #SBINB, NBIN = subbin_bound(p_array.q_array, z[ind_z_sort], self.x_qbin, self.n_bin, self.m_bin)
+        #B_params = [self.x_qbin, self.n_bin, self.m_bin, self.ip_method, self.sp, self.sigma_min]
+        #s1, s2, Ns, lam_ds = Q2EQUI(p_array.q_array[ind_z_sort], B_params, SBINB, NBIN)
+        SBINB, NBIN = self.sub_bin.subbin_bound(p_array.q_array, z[ind_z_sort], self.x_qbin, self.n_bin, self.m_bin)
+        B_params = [self.x_qbin, self.n_bin, self.m_bin, self.ip_method, self.sp, self.sigma_min]
+        s1, s2, Ns, lam_ds = self.bin_smoth.Q2EQUI(p_array.q_array[ind_z_sort], B_params, SBINB, NBIN)
+
+        gamma = p_array.E/m_e_GeV
+        lam_K1, sa, st, itr_ra = self.csr_wake(s1, s2, Ns, lam_ds, gamma, delta_s)
 
         z_sort = z[ind_z_sort]
         dE = np.interp(z_sort*(1./st)+(0. - sa/st), np.arange(len(lam_K1)), lam_K1)
@@ -930,6 +1152,72 @@ class CSR(PhysProc):
         if self.pict_debug:
             self.plot_wake(p_array, lam_K1, itr_ra, s1, st)
 
+    def chunk_start(self, dz):
+        """
+        Out-of-core tracking, see PhysProc. The particles are not sorted, the sub-bin boundaries are found
+        from the charge histogram instead. Pass 0 - bounds of z and the charge, pass 1 - histogram of z
+        with chunk_hist_bins bins and the sub-bin boundaries, pass 2 - charges of the sub-bins, then the kick.
+        pict_debug is ignored.
+        """
+        if dz < self.traj_step:
+            logger.debug("CSR delta_s < self.traj_step")
+            self.chunk_data = None
+            return
+        self.chunk_data = {"min": np.inf, "max": -np.inf, "q": 0.}
+
+    def chunk_reduce(self, p_array, npass):
+        d = self.chunk_data
+        if d is None or p_array.n == 0:
+            return
+        z = -p_array.tau()
+        d["E"] = p_array.E
+        if npass == 0:
+            d["min"] = min(d["min"], np.min(z))
+            d["max"] = max(d["max"], np.max(z))
+            d["q"] += np.sum(p_array.q_array)
+        elif npass == 1:
+            d["hist"] += np.histogram(z, bins=d["edges"], weights=p_array.q_array)[0]
+        else:
+            # the same sub-bins as in SubBinning.p_per_subbins(): s >= SBINB[k] goes to the sub-bin k
+            k = np.searchsorted(d["SBINB"][1:-1], z, side="right")
+            d["Q"] += np.bincount(k, weights=p_array.q_array, minlength=len(d["Q"]))
+
+    def chunk_reduce_end(self, npass, dz):
+        d = self.chunk_data
+        if d is None:
+            return
+        K_BIN = self.n_bin * self.m_bin
+        if npass == 0:
+            d["edges"] = np.linspace(d["min"], d["max"], self.chunk_hist_bins + 1)
+            d["hist"] = np.zeros(self.chunk_hist_bins)
+            return
+        if npass == 1:
+            # monotone "charge" and "length" vectors on the histogram edges, see SubBinning.subbin_bound()
+            aa = np.append([0.], np.cumsum(d["hist"])) / d["q"]
+            bb = np.linspace(0., 1., len(d["edges"]))
+            aa = aa * self.x_qbin + bb * (1 - self.x_qbin)
+            if np.min(np.diff(aa)) == 0:
+                aa = 0.999 * aa + 0.001 * bb
+            SBINB = interp1(aa, d["edges"], np.arange(K_BIN + 1.) / K_BIN)
+            SBINB[0] = d["min"]
+            SBINB[K_BIN] = d["max"]
+            d["SBINB"] = SBINB
+            d["Q"] = np.zeros(K_BIN)
+            return
+        # charges of the sub-bins are passed as the sorted charges of one particle per sub-bin
+        B_params = [self.x_qbin, self.n_bin, self.m_bin, self.ip_method, self.sp, self.sigma_min]
+        s1, s2, Ns, lam_ds = self.bin_smoth.Q2EQUI(d["Q"], B_params, d["SBINB"], np.ones(K_BIN))
+        d["lam_K1"], d["sa"], d["st"], _ = self.csr_wake(s1, s2, Ns, lam_ds, d["E"] / m_e_GeV, dz)
+
+    def chunk_kick(self, p_array, dz):
+        d = self.chunk_data
+        if d is None:
+            return
+        z = -p_array.tau()
+        dE = np.interp(z * (1. / d["st"]) + (0. - d["sa"] / d["st"]), np.arange(len(d["lam_K1"])), d["lam_K1"])
+        pc_ref = np.sqrt(p_array.E ** 2 / m_e_GeV ** 2 - 1) * m_e_GeV
+        p_array.rparticles[5] += dE * 1e-9 / pc_ref
+
     def finalize(self, *args, **kwargs):
         """
         the method is called at the end of tracking
@@ -1011,7 +1299,7 @@ class CSR(PhysProc):
         indx_prev = (np.abs(s_array - (s_cur - delta_s))).argmin()
         gamma = p_array.E / m_e_GeV
         h = max(1., self.apply_step / self.traj_step)
-        itr_ra = np.unique(-np.round(np.arange(-indx, -indx_prev, h))).astype(np.int)
+        itr_ra = np.unique(-np.round(np.arange(-indx, -indx_prev, h))).astype(int)
 
         nit = 0
         n_iter = len(itr_ra)
@@ -274,6 +274,8 @@ class Undulator(Element):
     Ky - undulator parameter for horizantal field;\n
     field_file - absolute path to magnetic field data;\n
     mag_field - None by default, the magnetic field map function - (Bx, By, Bz) = f(x, y, z)
+                or CompiledField (ocelot/cpbd/high_order.py) for the compiled Runge-Kutta tracking.
+                If None and field_file is given, RungeKuttaTM uses CompiledField.from_field_map(field_map)
     eid - id of undulator.
     """
     def __init__(self, lperiod=0., nperiods=0, Kx=0., Ky=0., field_file=None, eid=None):
@@ -11,9 +11,11 @@ _logger = logging.getLogger(__name__)
 
 try:
     import numba as nb
+    from numba import prange
     nb_flag = True
 except:
     _logger.info("high_order.py: module NUMBA is not installed. Install it to speed up calculation")
+    prange = range
     nb_flag = False
     
 __MAD__ = True
@@ -912,7 +914,7 @@ def moments_py(bx, by, Bx, By, Bz, dzk):
     my = -k*(bx*Bz - Bx*(1.+by2) + bxy*By)
     return mx, my
 
-moments = moments_py if not nb_flag else nb.jit(moments_py)
+moments = moments_py if not nb_flag else nb.jit(nopython=True, nogil=True)(moments_py)
 
 
 def rk_track_in_field(y0, s_stop, N, energy, mag_field, s_start=0.):
@@ -1021,7 +1023,8 @@ def rk_field(rparticles, s_start, s_stop, N, energy, mag_field, long_dynamics=Tr
     :param s_stop:
     :param N: number of points on the trajectory
     :param energy: in GeV
-    :param mag_field: must be function e.g. lambda x, y, z: (Bx, By, Bz)
+    :param mag_field: must be function e.g. lambda x, y, z: (Bx, By, Bz) or CompiledField.
+                      In the last case the tracking is done by rk_field_compiled()
     :param long_dynamics: True, if True, includes longitudinal dynamics, otherwise only transverse
     :return:
     """
@@ -1029,6 +1032,9 @@ def rk_field(rparticles, s_start, s_stop, N, energy, mag_field, long_dynamics=Tr
         print("rk_field: s_start > s_stop. Setup s_start = 0")
         s_start = 0.
 
+    if isinstance(mag_field, CompiledField):
+        return rk_field_compiled(rparticles, s_start, s_stop, N, energy, mag_field, long_dynamics)
+
     ref_path = 0
 
     if long_dynamics:
@@ -1057,6 +1063,401 @@ def rk_field(rparticles, s_start, s_stop, N, energy, mag_field, long_dynamics=Tr
     return rparticles
 
 
+
+def und_field_rk_py(x, y, z, params):
+    """
+    Analytic field of the planar undulator, see und_field() in ocelot/rad/radiation_py.py
+
+    :param x: horizontal coordinate
+    :param y: vertical coordinate
+    :param z: longitudinal coordinate
+    :param params: array [lperiod, Kx, ax, nperiods]
+                    ax - width of the poles, if ax <= 0 the poles are infinitely wide,
+                    nperiods - number of periods, if nperiods <= 0 the field is without end poles
+    :return: Bx, By, Bz
+    """
+    lperiod = params[0]
+    kx = 0.
+    if params[2] > 0:
+        kx = 2. * np.pi / params[2]
+    kz = 2. * np.pi / lperiod
+    ky = np.sqrt(kz * kz + kx * kx)
+    B0 = params[1] * m_e_eV * kz / speed_of_light
+    k1 = -B0 * kx / ky
+    k2 = -B0 * kz / ky
+
+    ky_y = ky * y
+    kz_z = kz * z
+    cosx = 1.
+    sinx = 0.
+    if kx != 0.:
+        cosx = np.cos(kx * x)
+        sinx = np.sin(kx * x)
+
+    cosz = np.cos(kz_z)
+    nperiods = params[3]
+    if nperiods > 0:
+        z_coef = (0.125 * (np.sign(z) + 1) + 0.25 * (np.sign(z - lperiod / 2.) + 1)
+                  + 0.125 * (np.sign(z - lperiod) + 1) - 0.125 * (np.sign(z - (nperiods - 1) * lperiod) + 1)
+                  - 0.25 * (np.sign(z - (nperiods - 0.5) * lperiod) + 1)
+                  - 0.125 * (np.sign(z - nperiods * lperiod) + 1))
+        cosz = np.cos(kz_z + np.pi / 2.) * z_coef
+
+    sinhy = np.sinh(ky_y)
+    Bx = k1 * sinx * sinhy * cosz
+    By = B0 * cosx * np.cosh(ky_y) * cosz
+    Bz = k2 * cosx * sinhy * np.sin(kz_z)
+    return Bx, By, Bz
+
+
+def uniform_field_rk_py(x, y, z, params):
+    """
+    Uniform field e.g. of the dipole magnet
+
+    :param params: array [Bx, By, Bz]
+    :return: Bx, By, Bz
+    """
+    return params[0], params[1], params[2]
+
+
+def grid_weights_py(f, n):
+    """
+    Indices of the neighbour grid nodes and weight of the second node for linear interpolation.
+    Coordinate outside the grid is moved to the grid edge.
+
+    :param f: coordinate in units of the grid step counted from the first node
+    :param n: number of nodes
+    :return: i0, i1, w
+    """
+    if n == 1:
+        return 0, 0, 0.
+    if f < 0.:
+        f = 0.
+    elif f > n - 1:
+        f = n - 1.
+    i0 = int(f)
+    if i0 > n - 2:
+        i0 = n - 2
+    return i0, i0 + 1, f - i0
+
+
+def field_map_rk_py(x, y, z, params):
+    """
+    Trilinear interpolation of the tabulated field on the regular grid.
+    The field is zero outside the map in longitudinal direction and it is taken from the map edge
+    outside the map in transverse plane.
+
+    :param params: array [nx, ny, nz, x0, y0, z0, dx, dy, dz, Bx, By, Bz]
+                   n* - number of nodes, *0 - first node, d* - grid steps,
+                   B* - flattened field arrays (nx*ny*nz each), index = ix + nx*(iy + ny*iz)
+    :return: Bx, By, Bz
+    """
+    nx = int(params[0])
+    ny = int(params[1])
+    nz = int(params[2])
+    fz = (z - params[5]) / params[8]
+    if fz < 0. or fz > nz - 1:
+        return 0., 0., 0.
+    ix0, ix1, wx = grid_weights((x - params[3]) / params[6], nx)
+    iy0, iy1, wy = grid_weights((y - params[4]) / params[7], ny)
+    iz0, iz1, wz = grid_weights(fz, nz)
+    n = nx * ny * nz
+    Bx, By, Bz = 0., 0., 0.
+    for c in range(8):
+        w = 1.
+        if c & 1:
+            ix = ix1
+            w *= wx
+        else:
+            ix = ix0
+            w *= 1. - wx
+        if c & 2:
+            iy = iy1
+            w *= wy
+        else:
+            iy = iy0
+            w *= 1. - wy
+        if c & 4:
+            iz = iz1
+            w *= wz
+        else:
+            iz = iz0
+            w *= 1. - wz
+        if w == 0.:
+            continue
+        ind = 9 + ix + nx * (iy + ny * iz)
+        Bx += w * params[ind]
+        By += w * params[ind + n]
+        Bz += w * params[ind + 2 * n]
+    return Bx, By, Bz
+
+
+def field_on_points_py(func, X, Y, Z, params):
+    """
+    Calculation of the compiled field in the array of points
+
+    :param func: field function func(x, y, z, params) -> (Bx, By, Bz)
+    :param X: array of horizontal coordinates
+    :param Y: array of vertical coordinates
+    :param Z: array of longitudinal coordinates
+    :param params: array of the field parameters
+    :return: Bx, By, Bz arrays
+    """
+    n = len(X)
+    Bx = np.zeros(n)
+    By = np.zeros(n)
+    Bz = np.zeros(n)
+    for i in range(n):
+        Bx[i], By[i], Bz[i] = func(X[i], Y[i], Z[i], params)
+    return Bx, By, Bz
+
+
+if nb_flag:
+    und_field_rk = nb.jit(nopython=True, nogil=True)(und_field_rk_py)
+    uniform_field_rk = nb.jit(nopython=True, nogil=True)(uniform_field_rk_py)
+    grid_weights = nb.jit(nopython=True, nogil=True)(grid_weights_py)
+    field_map_rk = nb.jit(nopython=True, nogil=True)(field_map_rk_py)
+    field_on_points = nb.jit(nopython=True, nogil=True)(field_on_points_py)
+else:
+    und_field_rk = und_field_rk_py
+    uniform_field_rk = uniform_field_rk_py
+    grid_weights = grid_weights_py
+    field_map_rk = field_map_rk_py
+    field_on_points = field_on_points_py
+
+
+class CompiledField:
+    """
+    Magnetic field which is evaluated inside the compiled Runge-Kutta integrator rk_field_compiled().
+
+    func(x, y, z, params) -> (Bx, By, Bz) works with scalars and is compiled with numba,
+    all parameters of the field are packed into 1D array params.
+    The object can be used as the usual mag_field function: Bx, By, Bz = field(X, Y, Z)
+
+    Predefined fields: CompiledField.undulator(), CompiledField.uniform() and CompiledField.from_field_map()
+    """
+    def __init__(self, func, params):
+        self.func = func
+        self.params = np.ascontiguousarray(params, dtype=np.float64)
+
+    def __call__(self, x, y, z):
+        if np.ndim(x) == 0 and np.ndim(y) == 0 and np.ndim(z) == 0:
+            return self.func(x, y, z, self.params)
+        X, Y, Z = np.broadcast_arrays(x, y, z)
+        Bx, By, Bz = field_on_points(self.func, np.ascontiguousarray(X, dtype=np.float64).ravel(),
+                                     np.ascontiguousarray(Y, dtype=np.float64).ravel(),
+                                     np.ascontiguousarray(Z, dtype=np.float64).ravel(), self.params)
+        return Bx.reshape(X.shape), By.reshape(X.shape), Bz.reshape(X.shape)
+
+    @classmethod
+    def undulator(cls, lperiod, Kx, ax=-1, nperiods=None):
+        """
+        Planar undulator field
+
+        :param lperiod: undulator period [m]
+        :param Kx: undulator parameter
+        :param ax: width of the poles [m], if ax <= 0 the poles are infinitely wide
+        :param nperiods: number of periods, if None the field is without end poles
+        :return: CompiledField
+        """
+        nperiods = 0 if nperiods is None else nperiods
+        return cls(und_field_rk, [lperiod, Kx, ax, nperiods])
+
+    @classmethod
+    def uniform(cls, Bx=0., By=0., Bz=0.):
+        """
+        Uniform field e.g. of the dipole magnet
+
+        :param Bx: horizontal component [T]
+        :param By: vertical component [T]
+        :param Bz: longitudinal component [T]
+        :return: CompiledField
+        """
+        return cls(uniform_field_rk, [Bx, By, Bz])
+
+    @classmethod
+    def from_field_map(cls, field_map):
+        """
+        Field from the tabulated field map (see ocelot/cpbd/field_map.py).
+        The longitudinal coordinate of the map is counted from the first point of the map.
+        2D (z, By) and (z, Bx, By) maps are considered as independent on the transverse coordinates,
+        nonuniform longitudinal grid of these maps is interpolated on the uniform one.
+
+        :param field_map: FieldMap
+        :return: CompiledField
+        """
+        unit_coef = 0.001 if field_map.units == "mm" else 1.
+        z = (np.asarray(field_map.z_arr, dtype=np.float64) - field_map.z_arr[0]) * unit_coef
+        nz = len(z)
+        if len(field_map.x_arr) == 0:
+            nx, ny = 1, 1
+            x0, y0, dx, dy = 0., 0., 1., 1.
+            Bx = field_map.Bx_arr if len(field_map.Bx_arr) == nz else np.zeros(nz)
+            By = field_map.By_arr if len(field_map.By_arr) == nz else np.zeros(nz)
+            Bz = field_map.Bz_arr if len(field_map.Bz_arr) == nz else np.zeros(nz)
+            z_uni = np.linspace(z[0], z[-1], num=nz)
+            if not np.allclose(z, z_uni, rtol=0, atol=1e-9 * (z[-1] - z[0])):
+                Bx, By, Bz = [np.interp(z_uni, z, B) for B in (Bx, By, Bz)]
+            z = z_uni
+        else:
+            nx, ny = len(field_map.x_arr), len(field_map.y_arr)
+            x0, y0 = field_map.x_arr[0] * unit_coef, field_map.y_arr[0] * unit_coef
+            dx = (field_map.x_arr[1] - field_map.x_arr[0]) * unit_coef if nx > 1 else 1.
+            dy = (field_map.y_arr[1] - field_map.y_arr[0]) * unit_coef if ny > 1 else 1.
+            Bx, By, Bz = field_map.Bx_arr, field_map.By_arr, field_map.Bz_arr
+        dz = z[1] - z[0]
+        params = np.hstack(([nx, ny, nz, x0, y0, z[0], dx, dy, dz], Bx, By, Bz))
+        return cls(field_map_rk, params)
+
+
+def rk_track_field_py(rparticles, z0, dz, N, gamma0, func, params, path, traj):
+    """
+    Compiled Runge-Kutta tracking of the particles through the field (see rk_track_in_field()).
+    The whole step loop is done for each particle independently and only the final state is kept.
+
+    :param rparticles: array 6 x n, transverse coordinates x, x', y, y' are replaced by final ones
+    :param z0: starting longitudinal coordinate
+    :param dz: integration step
+    :param N: number of points on the trajectory
+    :param gamma0: reference Lorentz factor
+    :param func: compiled field function func(x, y, z, params) -> (Bx, By, Bz)
+    :param params: array of the field parameters
+    :param path: array n, the trajectory lengths are written in it
+    :param traj: array N*9 x n to store trajectory as in rk_track_in_field() or array 0 x n to skip it
+    :return:
+    """
+    beta0 = np.sqrt(1. - 1. / (gamma0 * gamma0))
+    save_traj = traj.shape[0] > 0
+    for j in prange(rparticles.shape[1]):
+        X = rparticles[0, j]
+        bxconst = rparticles[1, j]
+        Y = rparticles[2, j]
+        byconst = rparticles[3, j]
+        dp = rparticles[5, j]
+        gammai = gamma0 * (1 + dp * beta0)
+        dzk = dz * speed_of_light / (m_e_eV * gammai)
+        Z = z0
+        s = 0.
+        for i in range(N - 1):
+            bx = bxconst
+            by = byconst
+            kx1 = bx * dz
+            ky1 = by * dz
+            Bx, By, Bz = func(X, Y, Z, params)
+            mx1, my1 = moments(bx, by, Bx, By, Bz, dzk)
+            if save_traj:
+                traj[i * 9 + 0, j] = X
+                traj[i * 9 + 1, j] = bxconst
+                traj[i * 9 + 2, j] = Y
+                traj[i * 9 + 3, j] = byconst
+                traj[i * 9 + 4, j] = Z
+                traj[i * 9 + 5, j] = dp
+                traj[i * 9 + 6, j] = Bx
+                traj[i * 9 + 7, j] = By
+                traj[i * 9 + 8, j] = Bz
+            # K2
+            bx = bxconst + mx1 / 2.
+            by = byconst + my1 / 2.
+            kx2 = bx * dz
+            ky2 = by * dz
+            Bx, By, Bz = func(X + kx1 / 2., Y + ky1 / 2., Z + dz / 2., params)
+            mx2, my2 = moments(bx, by, Bx, By, Bz, dzk)
+            # K3
+            bx = bxconst + mx2 / 2.
+            by = byconst + my2 / 2.
+            kx3 = bx * dz
+            ky3 = by * dz
+            Bx, By, Bz = func(X + kx2 / 2., Y + ky2 / 2., Z + dz / 2., params)
+            mx3, my3 = moments(bx, by, Bx, By, Bz, dzk)
+            # K4
+            Z_n = Z + dz
+            bx = bxconst + mx3
+            by = byconst + my3
+            kx4 = bx * dz
+            ky4 = by * dz
+            Bx, By, Bz = func(X + kx3, Y + ky3, Z_n, params)
+            mx4, my4 = moments(bx, by, Bx, By, Bz, dzk)
+
+            X = X + 1 / 6. * (kx1 + 2. * (kx2 + kx3) + kx4)
+            bxconst = bxconst + 1 / 6. * (mx1 + 2. * (mx2 + mx3) + mx4)
+            Y = Y + 1 / 6. * (ky1 + 2. * (ky2 + ky3) + ky4)
+            byconst = byconst + 1 / 6. * (my1 + 2. * (my2 + my3) + my4)
+            s += (Z_n - Z) * np.sqrt(1 + bxconst * bxconst + byconst * byconst)
+            Z = Z_n
+        if save_traj:
+            Bx, By, Bz = func(X, Y, Z, params)
+            traj[(N - 1) * 9 + 0, j] = X
+            traj[(N - 1) * 9 + 1, j] = bxconst
+            traj[(N - 1) * 9 + 2, j] = Y
+            traj[(N - 1) * 9 + 3, j] = byconst
+            traj[(N - 1) * 9 + 4, j] = Z
+            traj[(N - 1) * 9 + 5, j] = dp
+            traj[(N - 1) * 9 + 6, j] = Bx
+            traj[(N - 1) * 9 + 7, j] = By
+            traj[(N - 1) * 9 + 8, j] = Bz
+        rparticles[0, j] = X
+        rparticles[1, j] = bxconst
+        rparticles[2, j] = Y
+        rparticles[3, j] = byconst
+        path[j] = s
+
+rk_track_field = rk_track_field_py if not nb_flag else nb.jit(nopython=True, parallel=True)(rk_track_field_py)
+
+
+def rk_track_in_field_compiled(y0, s_stop, N, energy, field, s_start=0.):
+    """
+    The same as rk_track_in_field() but the field is CompiledField and the step loop is compiled
+
+    :param y0: array 6 x n; initial coordinates of n particles
+    :param s_stop: longitudinal coordinate of stop
+    :param N: number of steps
+    :param energy: energy of particle in [GeV]
+    :param field: CompiledField
+    :param s_start: starting longitudinal coordinate
+    :return: array with shape (N*9, n) - coordinates and magnetic fields on the trajectory
+            [x, x', y, y', z, dE/pc, Bx, By, Bz, ...
+            xn, xn', yn, yn', zn, zn', Bxn, Byn, Bzn]
+    """
+    z = np.linspace(s_start, s_stop, num=N)
+    rparticles = np.array(y0, dtype=np.float64)
+    n = rparticles.shape[1]
+    traj = np.zeros((N * 9, n))
+    rk_track_field(rparticles, z[0], z[1] - z[0], N, energy / m_e_GeV, field.func, field.params, np.zeros(n), traj)
+    return traj
+
+
+def rk_field_compiled(rparticles, s_start, s_stop, N, energy, field, long_dynamics=True):
+    """
+    Method to track particles through CompiledField. The result is the same as of rk_field() but
+    the trajectories are not stored and the step loop over all particles is compiled.
+
+    :param rparticles: initial coordinates of the particles shape (6xN), N number of particles (e.g. ParticleArray.rparticles)
+    :param s_start:
+    :param s_stop:
+    :param N: number of points on the trajectory
+    :param energy: in GeV
+    :param field: CompiledField
+    :param long_dynamics: True, if True, includes longitudinal dynamics, otherwise only transverse
+    :return:
+    """
+    if s_start > s_stop:
+        print("rk_field: s_start > s_stop. Setup s_start = 0")
+        s_start = 0.
+    z = np.linspace(s_start, s_stop, num=N)
+    gamma0 = energy / m_e_GeV
+    no_traj = np.zeros((0, rparticles.shape[1]))
+
+    path = np.zeros(rparticles.shape[1])
+    rk_track_field(rparticles, z[0], z[1] - z[0], N, gamma0, field.func, field.params, path, no_traj)
+
+    if long_dynamics:
+        ref = np.zeros((6, 1))
+        ref_path = np.zeros(1)
+        rk_track_field(ref, z[0], z[1] - z[0], N, gamma0, field.func, field.params, ref_path, no_traj[:, :1])
+        rparticles[4, :] += z[0] + path - ref_path[0]
+    return rparticles
+
+
 def scipy_track_in_field(y0, l, N, energy, mag_field):# y0, l, N, energy, mag_field
     z = np.linspace(0.,l, num=N)
     def func(y, z, fields):
@@ -6,9 +6,24 @@ author sergey.tomin
 """
 from ocelot.cpbd.elements import *
 import os, sys
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from ocelot.adaptors.astra2ocelot import astraBeam2particleArray, particleArray2astraBeam
 from ocelot.adaptors.csrtrack2ocelot import csrtrackBeam2particleArray, particleArray2csrtrackBeam
 from ocelot.cpbd.beam import ParticleArray, Twiss, Beam
+from ocelot.common.ocelog import *
+
+_logger = logging.getLogger(__name__)
+
+try:
+    import h5py
+    h5py_flag = True
+except:
+    _logger.debug("io.py: module H5PY is not installed. Install it to save/load beam in HDF5 format")
+    h5py_flag = False
+
+HDF5_COORDINATES = ("x", "px", "y", "py", "tau", "p")
 
 
 def save_particle_array2npz(filename, p_array):
@@ -27,30 +42,212 @@ def load_particle_array_from_npz(filename, print_params=False):
     p_array = ParticleArray()
     with np.load(filename) as data:
         for key in data.keys():
-            p_array.__dict__[key] = data[key]
+            setattr(p_array, key, data[key])
+    return p_array
+
+
+def save_particle_array2npy(dirname, p_array):
+    """
+    Save ParticleArray uncompressed in the directory (extension *.npyd) which contains
+    rparticles.npy, q_array.npy and params.json (E, s).
+    The beam can be loaded without copy by load_particle_array_from_npy().
+
+    Each file is written to a temporary file and renamed, so the beams which are memory-mapped from
+    the old files (e.g. p_array itself) keep their data and the beam can be saved to the same directory.
+
+    :param dirname: path to directory, dirname.npyd
+    :param p_array: ParticleArray
+    :return:
+    """
+    dirname = dirname.rstrip("/\\")
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    params = json.dumps({"E": float(p_array.E), "s": float(p_array.s)}).encode()
+    for name, data in [("rparticles.npy", p_array.rparticles), ("q_array.npy", p_array.q_array),
+                       ("params.json", params)]:
+        tmp_name = os.path.join(dirname, "%s.%d.%d.tmp" % (name, os.getpid(), threading.get_ident()))
+        try:
+            with open(tmp_name, "wb") as f:
+                if isinstance(data, bytes):
+                    f.write(data)
+                else:
+                    np.save(f, data)
+            os.replace(tmp_name, os.path.join(dirname, name))
+        except:
+            os.remove(tmp_name)
+            raise
+
+
+def load_particle_array_from_npy(dirname, mmap_mode="c"):
+    """
+    Load ParticleArray from the directory created by save_particle_array2npy().
+    By default the arrays are memory-mapped in copy-on-write mode: nothing is read until it is used,
+    many processes which load the same beam share one physical copy of it, and changes of the particles
+    are not written to the file.
+
+    :param dirname: path to directory, dirname.npyd
+    :param mmap_mode: "c" - copy-on-write, "r" - read-only, None - arrays are read into memory
+    :return: ParticleArray
+    """
+    dirname = dirname.rstrip("/\\")
+    rparticles = np.load(os.path.join(dirname, "rparticles.npy"), mmap_mode=mmap_mode)
+    q_array = np.load(os.path.join(dirname, "q_array.npy"), mmap_mode=mmap_mode)
+    with open(os.path.join(dirname, "params.json"), "r") as f:
+        params = json.load(f)
+    p_array = ParticleArray(dtype=rparticles.dtype)
+    # plain ndarray views of the mapped buffers, np.memmap subclass is not propagated to the results of operations
+    p_array.rparticles = np.asarray(rparticles)
+    p_array.q_array = np.asarray(q_array)
+    p_array.E = params["E"]
+    p_array.s = params["s"]
+    return p_array
+
+
+def create_hdf5_beam_file(filename, n, E=0., s=0., charge=None, dtype=np.float64, chunk_size=1000000,
+                          compression=None, compression_opts=None):
+    """
+    Function creates HDF5 beam file with empty chunked datasets. Group "beam" contains one dataset per coordinate
+    ("x", "px", "y", "py", "tau", "p") and "q_array", attributes E [GeV], s [m] and charge [C].
+    The blocks of particles can be written independently with write_hdf5_beam_block(),
+    e.g. one block per process after each other.
+
+    :param filename: path to file, filename.h5
+    :param n: number of particles
+    :param E: beam energy in [GeV]
+    :param s: position of the beam in [m]
+    :param charge: total charge in [C], None - not known yet (is calculated from q_array by save_particle_array2hdf5)
+    :param dtype: dtype of coordinates
+    :param chunk_size: number of particles in HDF5 chunk
+    :param compression: None, "lzf" or "gzip"
+    :param compression_opts: None or compression level for "gzip"
+    :return:
+    """
+    if not h5py_flag:
+        raise ImportError("create_hdf5_beam_file: module H5PY is not installed")
+    chunks = (max(1, min(chunk_size, n)),)
+    with h5py.File(filename, "w") as f:
+        grp = f.create_group("beam")
+        for name in HDF5_COORDINATES + ("q_array",):
+            grp.create_dataset(name, shape=(n,), dtype=np.float64 if name == "q_array" else dtype,
+                               chunks=chunks, compression=compression, compression_opts=compression_opts,
+                               shuffle=compression is not None)
+        grp.attrs["E"] = E
+        grp.attrs["s"] = s
+        grp.attrs["n"] = n
+        if charge is not None:
+            grp.attrs["charge"] = charge
+
+
+def write_hdf5_beam_block(filename, p_array, i0=0):
+    """
+    Function writes ParticleArray into HDF5 beam file (see create_hdf5_beam_file()) starting from particle i0
+
+    :param filename: path to file, filename.h5
+    :param p_array: ParticleArray
+    :param i0: index of the first particle
+    :return:
+    """
+    if not h5py_flag:
+        raise ImportError("write_hdf5_beam_block: module H5PY is not installed")
+    i1 = i0 + p_array.n
+    with h5py.File(filename, "r+") as f:
+        grp = f["beam"]
+        for i, name in enumerate(HDF5_COORDINATES):
+            grp[name][i0:i1] = p_array.rparticles[i]
+        grp["q_array"][i0:i1] = p_array.q_array
+
+
+def save_particle_array2hdf5(filename, p_array, chunk_size=1000000, compression=None, compression_opts=None):
+    """
+    Save ParticleArray in HDF5 format with chunked, optionally compressed datasets per coordinate
+
+    :param filename: path to file, filename.h5
+    :param p_array: ParticleArray
+    :param chunk_size: number of particles in HDF5 chunk
+    :param compression: None, "lzf" (fast) or "gzip"
+    :param compression_opts: None or compression level for "gzip"
+    :return:
+    """
+    create_hdf5_beam_file(filename, p_array.n, E=p_array.E, s=p_array.s, charge=np.sum(p_array.q_array),
+                          dtype=p_array.rparticles.dtype, chunk_size=chunk_size, compression=compression,
+                          compression_opts=compression_opts)
+    write_hdf5_beam_block(filename, p_array, i0=0)
+
+
+def load_particle_array_from_hdf5(filename, coordinates=None, nth=1, tau_range=None, start=0, stop=None,
+                                  block_size=1000000):
+    """
+    Load ParticleArray from HDF5 beam file. Partial reads are possible, the file is read block by block.
+
+    :param filename: path to file, filename.h5
+    :param coordinates: None or list of coordinates to read e.g. ["x", "px"], other coordinates are zeros.
+    :param nth: every n-th particle is read, charge of particles is multiplied by nth (as in ParticleArray.thin_out())
+    :param tau_range: None or (tau_min, tau_max), only particles with tau_min <= tau < tau_max are read
+    :param start: index of the first particle
+    :param stop: None or index of the last particle (not included)
+    :param block_size: number of particles read at once
+    :return: ParticleArray
+    """
+    if not h5py_flag:
+        raise ImportError("load_particle_array_from_hdf5: module H5PY is not installed")
+    if coordinates is None:
+        coordinates = HDF5_COORDINATES
+    nth = int(nth)
+    with h5py.File(filename, "r") as f:
+        grp = f["beam"]
+        n = grp["q_array"].shape[0]
+        stop = n if stop is None else min(stop, n)
+        dtype = grp["x"].dtype
+        blocks = []
+        for i0 in range(start, stop, block_size * nth):
+            i1 = min(i0 + block_size * nth, stop)
+            inds = slice(i0, i1, nth)
+            mask = None
+            if tau_range is not None:
+                tau = grp["tau"][inds]
+                mask = np.logical_and(tau >= tau_range[0], tau < tau_range[1])
+            q = grp["q_array"][inds]
+            block = np.zeros((6, len(q)), dtype=dtype)
+            for name in coordinates:
+                block[HDF5_COORDINATES.index(name)] = grp[name][inds]
+            if mask is not None:
+                block, q = block[:, mask], q[mask]
+            blocks.append((block, q))
+        p_array = ParticleArray(dtype=dtype)
+        if len(blocks) > 0:
+            p_array.rparticles = np.hstack([b[0] for b in blocks])
+            p_array.q_array = np.concatenate([b[1] for b in blocks]) * nth
+        p_array.E = float(grp.attrs["E"])
+        p_array.s = float(grp.attrs["s"])
     return p_array
 
 
 def load_particle_array(filename, print_params=False):
     """
-    Universal function to load beam file, *.ast (ASTRA), *.fmt1 (CSRTrack) or *.npz format
+    Universal function to load beam file, *.ast (ASTRA), *.fmt1 (CSRTrack), *.npz, *.h5 (HDF5) or
+    *.npyd (memory-mapped directory, see load_particle_array_from_npy()) format
 
     Note that downloading ParticleArray from the astra file (.ast) and saving it back does not give the same distribution.
     The difference arises because the array of particles does not have a reference particle, and in this case
     the first particle is used as a reference.
 
-    :param filename: path to file, filename.ast or filename.npz
+    :param filename: path to file, filename.ast, filename.npz, filename.h5 or filename.npyd
     :return: ParticleArray
     """
-    name, file_extension = os.path.splitext(filename)
+    name, file_extension = os.path.splitext(filename.rstrip("/\\"))
     if file_extension == ".npz":
         parray = load_particle_array_from_npz(filename, print_params=False)
+    elif file_extension == ".npyd":
+        parray = load_particle_array_from_npy(filename)
     elif file_extension in [".ast", ".001"]:
         parray = astraBeam2particleArray(filename, print_params=False)
     elif file_extension in [".fmt1"]:
         parray = csrtrackBeam2particleArray(filename)
+    elif file_extension in [".h5", ".hdf5"]:
+        parray = load_particle_array_from_hdf5(filename)
     else:
-        raise Exception("Unknown format of the beam file: " + file_extension + " but must be *.ast, *fmt1 or *.npz ")
+        raise Exception("Unknown format of the beam file: " + file_extension +
+                        " but must be *.ast, *fmt1, *.npz, *.h5 or *.npyd")
 
     if print_params:
         print(parray)
@@ -60,27 +257,85 @@ def load_particle_array(filename, print_params=False):
 
 def save_particle_array(filename, p_array, ref_index=0):
     """
-    Universal function to save beam file, *.ast (ASTRA), *.fmt1 (CSRTrack) or *.npz format
+    Universal function to save beam file, *.ast (ASTRA), *.fmt1 (CSRTrack), *.npz, *.h5 (HDF5) or
+    *.npyd (uncompressed directory) format
 
     Note that downloading ParticleArray from the astra file (.ast) and saving it back does not give the same distribution.
     The difference arises because the array of particles does not have a reference particle, and in this case
     the first particle is used as a reference.
 
-    :param filename: path to file, filename.ast or filename.npz
+    :param filename: path to file, filename.ast, filename.npz, filename.h5 or filename.npyd
     :param ref_index: index of ref particle
     :return: ParticleArray
     """
-    name, file_extension = os.path.splitext(filename)
+    name, file_extension = os.path.splitext(filename.rstrip("/\\"))
     if file_extension == ".npz":
         save_particle_array2npz(filename, p_array)
+    elif file_extension == ".npyd":
+        save_particle_array2npy(filename, p_array)
     elif file_extension == ".ast":
         particleArray2astraBeam(p_array, filename, ref_index)
     elif file_extension == ".fmt1":
         particleArray2csrtrackBeam(p_array, filename)
+    elif file_extension in [".h5", ".hdf5"]:
+        save_particle_array2hdf5(filename, p_array)
     else:
-        raise Exception("Unknown format of the beam file: " + file_extension + " but must be *.ast, *.fmt1 or *.npz")
+        raise Exception("Unknown format of the beam file: " + file_extension +
+                        " but must be *.ast, *.fmt1, *.npz, *.h5 or *.npyd")
 
 
+
+class BeamWriter:
+    """
+    Background writer of the beam files. save() takes a copy of the ParticleArray and returns immediately,
+    the file is written by save_particle_array() in the writer thread. The files are written in the order of
+    the save() calls. Not more than max_pending copies wait for writing, otherwise save() waits,
+    so the memory is bounded.
+
+    :param max_pending: 2, maximum number of the beam copies waiting for writing
+    """
+    def __init__(self, max_pending=2):
+        self.max_pending = max_pending
+        self.executor = None
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+
+    def save(self, filename, p_array, ref_index=0):
+        """
+        Method schedules writing of the beam file
+
+        :param filename: path to file, see save_particle_array()
+        :param p_array: ParticleArray
+        :param ref_index: index of ref particle
+        :return:
+        """
+        self.slots.acquire()
+        snapshot = ParticleArray(dtype=p_array.rparticles.dtype)
+        snapshot.rparticles = np.copy(p_array.rparticles)
+        snapshot.q_array = np.copy(p_array.q_array)
+        snapshot.E = p_array.E
+        snapshot.s = p_array.s
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        future = self.executor.submit(save_particle_array, filename, snapshot, ref_index)
+        future.add_done_callback(self._done)
+        self.futures.append(future)
+
+    def _done(self, future):
+        self.slots.release()
+        if future.exception() is not None:
+            _logger.error("BeamWriter: " + str(future.exception()))
+
+    def flush(self):
+        """
+        Method waits until all scheduled files are written. Exception of the writing is raised here.
+
+        :return:
+        """
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
 def find_drifts(lat):
     drift_lengs = []
     drifts = []
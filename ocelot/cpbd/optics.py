@@ -62,6 +62,8 @@ class SecondOrderMult:
                 X[i, n] = r_tmp + tmp
 
     def numexpr_apply(self, X, R, T):
+        R = R.astype(X.dtype, copy=False)
+        T = T.astype(X.dtype, copy=False)
         x, px, y, py, tau, dp = np.copy((X[0], X[1], X[2], X[3], X[4], X[5]))
         R00, R01, R02, R03, R04, R05 = R[0, 0], R[0, 1], R[0, 2], R[0, 3], R[0, 4], R[0, 5]
         R10, R11, R12, R13, R14, R15 = R[1, 0], R[1, 1], R[1, 2], R[1, 3], R[1, 4], R[1, 5]
@@ -84,6 +86,8 @@ class SecondOrderMult:
 
 
     def numpy_apply(self, X, R, T):
+        R = R.astype(X.dtype, copy=False)
+        T = T.astype(X.dtype, copy=False)
         Xr = np.dot(R, X)
         x, px, y, py, tau, dp = X[0], X[1], X[2], X[3], X[4], X[5]
         x2 = x * x
@@ -247,7 +251,10 @@ class TransferMap:
         return tws
 
     def mul_p_array(self, rparticles, energy=0.):
-        a = np.add(np.dot(self.R(energy), rparticles), self.B(energy))
+        # for the single precision particles the map is applied in single precision
+        R = self.R(energy).astype(rparticles.dtype, copy=False)
+        B = self.B(energy).astype(rparticles.dtype, copy=False)
+        a = np.add(np.dot(R, rparticles), B)
         rparticles[:] = a[:]
         return rparticles
 
@@ -295,6 +302,7 @@ class TransferMap:
             self.map(prcl_series.rparticles, energy=prcl_series.E)
             prcl_series.E += self.delta_e
             prcl_series.s += self.length
+            prcl_series.modified()
 
         elif prcl_series.__class__ == Particle:
             p = prcl_series
@@ -853,6 +861,9 @@ class MethodTM:
                 npoints = 200
             tm = method(s_start=s_start, npoints=npoints)
             tm.mag_field = element.mag_field
+            field_map = getattr(element, "field_map", None)
+            if tm.mag_field is None and field_map is not None and len(field_map.z_arr) != 0:
+                tm.mag_field = CompiledField.from_field_map(field_map)
 
         if element.__class__ == Cavity:
             tm = CavityTM(v=element.v, freq=element.freq, phi=element.phi)
@@ -1188,6 +1199,12 @@ class Navigator:
         self.z0 = 0.  # current position of navigator
         self.n_elem = 0  # current index of the element in lattice
         self.sum_lengths = 0.  # sum_lengths = Sum[lat.sequence[i].l, {i, 0, n_elem-1}]
+        for p in self.process_table.proc_list:
+            adaptive = getattr(p, "adaptive_step", None)
+            if adaptive is not None and adaptive.step0 is not None:
+                p.step = adaptive.step0
+                p.counter = p.step
+                adaptive.reset()
 
     def get_phys_procs(self):
         """
@@ -1257,6 +1274,72 @@ class Navigator:
 
         return dz, processes, phys_steps
 
+    def transfer_R(self, dz, energy):
+        """
+        First order transfer matrix from the current position of the navigator to z0 + dz.
+        The navigator is not moved.
+
+        :param dz: distance
+        :param energy: beam energy
+        :return: R matrix
+        """
+        return next(self.transfer_R_steps(dz, energy))
+
+    def transfer_R_steps(self, dz, energy):
+        """
+        First order transfer matrices from the current position of the navigator to z0 + dz, z0 + 2*dz, ...
+        Every matrix is the previous one multiplied by the transfer matrix of one more step,
+        so the first k matrices cost about the same as one transfer_R(k*dz). The navigator is not moved.
+
+        :param dz: step
+        :param energy: beam energy
+        :return: generator of R matrices, after the end of the lattice the last matrix is repeated
+        """
+        seq = self.lat.sequence
+        i = self.n_elem
+        z0 = self.z0
+        elem = seq[i]
+        L = self.sum_lengths + elem.l
+        R = np.eye(6)
+        k = 0
+        end = False
+        while True:
+            k += 1
+            z1 = self.z0 + k * dz
+            while not end and z1 + 1e-10 > L:
+                R = np.dot(elem.transfer_map.R_z(L - z0, energy), R)
+                z0 = L
+                if i >= len(seq) - 1:
+                    end = True
+                    break
+                i += 1
+                elem = seq[i]
+                L += elem.l
+            if not end and abs(z1 - z0) > 1e-10:
+                R = np.dot(elem.transfer_map.R_z(z1 - z0, energy), R)
+                z0 = z1
+            yield R
+
+    def update_steps(self, processes, phys_steps, p_array):
+        """
+        Method changes steps of the applied physics processes which have adaptive_step, see AdaptiveStep
+
+        :param processes: list of the applied physics processes
+        :param phys_steps: their steps in [m]
+        :param p_array: ParticleArray
+        :return:
+        """
+        for p, z_step in zip(processes, phys_steps):
+            adaptive = getattr(p, "adaptive_step", None)
+            if adaptive is None or p in self.process_table.kick_proc_list:
+                continue
+            transfer = self.transfer_R_steps(self.unit_step, p_array.E)
+            step = adaptive.next_step(p_array, p.step, z_step / self.unit_step, transfer=transfer)
+            if step != p.step:
+                _logger_navi.debug(" update_steps: " + p.__class__.__name__ + " step: " + str(p.step) + " -> " + str(step))
+                p.counter = max(1, p.counter + step - p.step)
+                p.step = step
+
     def get_proc_list(self):
         _logger_navi.debug(" get_proc_list: all phys proc = " + str([p.__class__.__name__ for p in self.process_table.proc_list]))
         proc_list = []
@@ -1336,7 +1419,16 @@ class Navigator:
         return dz, processes, phys_steps
 
 
-def get_map(lattice, dz, navi):
+def get_map(lattice, dz, navi, elems=None):
+    """
+    Function returns list of transfer maps for the step dz from the current position of the navigator
+
+    :param lattice: MagneticLattice
+    :param dz: step in [m]
+    :param navi: Navigator, its position is moved by dz
+    :param elems: None or list, if list the elements of the transfer maps are appended to it
+    :return: list of TransferMaps
+    """
     nelems = len(lattice.sequence)
     TM = []
     i = navi.n_elem
@@ -1348,6 +1440,8 @@ def get_map(lattice, dz, navi):
 
         dl = L - navi.z0
         TM.append(elem.transfer_map(dl))
+        if elems is not None:
+            elems.append(elem)
 
         navi.z0 = L
         dz -= dl
@@ -1361,6 +1455,8 @@ def get_map(lattice, dz, navi):
         #    break
     if abs(dz) > 1e-10:
         TM.append(elem.transfer_map(dz))
+        if elems is not None:
+            elems.append(elem)
     navi.z0 += dz
     navi.sum_lengths = L - elem.l
     navi.n_elem = i
@@ -1,7 +1,7 @@
-from ocelot.cpbd.io import save_particle_array
+from ocelot.cpbd.io import save_particle_array, BeamWriter
 from ocelot.common.globals import *
 import numpy as np
-from ocelot.cpbd.beam import Twiss
+from ocelot.cpbd.beam import Twiss, smooth_sorted
 from scipy import optimize
 from ocelot.utils.acc_utils import *
 from ocelot.common.ocelog import *
@@ -20,7 +20,17 @@ class PhysProc:
     :attribute s_start: - position of start element in lattice - assigned in navigator.add_physics_proc()
     :attribute s_stop: - position of stop element in lattice.sequence - assigned in navigator.add_physics_proc()
     :attribute z0: - current position of navigator - assigned in track.track() before p.apply()
+    :attribute adaptive_step: - None or AdaptiveStep, if assigned self.step is changed during tracking
+    :attribute n_chunk_passes: - None or number of the reduction passes over the chunks of the beam
+                                in the out-of-core tracking, see track_chunked(). None - the process does not
+                                support the chunked tracking.
+    :attribute changes_tau: - True, False if the process changes only the momenta (kicks) and not tau or
+                                the charges, then the beam profile is kept for the next processes of the step
+                                (see ParticleArray.modified())
     """
+    n_chunk_passes = None
+    changes_tau = True
+
     def __init__(self, step=1):
         self.step = step
         self.energy = None
@@ -29,6 +39,7 @@ class PhysProc:
         self.s_start = None
         self.s_stop = None
         self.z0 = None
+        self.adaptive_step = None
 
     def prepare(self, lat):
         """
@@ -57,6 +68,122 @@ class PhysProc:
         """
         pass
 
+    def chunk_start(self, dz):
+        """
+        Out-of-core tracking, see track_chunked(). The method is called before the reduction passes
+        over the chunks of the beam instead of apply().
+
+        :param dz: step in [m]
+        :return:
+        """
+        pass
+
+    def chunk_reduce(self, p_array, npass):
+        """
+        Reduction pass over the chunks: the method is called for every chunk of the beam,
+        e.g. to accumulate the moments or to deposit the charges on the grid.
+
+        :param p_array: ParticleArray, chunk of the beam
+        :param npass: number of the pass, 0 ... n_chunk_passes - 1
+        :return:
+        """
+        pass
+
+    def chunk_reduce_end(self, npass, dz):
+        """
+        The method is called after every reduction pass, e.g. to calculate the fields after the last one.
+
+        :param npass: number of the pass
+        :param dz: step in [m]
+        :return:
+        """
+        pass
+
+    def chunk_kick(self, p_array, dz):
+        """
+        Kick pass: the method is called for every chunk of the beam to apply the fields calculated
+        in the reduction passes.
+
+        :param p_array: ParticleArray, chunk of the beam
+        :param dz: step in [m]
+        :return:
+        """
+        pass
+
+
+class AdaptiveStep:
+    """
+    Adaptive step of the physics process: physics_proc.adaptive_step = AdaptiveStep(...)
+
+    After every application of the process the relative change of the monitored beam quantity over the last step
+    is estimated and the step of the process is changed so that the quantity changes by about rel_change per step.
+    The step can grow not more than twice at once and stays within [step_min, step_max].
+    For "sigma_tau" and "sigma_xy" the step is also limited by the change of the quantity over the next step
+    predicted by the first order transfer matrices of the lattice, so the step is reduced before e.g. a chicane
+    and not only after it.
+    Navigator shortens the steps at the element boundaries and kick processes as for the fixed step.
+    The initial step is physics_proc.step.
+
+    :param step_min: 1, minimal step in [Navigator.unit_step]
+    :param step_max: 10, maximal step in [Navigator.unit_step]
+    :param rel_change: 0.01, relative change of the quantity per step
+    :param quantity: "sigma_tau" - bunch length (CSR, LSC, Wake), "sigma_xy" - transverse beam size (SpaceCharge)
+                    or function f(p_array) which returns the quantity
+    """
+    def __init__(self, step_min=1, step_max=10, rel_change=0.01, quantity="sigma_tau"):
+        self.step_min = step_min
+        self.step_max = step_max
+        self.rel_change = rel_change
+        self.quantity = quantity
+        self.value = None
+        self.step0 = None
+
+    def measure(self, p_array):
+        if self.quantity in ["sigma_tau", "sigma_xy"]:
+            # the same charge-weighted sigma matrix as in the prediction of next_step()
+            return self.cov2quantity(p_array.stats.sigma_matrix())
+        return self.quantity(p_array)
+
+    def cov2quantity(self, S):
+        if self.quantity == "sigma_tau":
+            return np.sqrt(S[4, 4])
+        return (S[0, 0] * S[2, 2]) ** 0.25
+
+    def next_step(self, p_array, step, dz, transfer=None):
+        """
+        :param p_array: ParticleArray after application of the process
+        :param step: current step of the process in [Navigator.unit_step]
+        :param dz: length of the last step in [Navigator.unit_step]
+        :param transfer: None or iterable of the first order transfer matrices over the next 1, 2, ... steps,
+                        see Navigator.transfer_R_steps()
+        :return: new step
+        """
+        if self.step0 is None:
+            self.step0 = step
+        value = self.measure(p_array)
+        value0 = self.value
+        self.value = value
+        if value0 is None or value0 == 0 or dz <= 0:
+            new_step = step
+        else:
+            rate = np.abs(value - value0) / np.abs(value0) / dz
+            new_step = self.rel_change / rate if rate > 0 else self.step_max
+            new_step = min(new_step, 2 * step)
+        new_step = int(max(self.step_min, min(self.step_max, np.floor(new_step))))
+
+        if transfer is not None and self.quantity in ["sigma_tau", "sigma_xy"]:
+            # cached charge-weighted sigma matrix, shared with the other users of p_array.stats
+            S = p_array.stats.sigma_matrix()
+            v0 = self.cov2quantity(S)
+            for k, R in zip(range(1, new_step + 1), transfer):
+                if np.abs(self.cov2quantity(np.dot(np.dot(R, S), R.T)) - v0) > self.rel_change * v0:
+                    new_step = max(self.step_min, k - 1)
+                    break
+        return new_step
+
+    def reset(self):
+        self.value = None
+
 
 class EmptyProc(PhysProc):
     def __init__(self, step=1):
@@ -67,14 +194,38 @@ class EmptyProc(PhysProc):
 
 
 class SaveBeam(PhysProc):
-    def __init__(self, filename):
+    """
+    Physics Process to save the beam file, see save_particle_array()
+
+    :param filename: path to file
+    :param background: False, if True the file is written in the background thread (see BeamWriter)
+                       while tracking goes on. All files are written at the latest in finalize() at the end of tracking.
+    """
+    def __init__(self, filename, background=False):
         PhysProc.__init__(self)
         self.energy = None
         self.filename = filename
+        self.background = background
+        self.writer = None
+
+    def __getstate__(self):
+        # the writer holds the thread lock and the thread pool which can not be copied or pickled
+        state = self.__dict__.copy()
+        state["writer"] = None
+        return state
 
     def apply(self, p_array, dz):
         _logger.debug(" SaveBeam applied, dz =" + str(dz))
-        save_particle_array(filename=self.filename, p_array=p_array)
+        if self.background:
+            if self.writer is None:
+                self.writer = BeamWriter()
+            self.writer.save(self.filename, p_array)
+        else:
+            save_particle_array(filename=self.filename, p_array=p_array)
+
+    def finalize(self, *args, **kwargs):
+        if self.writer is not None:
+            self.writer.flush()
 
 
 class SmoothBeam(PhysProc):
@@ -109,32 +260,9 @@ class SmoothBeam(PhysProc):
         """
 
         _logger.debug(" SmoothBeam applied, dz =" + str(dz))
-        def myfunc(x, A):
-            if x < 2 * A:
-                y = x - x * x / (4 * A)
-            else:
-                y = A
-            return y
-
-        #Zin = np.copy(p_array.tau())
         Zin = p_array.tau()
-        inds = np.argsort(Zin, axis=0)
-        Zout = np.copy(Zin[inds])
-        N = Zin.shape[0]
-        S = np.zeros(N + 1)
-        S[N] = 0
-        S[0] = 0
-        for i in range(N):
-            S[i + 1] = S[i] + Zout[i]
-        Zout2 = np.zeros(N)
-        Zout2[N - 1] = Zout[N - 1]
-        Zout2[0] = Zout[0]
-        for i in range(1, N - 1):
-            m = min(i, N - i + 1)
-            m = np.int(np.floor(myfunc(0.5 * m, 0.5 * self.mslice) + 0.500001))
-            Zout2[i] = (S[i + m + 1] - S[i - m]) / (2 * m + 1)
-        #Zout[inds] = Zout2
-        p_array.tau()[inds] = Zout2
+        inds = p_array.profile.argsort()
+        p_array.tau()[inds] = smooth_sorted(Zin[inds], self.mslice)
 
 
 class LaserModulator(PhysProc):
@@ -280,6 +408,157 @@ class Aperture(PhysProc):
             p_array.q_array = np.delete(p_array.q_array, inds, 0)
 
 
+
+class Resample(PhysProc):
+    """
+    Physics Process to control the number of macro-particles. The beam is divided into cells of the 6D grid,
+    the grid step is given in units of the rms beam size in each coordinate.
+
+    Merging: particles of the dense cells (number of particles > n_merge) are replaced by 12 particles
+        mu +- sqrt(6)*L_i, i = 1..6, with charge Q/12, where mu, Q are charge-weighted mean and charge of the cell
+        and L*L^T is its second moments matrix. Charge, mean and second moments of each cell are conserved.
+    Splitting: every particle of the sparse cells (number of particles < n_split) in the region of interest is
+        split into split_factor particles at +-delta with charge q/split_factor. Delta is gaussian with rms
+        split_spread*cell. Charge and mean are conserved, rms sizes grow in order of split_spread*cell/sqrt(nparticles_in_cell).
+
+    :attribute cell: 0.5, size of the cell in units of rms beam size, scalar or 6 values
+    :attribute n_merge: 48, the cells with more particles are merged, None - no merging
+    :attribute n_split: 0, particles of the cells with less particles are split, 0 - no splitting
+    :attribute split_factor: 2, number of particles which a particle is split into, must be even
+    :attribute split_spread: 0.1, rms offset of the split particles in units of cell
+    :attribute roi: None or function roi(p_array) -> bool array of particles which can be split, None - all particles
+    :attribute seed: None or int, seed of the random offsets of the split particles
+
+    Examples
+    --------
+    # keep the number of particles under control after the bunch compressor
+    resample = Resample()
+    resample.n_merge = 48
+    resample.n_split = 4
+    resample.roi = lambda p_array: np.abs(p_array.tau() - np.mean(p_array.tau())) < 10e-6
+
+    navi.add_physics_proc(resample, elem, elem)
+    """
+    def __init__(self, step=1):
+        PhysProc.__init__(self, step)
+        self.cell = 0.5
+        self.n_merge = 48
+        self.n_split = 0
+        self.split_factor = 2
+        self.split_spread = 0.1
+        self.roi = None
+        self.seed = None
+
+    def cells(self, X):
+        """
+        Indices of the 6D grid cells
+
+        :param X: array 6 x n
+        :return: cell_size (array 6 - size of the cell in each coordinate, 0 if the coordinate has no spread),
+                 key (array n)
+        """
+        cell_size = np.std(X, axis=1) * np.ones(6) * self.cell
+        step = np.where(cell_size > 0, cell_size, 1.)
+        ind = np.floor((X - np.mean(X, axis=1)[:, None]) / step[:, None]).astype(np.int64)
+        ind -= np.min(ind, axis=1)[:, None]
+        dims = np.max(ind, axis=1) + 1
+        if np.sum(np.log2(dims)) < 62:
+            key = np.ravel_multi_index(ind, dims)
+        else:
+            key = np.unique(ind, axis=1, return_inverse=True)[1].ravel()
+        return cell_size, key
+
+    @staticmethod
+    def merge(X, q, starts):
+        """
+        Replacement of the groups of particles by 12 particles with the same charge, mean and second moments.
+        Moments of the groups with zero total charge (e.g. ParticleArray without charges) are weighted
+        with the number of particles.
+
+        :param X: array 6 x n, particles sorted by groups
+        :param q: array n, charges
+        :param starts: array of the indices where groups start
+        :return: X_new (array 6 x 12*ngroups), q_new
+        """
+        counts = np.diff(np.append(starts, len(q)))
+        Q = np.add.reduceat(q, starts)
+        no_charge = Q == 0
+        weights = np.where(np.repeat(no_charge, counts), 1., q)
+        W = np.where(no_charge, counts, Q)
+        mu = np.add.reduceat(X * weights, starts, axis=1) / W
+        D = X - np.repeat(mu, counts, axis=1)
+        cov = np.zeros((len(starts), 6, 6))
+        for i in range(6):
+            for j in range(i, 6):
+                cov[:, i, j] = cov[:, j, i] = np.add.reduceat(weights * D[i] * D[j], starts) / W
+        w, V = np.linalg.eigh(cov)
+        L = V * np.sqrt(6. * np.maximum(w, 0.))[:, None, :]
+        # columns of L with both signs around the mean of the group
+        X_new = mu.T[:, :, None] + np.concatenate((L, -L), axis=2)
+        X_new = X_new.transpose(1, 0, 2).reshape(6, -1)
+        q_new = np.repeat(Q / 12., 12)
+        return X_new, q_new
+
+    def split(self, X, q, cell_size):
+        """
+        Splitting of the particles into split_factor particles with the same charge and mean
+
+        :param X: array 6 x n
+        :param q: array n, charges
+        :param cell_size: array 6
+        :return: X_new (array 6 x split_factor*n), q_new
+        """
+        npairs = self.split_factor // 2
+        rng = np.random.default_rng(self.seed)
+        delta = rng.standard_normal((npairs, 6, X.shape[1])) * (self.split_spread * cell_size)[None, :, None]
+        X_new = np.concatenate([X + d for d in delta] + [X - d for d in delta], axis=1)
+        q_new = np.tile(q / (2 * npairs), 2 * npairs)
+        return X_new, q_new
+
+    def apply(self, p_array, dz):
+        _logger.debug(" Resample applied")
+        if self.split_factor % 2 != 0:
+            raise ValueError("Resample: split_factor must be even")
+        n0 = p_array.n
+        X = p_array.rparticles.astype(np.float64)
+        q = p_array.q_array
+        cell_size, key = self.cells(X)
+
+        order = np.argsort(key, kind="stable")
+        key_sorted = key[order]
+        starts = np.flatnonzero(np.append(True, key_sorted[1:] != key_sorted[:-1]))
+        counts = np.diff(np.append(starts, len(key)))
+        n_in_cell = np.empty(len(key), dtype=np.int64)
+        n_in_cell[order] = np.repeat(counts, counts)
+
+        keep = np.ones(len(key), dtype=bool)
+        X_add, q_add = [], []
+        if self.n_merge is not None:
+            dense = counts > max(self.n_merge, 12)
+            if np.any(dense):
+                inds = order[np.repeat(dense, counts)]
+                keep[inds] = False
+                X_m, q_m = self.merge(X[:, inds], q[inds], np.append(0, np.cumsum(counts[dense])[:-1]))
+                X_add.append(X_m)
+                q_add.append(q_m)
+
+        if self.n_split > 0:
+            sparse = n_in_cell < self.n_split
+            if self.roi is not None:
+                sparse &= np.asarray(self.roi(p_array), dtype=bool)
+            if np.any(sparse):
+                keep[sparse] = False
+                X_s, q_s = self.split(X[:, sparse], q[sparse], cell_size)
+                X_add.append(X_s)
+                q_add.append(q_s)
+
+        if len(X_add) == 0:
+            return
+        p_array.rparticles = np.hstack([p_array.rparticles[:, keep]] + X_add).astype(p_array.rparticles.dtype)
+        p_array.q_array = np.concatenate([q[keep]] + q_add)
+        _logger.info(" Resample: number of particles " + str(n0) + " -> " + str(p_array.n))
+
+
 class BeamTransform(PhysProc):
     """
     Beam matching
@@ -648,14 +927,14 @@ class SPDKick(PhysProc):
         :return: (wake, current) - wake[:, 0] - s in [m],  wake[:, 1] - kick in [V]
                                 - current[:, 0] - s in [m], current[:, 1] - current in [A]
         """
-        I = s_to_cur(p_array.tau(), sigma=0.03 * np.std(p_array.tau()), q0=np.sum(p_array.q_array), v=speed_of_light)
+        I = p_array.profile.current(sigma=0.03 * p_array.profile.mean_std()[1], v=speed_of_light)
         s_shift = I[0, 0]
         dipole_kick = self.convolve_beam(current=I, wake=self.dipole_wake)
         quad_kick = self.convolve_beam(current=I, wake=self.quad_wake)
         long_kick = self.convolve_beam(current=I, wake=self.long_wake)
 
         z = p_array.tau()
-        ind_z_sort = np.argsort(z)
+        ind_z_sort = p_array.profile.argsort()
         z_sort = z[ind_z_sort]
         wd = np.interp(z_sort - s_shift, dipole_kick[:, 0], dipole_kick[:, 1])
         wq = np.interp(z_sort - s_shift, quad_kick[:, 0], quad_kick[:, 1])
@@ -14,8 +14,9 @@ import multiprocessing
 from scipy.special import exp1, k1
 from ocelot.cpbd.physics_proc import PhysProc
 from ocelot.common.math_op import conj_sym
-from ocelot.cpbd.beam import s_to_cur
+from ocelot.cpbd.beam import s_to_cur, smooth_sorted, s_to_cur_grid, s_to_cur_deposit, s_to_cur_finish, BeamMoments
 import logging
+from collections import OrderedDict
 
 try:
     from scipy.special import factorial
@@ -26,14 +27,14 @@ logger = logging.getLogger(__name__)
 
 try:
     pyfftw_flag = True
-    from pyfftw.interfaces.numpy_fft import fftn
-    from pyfftw.interfaces.numpy_fft import ifftn
+    from pyfftw.interfaces.numpy_fft import rfftn
+    from pyfftw.interfaces.numpy_fft import irfftn
     import pyfftw
 except:
     pyfftw_flag = False
     logger.debug("cs.py: module PYFFTW is not installed. Install it to speed up calculation")
-    from numpy.fft import ifftn
-    from numpy.fft import fftn
+    from numpy.fft import irfftn
+    from numpy.fft import rfftn
 
 try:
     import numexpr as ne
@@ -42,34 +43,206 @@ except:
     logger.debug("sc.py: module NUMEXPR is not installed. Install it to speed up calculation")
     ne_flag = False
 
-def smooth_z(Zin, mslice):
-
-    def myfunc(x, A):
-        if x < 2*A:
-            y = x - x*x/(4*A)
-        else:
-            y = A
-        return y
+try:
+    import numba as nb
+    from numba import prange
+    nb_flag = True
+except:
+    logger.debug("sc.py: module NUMBA is not installed. Install it to speed up calculation")
+    prange = range
+    nb_flag = False
 
+def smooth_z(Zin, mslice):
     inds = np.argsort(Zin, axis=0)
-    Zout = np.sort(Zin, axis=0)
-    N = Zin.shape[0]
-    S = np.zeros(N+1)
-    S[N] = 0
-    S[0] = 0
-    for i in range(N):
-        S[i+1] = S[i] + Zout[i]
-    Zout2 = np.zeros(N)
-    Zout2[N-1] = Zout[N-1]
-    Zout2[0] = Zout[0]
-    for i in range(1, N-1):
-        m = min(i, N-i+1)
-        m = np.floor(myfunc(0.5*m, 0.5*mslice) + 0.500001).astype(int)
-        Zout2[i] = (S[i+m+1] - S[i-m])/(2*m + 1)
-    Zout[inds] = Zout2
+    Zout = np.empty_like(Zin)
+    Zout[inds] = smooth_sorted(Zin[inds], mslice)
     return Zout
 
 
+def cic_deposit_np(X, Q, nxyz):
+    """
+    Cloud-in-cell deposition of the charges on the 3D mesh.
+    Node (i, j, k) is placed at X = (i - 0.5, j - 0.5, k - 0.5), the same as for the nearest-grid-point deposition.
+
+    :param X: (N, 3) - coordinates of the particles in units of the mesh steps
+    :param Q: (N,) - charges
+    :param nxyz: mesh size [nx, ny, nz]
+    :return: charge on the mesh
+    """
+    nx, ny, nz = nxyz
+    U = X + 0.5
+    I = np.int_(np.floor(U))
+    F = U - I
+    G = 1. - F
+    inds = []
+    weights = []
+    for di in (0, 1):
+        wx = F[:, 0] if di else G[:, 0]
+        for dj in (0, 1):
+            wy = F[:, 1] if dj else G[:, 1]
+            for dk in (0, 1):
+                wz = F[:, 2] if dk else G[:, 2]
+                inds.append((I[:, 0] + di) * ny * nz + (I[:, 1] + dj) * nz + I[:, 2] + dk)
+                weights.append(Q * wx * wy * wz)
+    q = np.bincount(np.concatenate(inds), np.concatenate(weights), nx * ny * nz)
+    return q.reshape(nxyz)
+
+
+def cic_deposit_py(X, Q, nxyz):
+    nx, ny, nz = nxyz[0], nxyz[1], nxyz[2]
+    N = X.shape[0]
+    nthread = nb.get_num_threads()
+    chunk = (N + nthread - 1) // nthread
+    grids = np.zeros((nthread, nx, ny, nz))
+    for t in prange(nthread):
+        for n in range(t * chunk, min(N, (t + 1) * chunk)):
+            ux = X[n, 0] + 0.5
+            uy = X[n, 1] + 0.5
+            uz = X[n, 2] + 0.5
+            i = int(np.floor(ux))
+            j = int(np.floor(uy))
+            k = int(np.floor(uz))
+            fx = ux - i
+            fy = uy - j
+            fz = uz - k
+            for di in range(2):
+                wx = fx if di else 1. - fx
+                for dj in range(2):
+                    wy = fy if dj else 1. - fy
+                    for dk in range(2):
+                        wz = fz if dk else 1. - fz
+                        grids[t, i + di, j + dj, k + dk] += Q[n] * wx * wy * wz
+    q = np.zeros((nx, ny, nz))
+    for i in prange(nx):
+        for t in range(nthread):
+            q[i] += grids[t, i]
+    return q
+
+
+def tsc_deposit_np(X, Q, nxyz):
+    """
+    Triangular-shaped-cloud deposition of the charges on the 3D mesh. The mesh layout is the same as for cic_deposit.
+
+    :param X: (N, 3) - coordinates of the particles in units of the mesh steps
+    :param Q: (N,) - charges
+    :param nxyz: mesh size [nx, ny, nz]
+    :return: charge on the mesh
+    """
+    nx, ny, nz = nxyz
+    U = X + 0.5
+    I = np.int_(np.floor(U + 0.5))
+    D = U - I
+    W = [0.5 * (0.5 - D) ** 2, 0.75 - D * D, 0.5 * (0.5 + D) ** 2]
+    inds = []
+    weights = []
+    for di in (-1, 0, 1):
+        ix = np.minimum(np.maximum(I[:, 0] + di, 0), nx - 1)
+        for dj in (-1, 0, 1):
+            iy = np.minimum(np.maximum(I[:, 1] + dj, 0), ny - 1)
+            for dk in (-1, 0, 1):
+                iz = np.minimum(np.maximum(I[:, 2] + dk, 0), nz - 1)
+                inds.append(ix * ny * nz + iy * nz + iz)
+                weights.append(Q * W[di + 1][:, 0] * W[dj + 1][:, 1] * W[dk + 1][:, 2])
+    q = np.bincount(np.concatenate(inds), np.concatenate(weights), nx * ny * nz)
+    return q.reshape(nxyz)
+
+
+def tsc_deposit_py(X, Q, nxyz):
+    nx, ny, nz = nxyz[0], nxyz[1], nxyz[2]
+    N = X.shape[0]
+    nthread = nb.get_num_threads()
+    chunk = (N + nthread - 1) // nthread
+    grids = np.zeros((nthread, nx, ny, nz))
+    for t in prange(nthread):
+        wx = np.zeros(3)
+        wy = np.zeros(3)
+        wz = np.zeros(3)
+        for n in range(t * chunk, min(N, (t + 1) * chunk)):
+            ux = X[n, 0] + 0.5
+            uy = X[n, 1] + 0.5
+            uz = X[n, 2] + 0.5
+            i = int(np.floor(ux + 0.5))
+            j = int(np.floor(uy + 0.5))
+            k = int(np.floor(uz + 0.5))
+            dx = ux - i
+            dy = uy - j
+            dz = uz - k
+            wx[0], wx[1], wx[2] = 0.5 * (0.5 - dx) ** 2, 0.75 - dx * dx, 0.5 * (0.5 + dx) ** 2
+            wy[0], wy[1], wy[2] = 0.5 * (0.5 - dy) ** 2, 0.75 - dy * dy, 0.5 * (0.5 + dy) ** 2
+            wz[0], wz[1], wz[2] = 0.5 * (0.5 - dz) ** 2, 0.75 - dz * dz, 0.5 * (0.5 + dz) ** 2
+            for di in range(3):
+                ii = min(max(i + di - 1, 0), nx - 1)
+                for dj in range(3):
+                    jj = min(max(j + dj - 1, 0), ny - 1)
+                    for dk in range(3):
+                        kk = min(max(k + dk - 1, 0), nz - 1)
+                        grids[t, ii, jj, kk] += Q[n] * wx[di] * wy[dj] * wz[dk]
+    q = np.zeros((nx, ny, nz))
+    for i in prange(nx):
+        for t in range(nthread):
+            q[i] += grids[t, i]
+    return q
+
+
+def field_gather_np(X, Ex, Ey, Ez):
+    """
+    Trilinear interpolation of the staggered field components Ex, Ey, Ez to the particle positions
+
+    :param X: (N, 3) - coordinates of the particles in units of the mesh steps
+    :param Ex: Ex on the mesh, Ex[i, j, k] is placed at X = (i, j - 0.5, k - 0.5)
+    :param Ey: Ey on the mesh, Ey[i, j, k] is placed at X = (i - 0.5, j, k - 0.5)
+    :param Ez: Ez on the mesh, Ez[i, j, k] is placed at X = (i - 0.5, j - 0.5, k)
+    :return: (N, 3) - Ex, Ey, Ez at the particle positions
+    """
+    Exyz = np.zeros((X.shape[0], 3))
+    Exyz[:, 0] = ndimage.map_coordinates(Ex, np.c_[X[:, 0], X[:, 1] + 0.5, X[:, 2] + 0.5].T, order=1)
+    Exyz[:, 1] = ndimage.map_coordinates(Ey, np.c_[X[:, 0] + 0.5, X[:, 1], X[:, 2] + 0.5].T, order=1)
+    Exyz[:, 2] = ndimage.map_coordinates(Ez, np.c_[X[:, 0] + 0.5, X[:, 1] + 0.5, X[:, 2]].T, order=1)
+    return Exyz
+
+
+def trilinear_py(F, x, y, z):
+    nx, ny, nz = F.shape
+    # the same as ndimage.map_coordinates(order=1, mode="constant", cval=0)
+    if x < 0. or y < 0. or z < 0. or x > nx - 1 or y > ny - 1 or z > nz - 1:
+        return 0.
+    i = min(int(x), nx - 2)
+    j = min(int(y), ny - 2)
+    k = min(int(z), nz - 2)
+    fx = x - i
+    fy = y - j
+    fz = z - k
+    return ((1. - fx) * ((1. - fy) * ((1. - fz) * F[i, j, k] + fz * F[i, j, k + 1]) +
+                         fy * ((1. - fz) * F[i, j + 1, k] + fz * F[i, j + 1, k + 1])) +
+            fx * ((1. - fy) * ((1. - fz) * F[i + 1, j, k] + fz * F[i + 1, j, k + 1]) +
+                  fy * ((1. - fz) * F[i + 1, j + 1, k] + fz * F[i + 1, j + 1, k + 1])))
+
+
+def field_gather_py(X, Ex, Ey, Ez):
+    N = X.shape[0]
+    Exyz = np.zeros((N, 3))
+    for n in prange(N):
+        x = X[n, 0]
+        y = X[n, 1]
+        z = X[n, 2]
+        Exyz[n, 0] = trilinear(Ex, x, y + 0.5, z + 0.5)
+        Exyz[n, 1] = trilinear(Ey, x + 0.5, y, z + 0.5)
+        Exyz[n, 2] = trilinear(Ez, x + 0.5, y + 0.5, z)
+    return Exyz
+
+
+if nb_flag:
+    trilinear = nb.jit(nopython=True)(trilinear_py)
+    cic_deposit = nb.jit(nopython=True, parallel=True)(cic_deposit_py)
+    tsc_deposit = nb.jit(nopython=True, parallel=True)(tsc_deposit_py)
+    field_gather = nb.jit(nopython=True, parallel=True)(field_gather_py)
+else:
+    trilinear = trilinear_py
+    cic_deposit = cic_deposit_np
+    tsc_deposit = tsc_deposit_np
+    field_gather = field_gather_np
+
+
 class SpaceCharge(PhysProc):
     """
     Space Charge physics process
@@ -77,6 +250,16 @@ class SpaceCharge(PhysProc):
     Attributes:
         self.step = 1 [in Navigator.unit_step] - step of the Space Charge kick applying
         self.nmesh_xyz = [63, 63, 63] - 3D mesh
+        self.kernel_tol = 0. - relative tolerance of the mesh aspect ratios (hy/hx, hz/hx) within which
+                                the FFT of the Green's function is reused, e.g. 1e-3. If 0, the kernel is reused only
+                                for identical aspect ratios.
+        self.kernel_cache_size = 16 - maximal number of the cached kernel FFTs
+        self.deposit = "ngp" - charge deposition on the mesh: "ngp" - nearest grid point, "cic" - cloud-in-cell,
+                               "tsc" - triangular-shaped cloud. "cic" and "tsc" are less noisy and allow
+                               to reduce the number of macro-particles.
+        self.solver = "3d" - Poisson solver: "3d" - 3D FFT solver, "2.5d" - slice-based solver, "auto" - the 2.5D
+                             solver is used if the bunch aspect ratio in the rest frame exceeds self.aspect_ratio
+        self.aspect_ratio = 20. - threshold of sigma_z/max(sigma_x, sigma_y) in the rest frame for solver="auto"
 
     Description:
         The space charge forces are calculated by solving the Poisson equation in the bunch frame.
@@ -85,7 +268,14 @@ class SpaceCharge(PhysProc):
     by convolution of the free-space Green's function with the charge distribution.
     The convolution equation is solved with the help of the Fast Fourier Transform (FFT). The same algorithm for
     solution of the 3D Poisson equation is used, for example, in ASTRA
+
+    For bunches which are long in the rest frame (gamma*sigma_z >> sigma_x, sigma_y) the 2.5D solver can be used.
+    The transverse field is found by solving the 2D Poisson equation for every longitudinal slice of the mesh
+    (all slices are transformed in a single batched 2D FFT) and the longitudinal field is calculated
+    from the line charge density assuming a uniformly charged disk with the same RMS size as the bunch.
     """
+    n_chunk_passes = 3
+
     def __init__(self, step=1):
         PhysProc.__init__(self)
         self.step = step # in unit step
@@ -98,9 +288,18 @@ class SpaceCharge(PhysProc):
         self.random_mesh = False  # random mesh if True
         self.random_seed = 10     # random seeding number. if None seeding is random
 
+        self.kernel_tol = 0.        # relative tolerance of the mesh aspect ratios to reuse the kernel FFT
+        self.kernel_cache_size = 16
+        self.kernel_cache = OrderedDict()
+        self.fft_plans = {}
+        self.deposit = "ngp"        # charge deposition on the mesh: "ngp", "cic" or "tsc"
+        self.solver = "3d"          # Poisson solver: "3d", "2.5d" or "auto"
+        self.aspect_ratio = 20.     # rest frame aspect ratio to switch to the 2.5D solver if solver = "auto"
+
     def prepare(self, lat):
         if self.random_seed != None:
             np.random.seed(self.random_seed)
+        self.kernel_cache.clear()
 
     def sym_kernel(self, ijk2, hxyz):
         i2 = ijk2[0]
@@ -128,6 +327,86 @@ class SpaceCharge(PhysProc):
 
         return kern
 
+    def quantize_steps(self, steps):
+        """
+        Quantization of the mesh steps. The integrated Green's function is a homogeneous function of 2nd order,
+        kernel(a*h) = a**2 * kernel(h), so only the aspect ratios hy/hx and hz/hx are quantized
+        on a logarithmic grid with the relative resolution self.kernel_tol.
+
+        :param steps: [hx, hy, hz] or [hx, hy] - mesh steps
+        :return: (key, ref_steps) - the quantized aspect ratios and the mesh steps in units of hx which
+                 correspond to the key
+        """
+        ratios = np.array(steps[1:]) / steps[0]
+        if self.kernel_tol > 0:
+            log_base = np.log1p(self.kernel_tol)
+            key = tuple(np.round(np.log(ratios) / log_base).astype(int))
+            ratios = np.exp(np.array(key) * log_base)
+        else:
+            key = tuple(ratios)
+        ref_steps = np.r_[1., ratios]
+        return key, ref_steps
+
+    def get_fft_plans(self, shape, axes=None):
+        """
+        Persistent pyfftw plans for the real-to-complex and complex-to-real transforms on the padded mesh
+
+        :param shape: shape of the padded mesh
+        :param axes: axes over which the FFT is computed. If None, all axes are used.
+        :return: (rfftn, irfftn) - pyfftw.FFTW objects
+        """
+        key = (shape, axes)
+        if key not in self.fft_plans:
+            nthread = multiprocessing.cpu_count()
+            s = shape if axes is None else tuple(shape[i] for i in axes)
+            a = pyfftw.empty_aligned(shape, dtype='float64')
+            fft = pyfftw.builders.rfftn(a, axes=axes, planner_effort='FFTW_MEASURE', threads=nthread)
+            b = pyfftw.empty_aligned(fft.output_shape, dtype='complex128')
+            ifft = pyfftw.builders.irfftn(b, s=s, axes=axes, planner_effort='FFTW_MEASURE', threads=nthread)
+            self.fft_plans[key] = (fft, ifft)
+        return self.fft_plans[key]
+
+    def rfft(self, a, axes=None):
+        if pyfftw_flag:
+            fft, _ = self.get_fft_plans(a.shape, axes)
+            return fft(a).copy()
+        return rfftn(a, axes=axes)
+
+    def irfft(self, a, shape, axes=None):
+        if pyfftw_flag:
+            _, ifft = self.get_fft_plans(shape, axes)
+            return ifft(a)
+        s = shape if axes is None else tuple(shape[i] for i in axes)
+        return irfftn(a, s=s, axes=axes)
+
+    def kernel_fft(self, nxyz, steps):
+        """
+        FFT of the mirrored integrated Green's function on the padded mesh.
+        The result is cached and keyed by the mesh size and the quantized aspect ratios of the mesh steps.
+
+        :param nxyz: (Nx, Ny, Nz) - mesh size
+        :param steps: [hx, hy, hz] - mesh steps
+        :return: rfftn of the kernel
+        """
+        Nx, Ny, Nz = nxyz
+        key, ref_steps = self.quantize_steps(steps)
+        key = (Nx, Ny, Nz) + key
+        if key in self.kernel_cache:
+            self.kernel_cache.move_to_end(key)
+            K2_fft = self.kernel_cache[key]
+        else:
+            K1 = self.sym_kernel(nxyz, ref_steps)
+            K2 = np.zeros((2*Nx-1, 2*Ny-1, 2*Nz-1))
+            K2[0:Nx, 0:Ny, 0:Nz] = K1
+            K2[0:Nx, 0:Ny, Nz:2*Nz-1] = K2[0:Nx, 0:Ny, Nz-1:0:-1] #z-mirror
+            K2[0:Nx, Ny:2*Ny-1,:] = K2[0:Nx, Ny-1:0:-1, :]        #y-mirror
+            K2[Nx:2*Nx-1, :, :] = K2[Nx-1:0:-1, :, :]             #x-mirror
+            K2_fft = self.rfft(K2)
+            self.kernel_cache[key] = K2_fft
+            while len(self.kernel_cache) > self.kernel_cache_size:
+                self.kernel_cache.popitem(last=False)
+        return K2_fft * (steps[0]**2)
+
     def potential(self, q, steps):
         hx = steps[0]
         hy = steps[1]
@@ -135,105 +414,246 @@ class SpaceCharge(PhysProc):
         Nx = q.shape[0]
         Ny = q.shape[1]
         Nz = q.shape[2]
-        out = np.zeros((2*Nx-1, 2*Ny-1, 2*Nz-1))
+        shape = (2*Nx-1, 2*Ny-1, 2*Nz-1)
+        out = np.zeros(shape)
         out[:Nx, :Ny, :Nz] = q
-        K1 = self.sym_kernel(q.shape, steps)
-        K2 = np.zeros((2*Nx-1, 2*Ny-1, 2*Nz-1))
-        K2[0:Nx, 0:Ny, 0:Nz] = K1
-        K2[0:Nx, 0:Ny, Nz:2*Nz-1] = K2[0:Nx, 0:Ny, Nz-1:0:-1] #z-mirror
-        K2[0:Nx, Ny:2*Ny-1,:] = K2[0:Nx, Ny-1:0:-1, :]        #y-mirror
-        K2[Nx:2*Nx-1, :, :] = K2[Nx-1:0:-1, :, :]             #x-mirror
         t0 = time.time()
-        if pyfftw_flag:
-            nthread = multiprocessing.cpu_count()
-            K2_fft = pyfftw.builders.fftn(K2, axes=None, overwrite_input=False, planner_effort='FFTW_ESTIMATE',
-                                       threads=nthread, auto_align_input=False, auto_contiguous=False, avoid_copy=True)
-            out_fft = pyfftw.builders.fftn(out, axes=None, overwrite_input=False, planner_effort='FFTW_ESTIMATE',
-                                          threads=nthread, auto_align_input=False, auto_contiguous=False, avoid_copy=True)
-            out_ifft = pyfftw.builders.ifftn(out_fft()*K2_fft(), axes=None, overwrite_input=False, planner_effort='FFTW_ESTIMATE',
-                                          threads=nthread, auto_align_input=False, auto_contiguous=False, avoid_copy=True)
-            out = np.real(out_ifft())
-        else:
-            out = np.real(ifftn(fftn(out)*fftn(K2)))
+        K2_fft = self.kernel_fft(q.shape, steps)
+        out = self.irfft(self.rfft(out)*K2_fft, shape)
         t1 = time.time()
         logger.debug('fft time:' + str(t1-t0) + ' sec')
-        out[:Nx, :Ny, :Nz] = out[:Nx,:Ny,:Nz]/(4*pi*epsilon_0*hx*hy*hz)
-        return out[:Nx, :Ny, :Nz]
+        return out[:Nx, :Ny, :Nz]/(4*pi*epsilon_0*hx*hy*hz)
 
-    def el_field(self, X, Q, gamma, nxyz):
-        N = X.shape[0]
-        X[:, 2] = X[:, 2] * gamma
-        XX = np.max(X, axis=0) - np.min(X, axis=0)
+    def sym_kernel_2d(self, ij2, hxy):
+        """
+        Integral of ln(r) over the cells of the 2D mesh
+        """
+        i2 = ij2[0]
+        j2 = ij2[1]
+        hx = hxy[0]
+        hy = hxy[1]
+        x = hx*np.r_[0:i2+1] - hx/2
+        y = hy*np.r_[0:j2+1] - hy/2
+        x, y = np.ix_(x, y)
+        IG = 0.5*x*y*np.log(x*x + y*y) - 1.5*x*y + 0.5*x*x*np.arctan(y/x) + 0.5*y*y*np.arctan(x/y)
+        kern = IG[1:i2+1, 1:j2+1] - IG[0:i2, 1:j2+1] - IG[1:i2+1, 0:j2] + IG[0:i2, 0:j2]
+        return kern
+
+    def kernel_fft_2d(self, nxy, steps):
+        """
+        FFT of the mirrored 2D integrated Green's function on the padded transverse mesh.
+        kernel(a*h) = a**2 * kernel(h) + const, the constant shifts the potential of a slice as a whole and
+        does not contribute to the field, so the same cache and quantization as for the 3D kernel are used.
+
+        :param nxy: (Nx, Ny) - transverse mesh size
+        :param steps: [hx, hy] - transverse mesh steps
+        :return: rfftn of the kernel
+        """
+        Nx, Ny = nxy
+        key, ref_steps = self.quantize_steps(steps)
+        key = (Nx, Ny) + key
+        if key in self.kernel_cache:
+            self.kernel_cache.move_to_end(key)
+            K2_fft = self.kernel_cache[key]
+        else:
+            K1 = self.sym_kernel_2d(nxy, ref_steps)
+            K2 = np.zeros((2*Nx-1, 2*Ny-1))
+            K2[0:Nx, 0:Ny] = K1
+            K2[0:Nx, Ny:2*Ny-1] = K2[0:Nx, Ny-1:0:-1]  #y-mirror
+            K2[Nx:2*Nx-1, :] = K2[Nx-1:0:-1, :]         #x-mirror
+            K2_fft = self.rfft(K2)
+            self.kernel_cache[key] = K2_fft
+            while len(self.kernel_cache) > self.kernel_cache_size:
+                self.kernel_cache.popitem(last=False)
+        return K2_fft * (steps[0]**2)
+
+    def potential_2d(self, q, steps):
+        """
+        Transverse potential of the longitudinal slices of the mesh. Every slice is considered as
+        an infinitely long line charge with the density q[:, :, k]/hz.
+        The 2D convolutions of all slices are done by a single batched FFT.
+
+        :param q: charge on the mesh
+        :param steps: [hx, hy, hz] - mesh steps
+        :return: potential on the mesh
+        """
+        hx = steps[0]
+        hy = steps[1]
+        hz = steps[2]
+        Nx = q.shape[0]
+        Ny = q.shape[1]
+        Nz = q.shape[2]
+        shape = (2*Nx-1, 2*Ny-1, Nz)
+        out = np.zeros(shape)
+        out[:Nx, :Ny, :] = q
+        K2_fft = self.kernel_fft_2d((Nx, Ny), steps[:2])
+        out = self.irfft(self.rfft(out, axes=(0, 1))*K2_fft[:, :, np.newaxis], shape, axes=(0, 1))
+        return -out[:Nx, :Ny, :]/(2*pi*epsilon_0*hx*hy*hz)
+
+    def line_potential(self, qz, hz, a):
+        """
+        Potential on the axis of the bunch with the line charge qz. Every slice is considered as
+        a uniformly charged disk with the radius a.
+
+        :param qz: charges of the slices
+        :param hz: longitudinal mesh step
+        :param a: radius of the disk
+        :return: potential of the slices
+        """
+        Nz = len(qz)
+        d = hz*np.r_[1-Nz:Nz+1] - hz/2
+        # integral of sqrt(a^2 + d^2) - |d| over the slice
+        IG = 0.5*d*np.sqrt(a*a + d*d) + 0.5*a*a*np.arcsinh(d/a) - 0.5*d*np.abs(d)
+        K = (IG[1:] - IG[:-1])/(2*pi*epsilon_0*a*a*hz)
+        return np.convolve(qz, K)[Nz-1:2*Nz-1]
+
+    def mesh_steps(self, XX, sigma, nxyz):
+        """
+        Steps of the mesh and the choice of the solver
+
+        :param XX: sizes of the bunch in the rest frame
+        :param sigma: RMS sizes of the bunch in the rest frame
+        :param nxyz: mesh
+        :return: (steps, slice_solver)
+        """
+        slice_solver = self.solver == "2.5d" or (self.solver == "auto" and
+                                                 sigma[2] > self.aspect_ratio * max(sigma[0], sigma[1]))
+        logger.debug('2.5D solver: ' + str(slice_solver))
         if self.random_mesh:
             XX = XX * np.random.uniform(low=1, high=1.1)
         logger.debug('mesh steps:' + str(XX))
         # here we use a fast 3D "near-point" interpolation
         # we need a stand-alone module with 1D,2D,3D parricles-to-grid functions
         steps = XX / (nxyz - 3)
-        X = X / steps
-        X_min = np.min(X, axis=0)
-        X_mid = np.dot(Q, X) / np.sum(Q)
+        return steps, slice_solver
+
+    def mesh_offset(self, X_min, X_mid):
+        """
+        Offset of the mesh in units of the mesh steps
+
+        :param X_min: minimal coordinates of the particles in units of the mesh steps
+        :param X_mid: charge weighted mean coordinates in units of the mesh steps
+        :return: X_off
+        """
         X_off = np.floor(X_min - X_mid) + X_mid
         if self.random_mesh:
             X_off = X_off + np.random.uniform(low=-0.5, high=0.5)
-        X = X - X_off
+        return X_off
+
+    def deposit_charge(self, X, Q, nxyz):
+        """
+        Deposition of the charges on the mesh
+
+        :param X: (N, 3) coordinates in units of the mesh steps relative to the mesh offset
+        :param Q: charges
+        :param nxyz: mesh
+        :return: charges on the mesh
+        """
         nx = nxyz[0]
         ny = nxyz[1]
         nz = nxyz[2]
         nzny = nz * ny
-        Xi = np.int_(np.floor(X) + 1)
-        inds = np.int_(Xi[:, 0] * nzny + Xi[:, 1] * nz + Xi[:, 2])  # 3d -> 1d
-        q = np.bincount(inds, Q, nzny * nx).reshape(nxyz)
-        p = self.potential(q, steps)
+        if self.deposit == "cic":
+            q = cic_deposit(X, Q, nxyz)
+        elif self.deposit == "tsc":
+            q = tsc_deposit(X, Q, nxyz)
+        else:
+            Xi = np.int_(np.floor(X) + 1)
+            inds = np.int_(Xi[:, 0] * nzny + Xi[:, 1] * nz + Xi[:, 2])  # 3d -> 1d
+            q = np.bincount(inds, Q, nzny * nx).reshape(nxyz)
+        return q
+
+    def mesh_field(self, q, steps, sigma, slice_solver):
+        """
+        Electric field on the mesh in the rest frame
+
+        :param q: charges on the mesh
+        :param steps: mesh steps
+        :param sigma: RMS sizes of the bunch in the rest frame
+        :param slice_solver: True - 2.5D solver, False - 3D solver
+        :return: (Ex, Ey, Ez)
+        """
+        nx, ny, nz = q.shape
+        if slice_solver:
+            p = self.potential_2d(q, steps)
+            # radius of the uniformly charged disk with the same RMS size
+            a = np.sqrt(2 * (sigma[0] ** 2 + sigma[1] ** 2))
+            pz = self.line_potential(np.sum(q, axis=(0, 1)), steps[2], a)
+        else:
+            p = self.potential(q, steps)
         Ex = np.zeros(p.shape)
         Ey = np.zeros(p.shape)
         Ez = np.zeros(p.shape)
         Ex[:nx - 1, :, :] = (p[:nx - 1, :, :] - p[1:nx, :, :]) / steps[0]
         Ey[:, :ny - 1, :] = (p[:, :ny - 1, :] - p[:, 1:ny, :]) / steps[1]
-        Ez[:, :, :nz - 1] = (p[:, :, :nz - 1] - p[:, :, 1:nz]) / steps[2]
-        Exyz = np.zeros((N, 3))
-        Exyz[:, 0] = ndimage.map_coordinates(Ex, np.c_[X[:, 0], X[:, 1] + 0.5, X[:, 2] + 0.5].T, order=1) * gamma
-        Exyz[:, 1] = ndimage.map_coordinates(Ey, np.c_[X[:, 0] + 0.5, X[:, 1], X[:, 2] + 0.5].T, order=1) * gamma
-        Exyz[:, 2] = ndimage.map_coordinates(Ez, np.c_[X[:, 0] + 0.5, X[:, 1] + 0.5, X[:, 2]].T, order=1)
-        return Exyz
+        if slice_solver:
+            Ez[:, :, :nz - 1] = (pz[:nz - 1] - pz[1:nz]) / steps[2]
+        else:
+            Ez[:, :, :nz - 1] = (p[:, :, :nz - 1] - p[:, :, 1:nz]) / steps[2]
+        return Ex, Ey, Ez
 
+    def el_field(self, X, Q, gamma, nxyz):
+        N = X.shape[0]
+        X[:, 2] = X[:, 2] * gamma
+        sigma = np.std(X, axis=0)
+        XX = np.max(X, axis=0) - np.min(X, axis=0)
+        steps, slice_solver = self.mesh_steps(XX, sigma, nxyz)
+        X = X / steps
+        X_min = np.min(X, axis=0)
+        X_mid = np.dot(Q, X) / np.sum(Q)
+        X_off = self.mesh_offset(X_min, X_mid)
+        X = X - X_off
+        q = self.deposit_charge(X, Q, nxyz)
+        Ex, Ey, Ez = self.mesh_field(q, steps, sigma, slice_solver)
+        Exyz = field_gather(X, Ex, Ey, Ez)
+        Exyz[:, 0] *= gamma
+        Exyz[:, 1] *= gamma
+        return Exyz
 
-    def apply(self, p_array, zstep):
-        logger.debug(" apply: zstep = " + str(zstep))
-        if zstep == 0:
-            logger.debug(" apply: zstep = 0 -> return ")
-            return
-        nmesh_xyz = np.array(self.nmesh_xyz)
+    def xp_coordinates(self, p_array):
+        """
+        :param p_array: ParticleArray
+        :return: (6, N) - coordinates and momenta [eV/c] in the laboratory frame
+        """
         gamref = p_array.E / m_e_GeV
-        betref2 = 1 - gamref ** -2
-        betref = np.sqrt(betref2)
-
-        # MAD coordinates!!!
-        # Lorentz transformation with V-axis and gamma_av
         xp = np.zeros(p_array.rparticles.shape)
-        xp = xxstg_2_xp_mad(p_array.rparticles, xp, gamref)
+        return xxstg_2_xp_mad(p_array.rparticles, xp, gamref)
 
+    def rest_frame(self, P):
+        """
+        Frame with the longitudinal axis along the mean momentum of the bunch
+
+        :param P: mean momentum [eV/c]
+        :return: (T, gamma0) - transformation matrix to the frame and the mean energy
+        """
         # coordinate transformation to the velocity direction
-        t3 = np.mean(xp[3:6], axis=1)
-        Pav = np.linalg.norm(t3)
-        t3 = t3 / Pav
+        Pav = np.linalg.norm(P)
+        t3 = P / Pav
         ey = np.array([0, 1, 0])
         t1 = np.cross(ey, t3)
         t1 = t1 / np.linalg.norm(t1)
         t2 = np.cross(t3, t1)
         T = np.c_[t1, t2, t3]
+        gamma0 = np.sqrt((Pav / m_e_eV) ** 2 + 1)
+        return T, gamma0
 
-        xyz = np.dot(xp[0:3].T, T)
-        xp[3:6] = np.dot(xp[3:6].T, T).T
+    def kick(self, p_array, xp, T, Exyz, zstep, gamma0):
+        """
+        Equations of motion in the lab system
 
-        # electric field in the rest frame of bunch
-        gamma0 = np.sqrt((Pav / m_e_eV) ** 2 + 1)
+        :param p_array: ParticleArray, the particles are updated
+        :param xp: coordinates with the momenta in the frame T, see xp_coordinates() and rest_frame()
+        :param T: transformation matrix to the frame
+        :param Exyz: electric field in the rest frame of the bunch
+        :param zstep: step
+        :param gamma0: mean energy
+        :return:
+        """
+        gamref = p_array.E / m_e_GeV
+        betref2 = 1 - gamref ** -2
+        betref = np.sqrt(betref2)
         beta02 = 1 - gamma0 ** -2
         beta0 = np.sqrt(beta02)
-
-        Exyz = self.el_field(xyz, p_array.q_array, gamma0, nmesh_xyz)
-
-        # equations of motion in the lab system
         cdT = zstep / betref
 
         xp[3] = xp[3] + cdT * (1 - beta0 * beta0) * Exyz[:, 0]
@@ -243,17 +663,178 @@ class SpaceCharge(PhysProc):
         xp[3:6] = np.dot(xp[3:6].T, T).T
         xp_2_xxstg_mad(xp, p_array.rparticles, gamref)
 
+    def apply(self, p_array, zstep):
+        logger.debug(" apply: zstep = " + str(zstep))
+        if zstep == 0:
+            logger.debug(" apply: zstep = 0 -> return ")
+            return
+        nmesh_xyz = np.array(self.nmesh_xyz)
+
+        # MAD coordinates!!!
+        # Lorentz transformation with V-axis and gamma_av
+        xp = self.xp_coordinates(p_array)
+        T, gamma0 = self.rest_frame(np.mean(xp[3:6], axis=1))
+
+        xyz = np.dot(xp[0:3].T, T)
+        xp[3:6] = np.dot(xp[3:6].T, T).T
+
+        # electric field in the rest frame of bunch
+        Exyz = self.el_field(xyz, p_array.q_array, gamma0, nmesh_xyz)
+        self.kick(p_array, xp, T, Exyz, zstep, gamma0)
+
+    def chunk_start(self, zstep):
+        """
+        Out-of-core tracking, see PhysProc. Pass 0 - mean momentum of the bunch, pass 1 - moments and bounds of
+        the bunch in the rest frame, pass 2 - deposition of the charges on the mesh, then the field is
+        calculated and applied chunk by chunk.
+        """
+        if zstep == 0:
+            logger.debug(" chunk_start: zstep = 0 -> return ")
+            self.chunk_data = None
+            return
+        self.chunk_data = {"P": np.zeros(3), "n": 0, "xyz": BeamMoments(), "min": np.full(3, np.inf),
+                           "max": np.full(3, -np.inf), "QX": np.zeros(3), "Q": 0.}
+
+    def chunk_xyz(self, xp):
+        d = self.chunk_data
+        xyz = np.dot(xp[0:3].T, d["T"])
+        xyz[:, 2] = xyz[:, 2] * d["gamma0"]
+        return xyz
+
+    def chunk_reduce(self, p_array, npass):
+        d = self.chunk_data
+        if d is None or p_array.n == 0:
+            return
+        xp = self.xp_coordinates(p_array)
+        if npass == 0:
+            d["P"] += np.sum(xp[3:6], axis=1)
+            d["n"] += p_array.n
+            return
+        xyz = self.chunk_xyz(xp)
+        Q = p_array.q_array
+        if npass == 1:
+            d["xyz"].add(xyz.T)
+            d["min"] = np.minimum(d["min"], np.min(xyz, axis=0))
+            d["max"] = np.maximum(d["max"], np.max(xyz, axis=0))
+            d["QX"] += np.dot(Q, xyz)
+            d["Q"] += np.sum(Q)
+        else:
+            X = xyz / d["steps"] - d["X_off"]
+            d["q"] += self.deposit_charge(X, Q, np.array(self.nmesh_xyz))
+
+    def chunk_reduce_end(self, npass, zstep):
+        d = self.chunk_data
+        if d is None:
+            return
+        if npass == 0:
+            d["T"], d["gamma0"] = self.rest_frame(d["P"] / d["n"])
+        elif npass == 1:
+            nmesh_xyz = np.array(self.nmesh_xyz)
+            d["sigma"] = np.sqrt(np.diag(d["xyz"].cov()))
+            d["steps"], d["slice_solver"] = self.mesh_steps(d["max"] - d["min"], d["sigma"], nmesh_xyz)
+            d["X_off"] = self.mesh_offset(d["min"] / d["steps"], d["QX"] / d["Q"] / d["steps"])
+            d["q"] = np.zeros(nmesh_xyz)
+        else:
+            d["E"] = self.mesh_field(d["q"], d["steps"], d["sigma"], d["slice_solver"])
+
+    def chunk_kick(self, p_array, zstep):
+        d = self.chunk_data
+        if d is None or p_array.n == 0:
+            return
+        xp = self.xp_coordinates(p_array)
+        X = self.chunk_xyz(xp) / d["steps"] - d["X_off"]
+        xp[3:6] = np.dot(xp[3:6].T, d["T"]).T
+        Exyz = field_gather(X, *d["E"])
+        Exyz[:, 0] *= d["gamma0"]
+        Exyz[:, 1] *= d["gamma0"]
+        self.kick(p_array, xp, d["T"], Exyz, zstep, d["gamma0"])
+
 
 class LSC(PhysProc):
     """
     Longitudinal Space Charge
     smooth_param - 0.1 smoothing parameter, resolution = np.std(p_array.tau())*smooth_param
+    imp_tol - 0., relative tolerance of gamma, beam size and step of the current profile within which
+              the cached impedance is reused, e.g. 1e-3. If 0, the impedance is reused only for identical values.
+    imp_cache_size - 64, maximal number of the cached impedances
     """
+    n_chunk_passes = 2
+    changes_tau = False
+
     def __init__(self, step=1):
         PhysProc.__init__(self, step)
         self.smooth_param = 0.1
         self.step_profile = False
         self.napply = 0
+        self.imp_tol = 0.
+        self.imp_cache_size = 64
+        self.imp_cache = OrderedDict()
+        self.fft_plans = {}
+
+    def quantize(self, value):
+        """
+        Quantization of the value on the logarithmic grid with the relative resolution self.imp_tol
+
+        :param value: positive value
+        :return: (key, ref_value) - key for the impedance cache and the value which corresponds to the key
+        """
+        if self.imp_tol <= 0:
+            return value, value
+        log_base = np.log1p(self.imp_tol)
+        key = int(np.round(np.log(value) / log_base))
+        return key, np.exp(key * log_base)
+
+    def impedance(self, gamma, sigma, ds, nb):
+        """
+        LSC impedance per unit length on the frequency grid of the current profile zero padded to 2*nb points.
+        The result is cached and keyed by nb and quantized gamma, sigma and ds.
+
+        :param gamma: energy
+        :param sigma: transverse RMS size (radius for the step profile) of the beam
+        :param ds: step of the current profile
+        :param nb: number of points of the current profile
+        :return: impedance, Omm/m
+        """
+        key_g, gamma = self.quantize(gamma)
+        key_s, sigma = self.quantize(sigma)
+        key_d, ds = self.quantize(ds)
+        key = (nb, self.step_profile, key_g, key_s, key_d)
+        if key in self.imp_cache:
+            self.imp_cache.move_to_end(key)
+            return self.imp_cache[key]
+        dt = ds / speed_of_light
+        w = 1 / dt * np.arange(0, nb) / (2 * nb) * 2 * np.pi
+        if self.step_profile:
+            # space charge impedance of transverse step profile
+            Za = self.imp_step_lsc(gamma, rb=sigma, w=w, dz=1.)
+        else:
+            Za = self.imp_lsc(gamma, sigma, w=w, dz=1.)
+        self.imp_cache[key] = Za
+        while len(self.imp_cache) > self.imp_cache_size:
+            self.imp_cache.popitem(last=False)
+        return Za
+
+    def get_fft_plans(self, n):
+        """
+        Zero padded input buffer and real FFTs of the length n, persistent pyfftw plans if pyfftw is installed
+
+        :param n: length of the FFT
+        :return: (buffer, rfft, irfft)
+        """
+        if n not in self.fft_plans:
+            if pyfftw_flag:
+                a = pyfftw.empty_aligned(n, dtype='float64')
+                fft = pyfftw.builders.rfft(a, planner_effort='FFTW_MEASURE')
+                b = pyfftw.empty_aligned(n // 2 + 1, dtype='complex128')
+                ifft = pyfftw.builders.irfft(b, n=n, planner_effort='FFTW_MEASURE')
+                buf = fft.input_array
+                buf[:] = 0.
+            else:
+                buf = np.zeros(n)
+                fft = np.fft.rfft
+                ifft = lambda x: np.fft.irfft(x, n)
+            self.fft_plans[n] = (buf, fft, ifft)
+        return self.fft_plans[n]
 
     def imp_lsc(self, gamma, sigma, w, dz):
         """
@@ -333,27 +914,101 @@ class LSC(PhysProc):
         dt = ds / speed_of_light
         nb = len(s)
         n = nb * 2
-        f = 1 / dt * np.arange(0, n) /n
-        if self.step_profile:
-            # space charge impedance of transverse step profile
-            Za = self.imp_step_lsc(gamma, rb=sigma, w=f[0:nb] * 2 * np.pi, dz=dz)
-        else:
-            Za = self.imp_lsc(gamma, sigma, w=f[0:nb] * 2 * np.pi, dz=dz)
-
-        sb1 = s[0] + np.cumsum(np.ones(n)) * ds
-
-        bunch1 = np.append(bunch, np.zeros(nb))
+        Za = self.impedance(gamma, sigma, ds, nb) * dz
 
-        f, Zb = self.wake2impedance(sb1, bunch1 * speed_of_light)
+        # the same as wake2impedance() and impedance2wake() but with the real FFT of the zero padded bunch
+        buf, fft, ifft = self.get_fft_plans(n)
+        buf[0:nb] = bunch * speed_of_light
+        Zb = dt * fft(buf)
 
-        Z = np.zeros(n, dtype=np.complex)
+        Z = np.empty(nb + 1, dtype=complex)
         Z[0:nb] = Za * Zb[0:nb]
-        Z[nb:n] = np.flipud(np.conj(Z[0:nb]))
+        Z[nb] = np.conj(Z[nb - 1])
 
-        xa, wa = self.impedance2wake(f, Z)
+        df = 1 / dt / n
+        wa = n * df * ifft(Z)
         res = -wa[0:nb]
         return res
 
+    def energy_change(self, B, q, gamma, sigma, dz):
+        """
+        Energy change of the particles along the bunch
+
+        :param B: beam current [s, I], see s_to_cur()
+        :param q: bunch charge
+        :param gamma: energy
+        :param sigma: transverse RMS size (radius for the step profile) of the beam core
+        :param dz: step
+        :return: (x, W) - grid and energy change in [eV]
+        """
+        bunch = B[:, 1] / (q * speed_of_light)
+        x = B[:, 0]
+        W = - self.wake_lsc(x, bunch, gamma, sigma, dz) * q
+        return x, W
+
+    def chunk_start(self, dz):
+        """
+        Out-of-core tracking, see PhysProc. Pass 0 - moments and bounds of tau and the charge,
+        pass 1 - the current profile and the transverse size of the beam core, then the kick.
+        """
+        if dz < 1e-10:
+            logger.debug(" LSC applied, dz < 1e-10, dz = " + str(dz))
+            self.chunk_data = None
+            return
+        self.chunk_data = {"tau": BeamMoments(), "min": np.inf, "max": -np.inf, "q": 0.,
+                           "core": BeamMoments(), "xy_min": np.full(2, np.inf), "xy_max": np.full(2, -np.inf)}
+
+    def chunk_reduce(self, p_array, npass):
+        d = self.chunk_data
+        if d is None or p_array.n == 0:
+            return
+        tau = p_array.tau()
+        d["E"] = p_array.E
+        if npass == 0:
+            d["tau"].add(tau[np.newaxis, :])
+            d["min"] = min(d["min"], np.min(tau))
+            d["max"] = max(d["max"], np.max(tau))
+            d["q"] += np.sum(p_array.q_array)
+            return
+        s_to_cur_deposit(tau, d["C"], d["a"], d["ds"])
+        indx = np.where(np.logical_and(np.greater_equal(tau, d["slice_min"]), np.less(tau, d["slice_max"])))[0]
+        if len(indx) == 0:
+            return
+        xy = np.array([p_array.x()[indx], p_array.y()[indx]], dtype=np.float64)
+        if self.step_profile:
+            d["xy_min"] = np.minimum(d["xy_min"], np.min(xy, axis=1))
+            d["xy_max"] = np.maximum(d["xy_max"], np.max(xy, axis=1))
+        else:
+            d["core"].add(xy)
+
+    def chunk_reduce_end(self, npass, dz):
+        d = self.chunk_data
+        if d is None:
+            return
+        if npass == 0:
+            mean_b = d["tau"].means[0]
+            d["sigma_tau"] = np.sqrt(d["tau"].cov()[0, 0])
+            d["slice_min"] = mean_b - d["sigma_tau"] / 2.5
+            d["slice_max"] = mean_b + d["sigma_tau"] / 2.5
+            d["a"], d["ds"], N = s_to_cur_grid(d["min"], d["max"], d["sigma_tau"] * self.smooth_param)
+            d["C"] = np.zeros(N)
+            return
+        if self.step_profile:
+            sigma = np.min(d["xy_max"] - d["xy_min"]) / 2
+        else:
+            sigma = np.mean(np.sqrt(np.diag(d["core"].cov())))
+        gamma = d["E"] / m_e_GeV
+        v = np.sqrt(1 - 1 / gamma ** 2) * speed_of_light
+        B = s_to_cur_finish(d["C"], d["a"], d["ds"], d["sigma_tau"] * self.smooth_param, d["q"], v)
+        d["x"], d["W"] = self.energy_change(B, d["q"], gamma, sigma, dz)
+
+    def chunk_kick(self, p_array, dz):
+        d = self.chunk_data
+        if d is None:
+            return
+        pc_ref = np.sqrt(p_array.E ** 2 / m_e_GeV ** 2 - 1) * m_e_GeV
+        p_array.rparticles[5] += np.interp(p_array.tau(), d["x"], d["W"]) * 1e-9 / pc_ref
+
     def apply(self, p_array, dz):
         """
         wakes in V/pC
@@ -366,8 +1021,7 @@ class LSC(PhysProc):
             logger.debug(" LSC applied, dz < 1e-10, dz = " + str(dz))
             return
         logger.debug(" LSC applied, dz =" + str(dz))
-        mean_b = np.mean(p_array.tau())
-        sigma_tau = np.std(p_array.tau())
+        mean_b, sigma_tau = p_array.profile.mean_std()
         slice_min = mean_b - sigma_tau / 2.5
         slice_max = mean_b + sigma_tau / 2.5
         indx = np.where(np.logical_and(np.greater_equal(p_array.tau(), slice_min), np.less(p_array.tau(), slice_max)))
@@ -382,13 +1036,10 @@ class LSC(PhysProc):
         q = np.sum(p_array.q_array)
         gamma = p_array.E / m_e_GeV
         v = np.sqrt(1 - 1 / gamma ** 2) * speed_of_light
-        B = s_to_cur(p_array.tau(), sigma_tau * self.smooth_param, q, v)
-        bunch = B[:, 1] / (q * speed_of_light)
-        x = B[:, 0]
-
-        W = - self.wake_lsc(x, bunch, gamma, sigma, dz) * q
+        B = p_array.profile.current(sigma_tau * self.smooth_param, v)
+        x, W = self.energy_change(B, q, gamma, sigma, dz)
 
-        indx = np.argsort(p_array.tau(), kind="quicksort")
+        indx = p_array.profile.argsort()
         tau_sort = p_array.tau()[indx]
         dE = np.interp(tau_sort, x, W)
 
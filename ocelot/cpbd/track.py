@@ -4,10 +4,16 @@ from ocelot.cpbd.optics import *
 from ocelot.cpbd.beam import *
 from ocelot.cpbd.errors import *
 from ocelot.cpbd.elements import *
-from time import time
+from time import time, perf_counter
 from scipy.stats import truncnorm
 import copy
 import sys
+import os
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import tracemalloc
+import json
 import logging
 
 _logger = logging.getLogger(__name__)
@@ -254,28 +260,37 @@ def ellipse_track_list(beam, n_t_sigma = 3, num = 1000, type = "contour"):
 
 
 
-def track_nturns(lat, nturns, track_list, nsuperperiods=1, save_track=True, print_progress=True):
+def track_nturns(lat, nturns, track_list, nsuperperiods=1, save_track=True, print_progress=True, profiler=None):
     xlim, ylim, px_lim, py_lim = aperture_limit(lat, xlim = 1, ylim = 1)
     navi = Navigator(lat)
 
-    t_maps = get_map(lat, lat.totalLen, navi)
+    elems = []
+    t_maps = get_map(lat, lat.totalLen, navi, elems=elems)
     track_list_const = copy.copy(track_list)
     p_array = ParticleArray()
     p_list = [p.particle for p in track_list]
     p_array.list2array(p_list)
 
-    for i in range(nturns):
-        if print_progress: print(i)
-        for n in range(nsuperperiods):
-            for tm in t_maps:
-                tm.apply(p_array)
-            p_indx = p_array.rm_tails(xlim, ylim, px_lim, py_lim)
-
-            track_list = np.delete(track_list, p_indx)
-        for n, pxy in enumerate(track_list):
-            pxy.turn = i
-            if save_track:
-                pxy.p_list.append(p_array.rparticles[:, n])
+    try:
+        for i in range(nturns):
+            if print_progress: print(i)
+            for n in range(nsuperperiods):
+                if profiler is None:
+                    for tm in t_maps:
+                        tm.apply(p_array)
+                else:
+                    for tm, elem in zip(t_maps, elems):
+                        profiler.run(tm.apply, p_array, element=elem)
+                p_indx = p_array.rm_tails(xlim, ylim, px_lim, py_lim)
+
+                track_list = np.delete(track_list, p_indx)
+            for n, pxy in enumerate(track_list):
+                pxy.turn = i
+                if save_track:
+                    pxy.p_list.append(p_array.rparticles[:, n])
+    finally:
+        if profiler is not None:
+            profiler.stop()
     return np.array(track_list_const)
 
 
@@ -370,28 +385,356 @@ def da_mpi(lat, nturns, x_array, y_array, errors=None, nsuperperiods=1):
         return da.reshape(ny, nx)
 
 
-def tracking_step(lat, particle_list, dz, navi):
+_thread_pools = {}
+
+
+def apply_maps(t_maps, particle_list, nthreads=1, min_block=20000):
+    """
+    Application of the list of transfer maps to the particles.
+    If nthreads > 1 ParticleArray is split in contiguous blocks of the particles (columns of rparticles) and
+    the whole list of maps is applied to every block in the thread pool. All transfer maps are single particle maps
+    which change the particles in place, NumPy, numexpr and numba (nogil) kernels release GIL, so the blocks are
+    processed concurrently.
+
+    :param t_maps: list of TransferMaps
+    :param particle_list: ParticleArray or Particle list
+    :param nthreads: 1, number of threads
+    :param min_block: 20000, minimal number of particles in the block
+    :return: None
+    """
+    nblocks = 1
+    if particle_list.__class__ == ParticleArray:
+        nblocks = min(nthreads, particle_list.n // min_block)
+    if nblocks <= 1:
+        for tm in t_maps:
+            tm.apply(particle_list)
+        return
+
+    p_array = particle_list
+    bounds = np.linspace(0, p_array.n, nblocks + 1).astype(int)
+    blocks = []
+    for i0, i1 in zip(bounds[:-1], bounds[1:]):
+        block = ParticleArray(dtype=p_array.rparticles.dtype)
+        block.rparticles = p_array.rparticles[:, i0:i1]
+        block.q_array = p_array.q_array[i0:i1]
+        block.E = p_array.E
+        block.s = p_array.s
+        blocks.append(block)
+
+    def apply_block(block):
+        for tm in t_maps:
+            tm.apply(block)
+
+    if nblocks not in _thread_pools:
+        _thread_pools[nblocks] = ThreadPoolExecutor(max_workers=nblocks)
+    # exceptions in the threads are raised here
+    list(_thread_pools[nblocks].map(apply_block, blocks))
+    p_array.E = blocks[0].E
+    p_array.s = blocks[0].s
+    p_array.modified()
+
+
+def tracking_step(lat, particle_list, dz, navi, profiler=None, nthreads=1):
     """
     tracking for a fixed step dz
     :param lat: Magnetic Lattice
     :param particle_list: ParticleArray or Particle list
     :param dz: step in [m]
     :param navi: Navigator
+    :param profiler: None or TrackProfiler
+    :param nthreads: 1, number of threads for the application of the transfer maps, see apply_maps()
     :return: None
     """
     if navi.z0 + dz > lat.totalLen:
         dz = lat.totalLen - navi.z0
 
-    t_maps = get_map(lat, dz, navi)
-    for tm in t_maps:
+    elems = [] if profiler is not None else None
+    t_maps = get_map(lat, dz, navi, elems=elems)
+    if profiler is None:
         start = time()
-        tm.apply(particle_list)
+        apply_maps(t_maps, particle_list, nthreads=nthreads)
+        _logger.debug(" tracking_step -> apply_maps: time exec = " + str(time() - start) + "  sec")
+        return
+    for i, tm in enumerate(t_maps):
+        profiler.run(apply_maps, [tm], particle_list, nthreads, element=elems[i])
         _logger.debug(" tracking_step -> tm.class: " + tm.__class__.__name__  + "  l= "+  str(tm.length))
-        _logger.debug(" tracking_step -> tm.apply: time exec = " + str(time() - start) + "  sec")
     return
 
 
-def track(lattice, p_array, navi, print_progress=True, calc_tws=True, bounds=None):
+class TrackProfiler:
+    """
+    Opt-in profiler of track() and track_nturns(). It accumulates wall time, number of calls and
+    peak memory per element type, element id and physics process.
+
+    :param timeline: True, every call is stored as event for export to the trace viewers (chrome://tracing, Perfetto)
+    :param memory: False, if True the peak of the traced memory above its level at the start of each call is measured
+                    with tracemalloc ("peak_bytes" is the maximum over the calls, not the total allocated memory).
+                    It slows down the tracking considerably. tracemalloc is started at the first call and
+                    stopped at the end of track(). If tracemalloc is already used by other code,
+                    the memory is not measured, because the peak of the other user would be reset.
+
+    Example:
+        profiler = TrackProfiler()
+        tws, p_array = track(lat, p_array, navi, profiler=profiler)
+        print(profiler.table("type"))
+        profiler.save_trace("track_trace.json")
+    """
+    groups = ("type", "element", "process", "other")
+
+    def __init__(self, timeline=True, memory=False):
+        self.timeline = timeline
+        self.memory = memory
+        self.tracing = False
+        self.reset()
+
+    def reset(self):
+        self.totals = {group: {} for group in self.groups}
+        self.events = []
+        self.t0 = perf_counter()
+
+    def run(self, func, *args, element=None, process=None, name=None):
+        """
+        Method calls func(*args) and adds its execution time to the element, the physics process or the name
+
+        :param func: function
+        :param args: arguments of the function
+        :param element: None or Element which transfer map is applied
+        :param process: None or PhysProc which is applied
+        :param name: None or name of the other part of the tracking, e.g. "get_envelope"
+        :return: result of the function
+        """
+        if self.memory and not self.tracing:
+            if tracemalloc.is_tracing():
+                _logger.debug("TrackProfiler: tracemalloc is used by other code, memory is not measured")
+            else:
+                tracemalloc.start()
+                self.tracing = True
+        if self.tracing:
+            mem0 = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+
+        start = perf_counter()
+        result = func(*args)
+        dt = perf_counter() - start
+
+        nbytes = tracemalloc.get_traced_memory()[1] - mem0 if self.tracing else 0
+
+        if element is not None:
+            label = element.__class__.__name__
+            self.add("type", label, dt, nbytes)
+            self.add("element", element.id, dt, nbytes)
+            cat, args = "element", {"id": element.id}
+        elif process is not None:
+            label = process.__class__.__name__
+            self.add("process", label, dt, nbytes)
+            cat, args = "process", {}
+        else:
+            label = name
+            self.add("other", label, dt, nbytes)
+            cat, args = "other", {}
+
+        if self.timeline:
+            if self.tracing:
+                args["peak_bytes"] = nbytes
+            self.events.append({"name": label, "cat": cat, "ph": "X", "ts": (start - self.t0) * 1e6,
+                                "dur": dt * 1e6, "pid": 0, "tid": 0, "args": args})
+        return result
+
+    def stop(self):
+        """
+        Method stops tracemalloc if it was started by the profiler. It is called at the end of track()
+        and track_nturns(), the next call of run() starts it again.
+        """
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+    def add(self, group, key, dt, nbytes):
+        rec = self.totals[group].get(key)
+        if rec is None:
+            rec = {"time": 0., "calls": 0, "peak_bytes": 0}
+            self.totals[group][key] = rec
+        rec["time"] += dt
+        rec["calls"] += 1
+        rec["peak_bytes"] = max(rec["peak_bytes"], nbytes)
+
+    def stats(self, group="type"):
+        """
+        Method returns accumulated statistics sorted by the time
+
+        :param group: "type" - element types, "element" - element ids, "process" - physics processes,
+                        "other" - the rest of the tracking loop
+        :return: dict {key: {"time": [sec], "calls": number of calls, "peak_bytes": maximal peak memory of a call}}
+        """
+        totals = self.totals[group]
+        return {key: dict(totals[key]) for key in sorted(totals, key=lambda k: totals[k]["time"], reverse=True)}
+
+    def table(self, group="type"):
+        """
+        Method returns statistics as a text table
+
+        :param group: "type", "element", "process" or "other", see stats()
+        :return: str
+        """
+        stats = self.stats(group)
+        t_total = np.sum([rec["time"] for rec in stats.values()])
+        lines = ["{:<24} {:>10} {:>7} {:>10} {:>14}".format(group, "time, s", "%", "calls", "peak bytes")]
+        for key, rec in stats.items():
+            percent = 100. * rec["time"] / t_total if t_total > 0 else 0.
+            lines.append("{:<24} {:>10.4f} {:>7.2f} {:>10d} {:>14d}".format(str(key), rec["time"], percent,
+                                                                           rec["calls"], rec["peak_bytes"]))
+        return "\n".join(lines)
+
+    def save_trace(self, filename):
+        """
+        Method saves timeline in the Trace Event Format (chrome://tracing, Perfetto)
+
+        :param filename: json file
+        """
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+    def __str__(self):
+        return "\n\n".join([self.table(group) for group in self.groups if self.totals[group]])
+
+
+class Checkpoint:
+    """
+    Periodic saving of the tracking state (ParticleArray, Navigator and physics processes state, twiss list)
+    to the binary file during track(). The tracking can be continued from the file with resume().
+
+    :param filename: checkpoint file, it is overwritten at every checkpoint
+    :param n_steps: None or the state is saved every n_steps navigator steps
+    :param period: None or the state is saved every period seconds
+    :param background: True, the file is written in a background thread.
+                        The exception of the writing is raised at the next checkpoint or at the end of tracking.
+    """
+    def __init__(self, filename, n_steps=None, period=None, background=True):
+        self.filename = filename
+        self.n_steps = n_steps
+        self.period = period
+        self.background = background
+        self.nstep = 0
+        self.t_last = None
+        self.thread = None
+        self.error = None
+
+    def start(self):
+        """
+        The method is called by track() and resume() at the start of tracking, period is counted from here
+        """
+        self.t_last = time()
+
+    def update(self, p_array, navi, tws_track, L):
+        """
+        The method is called by track() after every navigator step
+        """
+        self.nstep += 1
+        by_steps = self.n_steps is not None and self.nstep % self.n_steps == 0
+        if self.t_last is None:
+            self.start()
+        by_time = self.period is not None and time() - self.t_last >= self.period
+        if by_steps or by_time:
+            self.save(get_tracking_state(p_array, navi, tws_track, L))
+
+    def save(self, state):
+        self.wait()
+        self.t_last = time()
+        if self.background:
+            self.thread = threading.Thread(target=self.write, args=(state,))
+            self.thread.start()
+        else:
+            self.write(state)
+
+    def write(self, state):
+        tmp_name = self.filename + ".tmp"
+        try:
+            with open(tmp_name, "wb") as f:
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_name, self.filename)
+        except Exception as e:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            if not self.background:
+                raise
+            # exception in the writer thread is raised in wait()
+            self.error = e
+            return
+        _logger.debug(" Checkpoint: state at z = " + str(state["navi"]["z0"]) + " is saved to " + self.filename)
+
+    def wait(self):
+        """
+        Method waits for the background writing and raises its exception
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def get_tracking_state(p_array, navi, tws_track, L):
+    """
+    Function returns copy of the tracking state
+
+    :param p_array: ParticleArray
+    :param navi: Navigator
+    :param tws_track: list of Twiss
+    :param L: tracked distance
+    :return: dict
+    """
+    procs = []
+    for p in navi.process_table.proc_list:
+        adaptive = getattr(p, "adaptive_step", None)
+        # only the plain state, AdaptiveStep.quantity can be a function which can not be pickled
+        adaptive_state = None if adaptive is None else {key: getattr(adaptive, key) for key in
+                                                        ("value", "step0", "step_min", "step_max", "rel_change")}
+        procs.append({"name": p.__class__.__name__, "counter": p.counter, "step": p.step, "z0": p.z0,
+                      "adaptive_step": adaptive_state})
+    state = {"rparticles": np.copy(p_array.rparticles), "q_array": np.copy(p_array.q_array),
+             "E": p_array.E, "s": p_array.s,
+             "navi": {"z0": navi.z0, "n_elem": navi.n_elem, "sum_lengths": navi.sum_lengths},
+             "procs": procs, "tws_track": list(tws_track), "L": L, "random_state": np.random.get_state()}
+    return state
+
+
+def set_tracking_state(state, navi):
+    """
+    Function restores Navigator and physics processes state and returns ParticleArray, twiss list and tracked distance
+
+    :param state: dict, see get_tracking_state()
+    :param navi: Navigator with the same physics processes as at the moment of the saving
+    :return: (p_array, tws_track, L)
+    """
+    proc_list = navi.process_table.proc_list
+    if [p.__class__.__name__ for p in proc_list] != [p["name"] for p in state["procs"]]:
+        raise ValueError("Physics processes of the Navigator do not match the saved ones: "
+                         + str([p["name"] for p in state["procs"]]))
+    for p, p_state in zip(proc_list, state["procs"]):
+        p.counter = p_state["counter"]
+        p.step = p_state["step"]
+        p.z0 = p_state["z0"]
+        if p_state["adaptive_step"] is not None:
+            if getattr(p, "adaptive_step", None) is None:
+                raise ValueError("Physics process " + p_state["name"] + " of the Navigator has no adaptive_step")
+            for key, value in p_state["adaptive_step"].items():
+                setattr(p.adaptive_step, key, value)
+    navi.z0 = state["navi"]["z0"]
+    navi.n_elem = state["navi"]["n_elem"]
+    navi.sum_lengths = state["navi"]["sum_lengths"]
+    np.random.set_state(state["random_state"])
+
+    p_array = ParticleArray()
+    p_array.rparticles = state["rparticles"]
+    p_array.q_array = state["q_array"]
+    p_array.E = state["E"]
+    p_array.s = state["s"]
+    return p_array, state["tws_track"], state["L"]
+
+
+def track(lattice, p_array, navi, print_progress=True, calc_tws=True, bounds=None, checkpoint=None, profiler=None,
+          tws_step=1, tws_positions=None, nthreads=1):
     """
     tracking through the lattice
 
@@ -401,35 +744,122 @@ def track(lattice, p_array, navi, print_progress=True, calc_tws=True, bounds=Non
     :param print_progress: True, print tracking progress
     :param calc_tws: True, during the tracking twiss parameters are calculated from the beam distribution
     :param bounds: None, optional, [left_bound, right_bound] - bounds in units of std(p_array.tau())
+    :param checkpoint: None or Checkpoint, periodic saving of the tracking state, see resume()
+    :param profiler: None or TrackProfiler, time of the elements and physics processes is accumulated
+    :param tws_step: 1, twiss parameters are calculated every tws_step steps and at the end of the lattice
+    :param tws_positions: None or list of positions [m], if given twiss parameters are calculated only
+                        after the steps which pass these positions (and at the start)
+    :param nthreads: 1, number of threads for the application of the transfer maps between the physics processes,
+                    see apply_maps()
     :return: twiss_list, ParticleArray. In case calc_tws=False, twiss_list is list of empty Twiss classes.
     """
 
     tw0 = get_envelope(p_array, bounds=bounds) if calc_tws else Twiss()
     tws_track = [tw0]
     L = 0.
+    # the caches of the beam are validated with the counters only, see ParticleArray.modified()
+    p_array.in_tracking = True
+    try:
+        return tracking_loop(lattice, p_array, navi, tws_track, L, print_progress=print_progress, calc_tws=calc_tws,
+                             bounds=bounds, checkpoint=checkpoint, profiler=profiler, tws_step=tws_step,
+                             tws_positions=tws_positions, nthreads=nthreads)
+    finally:
+        p_array.in_tracking = False
+        if profiler is not None:
+            profiler.stop()
+
+
+def resume(lattice, navi, filename, print_progress=True, calc_tws=True, bounds=None, checkpoint=None,
+           profiler=None, tws_step=1, tws_positions=None, nthreads=1):
+    """
+    Function continues tracking from the file saved by Checkpoint during track().
+    The lattice and the Navigator with the physics processes have to be created in the same way as for
+    the interrupted tracking.
 
+    :param lattice: Magnetic Lattice
+    :param navi: Navigator
+    :param filename: checkpoint file
+    :param print_progress: True, print tracking progress
+    :param calc_tws: True, during the tracking twiss parameters are calculated from the beam distribution
+    :param bounds: None, optional, [left_bound, right_bound] - bounds in units of std(p_array.tau())
+    :param checkpoint: None or Checkpoint, periodic saving of the tracking state
+    :param profiler: None or TrackProfiler
+    :param tws_step: 1, twiss parameters are calculated every tws_step steps, see track()
+    :param tws_positions: None or list of positions [m] where twiss parameters are calculated, see track()
+    :param nthreads: 1, number of threads for the application of the transfer maps, see track()
+    :return: twiss_list, ParticleArray - the same as track() of the whole tracking
+    """
+    with open(filename, "rb") as f:
+        state = pickle.load(f)
+    p_array, tws_track, L = set_tracking_state(state, navi)
+    _logger.info("resume: tracking continues from z = " + str(navi.z0))
+    # the caches of the beam are validated with the counters only, see ParticleArray.modified()
+    p_array.in_tracking = True
+    try:
+        return tracking_loop(lattice, p_array, navi, tws_track, L, print_progress=print_progress, calc_tws=calc_tws,
+                             bounds=bounds, checkpoint=checkpoint, profiler=profiler, tws_step=tws_step,
+                             tws_positions=tws_positions, nthreads=nthreads)
+    finally:
+        p_array.in_tracking = False
+        if profiler is not None:
+            profiler.stop()
+
+
+def tracking_loop(lattice, p_array, navi, tws_track, L, print_progress=True, calc_tws=True, bounds=None,
+                  checkpoint=None, profiler=None, tws_step=1, tws_positions=None, nthreads=1):
+
+    if tws_positions is not None:
+        tws_positions = np.sort(tws_positions)
+    if checkpoint is not None:
+        checkpoint.start()
+    nstep = 0
     while np.abs(navi.z0 - lattice.totalLen) > 1e-10:
         if navi.kill_process:
             _logger.info("Killing tracking ... ")
+            if checkpoint is not None:
+                checkpoint.wait()
             return tws_track, p_array
 
+        z_start = navi.z0
         dz, proc_list, phys_steps = navi.get_next()
-        tracking_step(lat=lattice, particle_list=p_array, dz=dz, navi=navi)
+        tracking_step(lat=lattice, particle_list=p_array, dz=dz, navi=navi, profiler=profiler, nthreads=nthreads)
         #part = p_array[0]
         for p, z_step in zip(proc_list, phys_steps):
             p.z0 = navi.z0
-            p.apply(p_array, z_step)
+            if profiler is None:
+                p.apply(p_array, z_step)
+            else:
+                profiler.run(p.apply, p_array, z_step, process=p)
+            p_array.modified(tau=getattr(p, "changes_tau", True))
+        navi.update_steps(proc_list, phys_steps, p_array)
         #p_array[0] = part
-        tw = get_envelope(p_array, bounds=bounds) if calc_tws else Twiss()
         L += dz
-        tw.s += L
-        tws_track.append(tw)
+        nstep += 1
+        if tws_positions is not None:
+            tws_needed = np.any((z_start < tws_positions) * (tws_positions <= navi.z0 + 1e-10))
+        else:
+            tws_needed = nstep % tws_step == 0 or np.abs(navi.z0 - lattice.totalLen) <= 1e-10
+        if tws_needed:
+            if not calc_tws:
+                tw = Twiss()
+            elif profiler is None:
+                tw = get_envelope(p_array, bounds=bounds)
+            else:
+                tw = profiler.run(lambda: get_envelope(p_array, bounds=bounds), name="get_envelope")
+            tw.s += L
+            tws_track.append(tw)
+
+        if checkpoint is not None:
+            checkpoint.update(p_array, navi, tws_track, L)
 
         if print_progress:
             poc_names = [p.__class__.__name__ for p in proc_list]
             sys.stdout.write( "\r" + "z = " + str(navi.z0)+" / "+str(lattice.totalLen) + " : applied: " + ", ".join(poc_names)  )
             sys.stdout.flush()
 
+    if checkpoint is not None:
+        checkpoint.wait()
+
     # finalize PhysProcesses
     for p in navi.get_phys_procs():
         p.finalize()
@@ -437,6 +867,117 @@ def track(lattice, p_array, navi, print_progress=True, calc_tws=True, bounds=Non
     return tws_track, p_array
 
 
+def track_chunked(lattice, store, navi, print_progress=True, calc_tws=True, tws_step=1, nthreads=1):
+    """
+    Out-of-core tracking of the beam which does not fit in RAM.
+    On every step the transfer maps are applied to the beam chunk by chunk. The physics processes are applied
+    with the two-phase protocol (see PhysProc): the reduction passes over all chunks build the grids or the profiles
+    of the whole beam, then the kick pass applies the fields chunk by chunk.
+    The physics processes which do not support it (PhysProc.n_chunk_passes is None, e.g. SmoothBeam)
+    and the adaptive steps are not allowed.
+
+    :param lattice: Magnetic Lattice
+    :param store: ParticleStore, the particles are changed in the store, it is flushed at the end of tracking
+    :param navi: Navigator
+    :param print_progress: True, print tracking progress
+    :param calc_tws: True, during the tracking twiss parameters are calculated from the beam distribution
+    :param tws_step: 1, twiss parameters are calculated every tws_step steps and at the end of the lattice
+    :param nthreads: 1, number of threads for the application of the transfer maps to the chunk, see apply_maps()
+    :return: twiss_list, ParticleStore
+    """
+    for p in navi.get_phys_procs():
+        if p.n_chunk_passes is None:
+            raise ValueError("track_chunked: " + p.__class__.__name__ + " does not support the chunked tracking")
+        if p.adaptive_step is not None:
+            raise ValueError("track_chunked: adaptive step of " + p.__class__.__name__ + " is not supported")
+
+    def envelope():
+        if not calc_tws:
+            return Twiss()
+        moments = BeamMoments()
+        for chunk in store.chunks():
+            moments.add_particles(chunk.rparticles)
+        return moments.twiss(store.E)
+
+    tws_track = [envelope()]
+    L = 0.
+    nstep = 0
+    while np.abs(navi.z0 - lattice.totalLen) > 1e-10:
+        if navi.kill_process:
+            _logger.info("Killing tracking ... ")
+            store.flush()
+            return tws_track, store
+
+        dz, proc_list, phys_steps = navi.get_next()
+        t_maps = get_map(lattice, min(dz, lattice.totalLen - navi.z0), navi)
+        for chunk in store.chunks():
+            apply_maps(t_maps, chunk, nthreads=nthreads)
+            E, s = chunk.E, chunk.s
+        if store.n > 0:
+            store.E, store.s = E, s
+
+        for p, z_step in zip(proc_list, phys_steps):
+            p.z0 = navi.z0
+            p.chunk_start(z_step)
+            for npass in range(p.n_chunk_passes):
+                for chunk in store.chunks():
+                    p.chunk_reduce(chunk, npass)
+                p.chunk_reduce_end(npass, z_step)
+            for chunk in store.chunks():
+                p.chunk_kick(chunk, z_step)
+        L += dz
+        nstep += 1
+        if nstep % tws_step == 0 or np.abs(navi.z0 - lattice.totalLen) <= 1e-10:
+            tw = envelope()
+            tw.s += L
+            tws_track.append(tw)
+
+        if print_progress:
+            poc_names = [p.__class__.__name__ for p in proc_list]
+            sys.stdout.write("\r" + "z = " + str(navi.z0) + " / " + str(lattice.totalLen) + " : applied: " + ", ".join(poc_names))
+            sys.stdout.flush()
+
+    store.flush()
+
+    # finalize PhysProcesses
+    for p in navi.get_phys_procs():
+        p.finalize()
+
+    return tws_track, store
+
+
+def precision_check(lattice, p_array, navi_func=None, dtype=np.float32, bounds=None):
+    """
+    Validation of the reduced precision tracking. The beam is tracked with float64 and with dtype coordinates
+    and the relative differences of the twiss parameters along the lattice and of the final coordinates are returned.
+
+    :param lattice: MagneticLattice
+    :param p_array: ParticleArray, is not changed
+    :param navi_func: None or function(lattice) which returns new Navigator with the physics processes,
+                    if None Navigator without physics processes is used
+    :param dtype: np.float32, precision which is compared with float64
+    :param bounds: None, optional, [left_bound, right_bound] - bounds for the twiss parameters calculation
+    :return: dict with the maximum relative differences, e.g. {"emit_x": 1e-7, ..., "x": 1e-6, ...}
+    """
+    res = []
+    for dt in [np.float64, dtype]:
+        navi = Navigator(lattice) if navi_func is None else navi_func(lattice)
+        tws_track, p = track(lattice, p_array.astype(dt), navi, print_progress=False, bounds=bounds)
+        res.append((tws_track, p))
+    (tws64, p64), (tws32, p32) = res
+
+    diff = {}
+    for key in ["beta_x", "beta_y", "alpha_x", "alpha_y", "emit_x", "emit_y", "E"]:
+        v64 = np.array([getattr(tw, key) for tw in tws64])
+        v32 = np.array([getattr(tw, key) for tw in tws32])
+        diff[key] = np.max(np.abs(v32 - v64) / (np.abs(v64) + np.abs(np.mean(v64)) + 1e-300))
+    for i, key in enumerate(["x", "px", "y", "py", "tau", "p"]):
+        x64 = p64.rparticles[i]
+        x32 = p32.rparticles[i].astype(np.float64)
+        diff[key] = np.max(np.abs(x32 - x64)) / (np.std(x64) + 1e-300)
+    return diff
+
+
 def lattice_track(lat, p):
     plist = [copy.copy(p)]
 
@@ -8,6 +8,9 @@ Added wake table WakeTableDechirperOffAxis on 11.2019
 from ocelot.adaptors import *
 from ocelot.adaptors.astra2ocelot import *
 from ocelot.cpbd.physics_proc import PhysProc
+from ocelot.cpbd.beam import s_to_grid
+from collections import OrderedDict
+from scipy.fftpack import next_fast_len
 
 import logging
 
@@ -22,10 +25,11 @@ except:
 
 
 def triang_filter(x, filter_order):
-    Ns = x.shape[0]
+    # x can be 2D, the filter is applied to every row
+    Ns = x.shape[-1]
     for i in range(filter_order):
-        x[1:Ns] = (x[1:Ns] + x[0:Ns-1])*0.5
-        x[0:Ns-1] = (x[1:Ns] + x[0:Ns-1])*0.5
+        x[..., 1:Ns] = (x[..., 1:Ns] + x[..., 0:Ns-1])*0.5
+        x[..., 0:Ns-1] = (x[..., 1:Ns] + x[..., 0:Ns-1])*0.5
     return x
 
 
@@ -39,18 +43,15 @@ def Der(x, y):
     return dy
 
 def Int1(x, y):
-    n = x.shape[0]
-    Y = np.zeros(n)
-    for i in range (1,n):
-        Y[i] = Y[i-1]+0.5*(y(i)+y(i-1))*(x(i)-x(i-1))
+    # cumulative integral, trapezoidal rule
+    Y = np.zeros(x.shape[0])
+    Y[1:] = np.cumsum(0.5*(y[1:] + y[:-1])*np.diff(x))
     return Y
 
 def Int1h(h, y):
-    n = y.shape[0]
-    Y = np.zeros(n)
-    # slow, switch to vector operations to be done
-    for i in range(1,n):
-        Y[i] = Y[i-1] + 0.5*(y[i]+y[i-1])
+    # cumulative integral on the equidistant grid with the step h, trapezoidal rule
+    Y = np.zeros(y.shape[0])
+    Y[1:] = np.cumsum(0.5*(y[1:] + y[:-1]))
     Y = Y*h
     return Y
 
@@ -77,7 +78,39 @@ def project_on_grid_py(Ro, I0, dI0, q_array):
 project_on_grid = project_on_grid_py if not nb_flag else nb.jit(project_on_grid_py)
 
 
-def s2current(s_array, q_array, n_points, filter_order, mean_vel):
+def project_on_grid_multi_py(Ro, I0, dI0, q_arrays):
+    """
+    Projection of the particles charges with several weights on grid in one pass over the particles
+
+    :param Ro: (m, n) - grids
+    :param I0: grid index for each particle
+    :param dI0: coefficient how particle close to Ro[i+1], see project_on_grid
+    :param q_arrays: (m, Np) - charges with the different weights in [C]
+    :return: Ro
+    """
+    m = q_arrays.shape[0]
+    Np = q_arrays.shape[1]
+    for i in range(Np):
+        i0 = int(I0[i])
+        di0 = dI0[i]
+        for k in range(m):
+            Ro[k, i0] = Ro[k, i0] + (1 - di0) * q_arrays[k, i]
+            Ro[k, i0 + 1] = Ro[k, i0 + 1] + di0 * q_arrays[k, i]
+    return Ro
+
+
+def project_on_grid_multi_np(Ro, I0, dI0, q_arrays):
+    m, n = Ro.shape
+    inds = (np.arange(m)[:, np.newaxis] * n + I0.astype(int)).ravel()
+    Ro += np.bincount(np.append(inds, inds + 1),
+                      np.append(((1 - dI0) * q_arrays).ravel(), (dI0 * q_arrays).ravel()), m * n).reshape(m, n)
+    return Ro
+
+
+project_on_grid_multi = project_on_grid_multi_np if not nb_flag else nb.jit(nopython=True)(project_on_grid_multi_py)
+
+
+def s2current(s_array, q_array, n_points, filter_order, mean_vel, grid=None):
     """
     I = s2current(P0,q,Ns,NF)
     :param s_array: s-vector, coordinates in longitudinal direction
@@ -85,32 +118,57 @@ def s2current(s_array, q_array, n_points, filter_order, mean_vel):
     :param n_points: number of sampling points
     :param filter_order: filter order
     :param mean_vel: mean velocity
+    :param grid: None or precalculated binning s_to_grid(s_array, n_points, filter_order),
+                e.g. p_array.profile.grid(n_points, filter_order)
     :return:
     """
-    s0 = np.min(s_array)
-    s1 = np.max(s_array)
-    NF2 = int(np.floor(filter_order / 2.))
-    n_points = n_points + 2 * NF2
+    s, I = s2currents(s_array, q_array[np.newaxis, :], n_points, filter_order, mean_vel, grid=grid)
+    return np.c_[s, I[0]]
+
 
-    ds = (s1 - s0) / (n_points - 2 - 2 * NF2)
-    s = s0 + np.arange(-NF2, n_points - NF2) * ds
+def s2currents(s_array, q_arrays, n_points, filter_order, mean_vel, grid=None):
+    """
+    Generalized currents for several charge weights, e.g. q, q*x, q*y, with one pass over the particles
+
+    :param s_array: s-vector, coordinates in longitudinal direction
+    :param q_arrays: (m, Np) - charges with the different weights
+    :param n_points: number of sampling points
+    :param filter_order: filter order
+    :param mean_vel: mean velocity
+    :param grid: None or precalculated binning s_to_grid(s_array, n_points, filter_order)
+    :return: (s, I) - grid and (m, len(s)) array of the currents
+    """
     # here we need a fast 1D linear interpolation of charges on the grid
     # in sc.py we use a fast 3D "near-point" interpolation
     # we need a stand-alone module with 1D,2D,3D particles-to-grid functions
-    Ip = (s_array - s0) / ds
-    I0 = np.floor(Ip)
-    dI0 = Ip - I0
-    I0 = I0 + NF2
-    Ro = np.zeros(n_points)
+    if grid is None:
+        grid = s_to_grid(s_array, n_points, filter_order)
+    s, I0, dI0, ds = grid
+    Ro = np.zeros((q_arrays.shape[0], len(s)))
     # with numba project charge on grid
-    Ro = project_on_grid(Ro, I0, dI0, q_array)
+    Ro = project_on_grid_multi(Ro, I0, dI0, q_arrays)
 
     if filter_order > 0:
         triang_filter(Ro, filter_order)
-    I = np.zeros([n_points, 2])
-    I[:, 0] = s
-    I[:, 1] = Ro * mean_vel / ds
-    return I
+    return s, Ro * mean_vel / ds
+
+
+def interp_on_grid(z, x, F):
+    """
+    Linear interpolation of several functions given on the equidistant grid,
+    the same as np.interp(z, x, F[k], 0, 0) for every k, but the grid indices are found only once
+
+    :param z: points
+    :param x: equidistant grid
+    :param F: (m, len(x)) - functions on the grid
+    :return: (m, len(z)) - interpolated functions
+    """
+    n = x.shape[0]
+    u = (z - x[0]) / (x[1] - x[0])
+    i = np.minimum(np.maximum(np.floor(u).astype(int), 0), n - 2)
+    f = u - i
+    inside = (u >= 0) & (u <= n - 1)
+    return (F[:, i] * (1. - f) + F[:, i + 1] * f) * inside
 
 
 class WakeTable:
@@ -343,7 +401,16 @@ class Wake(PhysProc):
     wake_table = None - wake table [WakeTable()]
     factor = 1. - scaling coefficient
     TH - list from WakeTable, (T, H): T- table of wakes coefs, H - matrix of the coefs place in T
+    spectra_cache_size = 64 - maximal number of the cached FFTs of the wake functions
+
+    The convolutions are done with FFT. The FFTs of the wake functions on the grid are cached with the key
+    (wake function, grid size, grid step), so they are reused while the bunch length does not change,
+    e.g. at high energy. All convolutions of one kick are summed in the frequency domain and transformed back
+    with a single batched inverse FFT.
     """
+    n_chunk_passes = 2
+    changes_tau = False
+
     def __init__(self, step=1):
         PhysProc.__init__(self)
         self.w_sampling = 500  # wake sampling
@@ -353,13 +420,16 @@ class Wake(PhysProc):
         self.factor = 1.
         self.step = step
         self.TH = None
+        self.spectra_cache_size = 64
+        self.wake_spectra = OrderedDict()
 
     def convolution(self, xu, u, xw, w):
         #convolution of equally spaced functions
         hx = xu[1] - xu[0]
-        wc = np.convolve(u, w)*hx
         nw = w.shape[0]
         nu = u.shape[0]
+        nfft = next_fast_len(nw + nu - 1)
+        wc = np.fft.irfft(np.fft.rfft(u, nfft)*np.fft.rfft(w, nfft), nfft)[:nw + nu - 1]*hx
         x0 = xu[0] + xw[0]
         xc = x0 + np.arange(nw + nu)*hx
         return xc, wc
@@ -406,99 +476,194 @@ class Wake(PhysProc):
           W = W - int_bunch*Cinv/c
         return x, W
 
-    def add_total_wake(self, X, Y, Z, q, TH, Ns, NF):
-        T, H = TH
+    def wake_spectrum(self, it, W, xwi, nfft):
+        """
+        FFT of the wake function on the grid. The result is cached.
+
+        :param it: (index of the wake table in T, 0 or 1) - W0 or W1
+        :param W: wake function, W[:, 0] - s, W[:, 1] - wake
+        :param xwi: equidistant grid starting from 0
+        :param nfft: FFT length
+        :return: rfft of the wake function
+        """
+        key = it + (len(xwi), xwi[1], nfft)
+        if key in self.wake_spectra:
+            self.wake_spectra.move_to_end(key)
+            return self.wake_spectra[key]
+        wake1 = np.interp(xwi, W[:, 0], W[:, 1], 0, 0)
+        wake1[0] = wake1[0]*0.5
+        Wf = np.fft.rfft(wake1, nfft)
+        self.wake_spectra[key] = Wf
+        while len(self.wake_spectra) > self.spectra_cache_size:
+            self.wake_spectra.popitem(last=False)
+        return Wf
+
+    def sum_wakes(self, x, currents, terms):
+        """
+        Sum of the wakes of the generalized currents, the same as the sum of add_wake() results.
+        The convolutions of all sums are done in the frequency domain with a single batched inverse FFT.
+
+        :param x: grid
+        :param currents: dict of the generalized currents on the grid
+        :param terms: list of sums, every sum is a list of (current name, index of wake table in T, factor)
+        :return: array (len(terms), len(x)) - wakes in V
+        """
+        T, H = self.TH
         c = speed_of_light
-        Np=X.shape[0]
+        nb = x.shape[0]
+        h = x[1] - x[0]
+        xwi = x - x[0]
+        nfft = next_fast_len(2*nb - 1)
+        spectra = {}
+        derivatives = {}
+
+        def derivative(name):
+            if name not in derivatives:
+                derivatives[name] = Der(x, currents[name])
+            return derivatives[name]
+
+        def spectrum(name, order):
+            if (name, order) not in spectra:
+                y = currents[name] if order == 0 else derivative(name)
+                spectra[(name, order)] = np.fft.rfft(y, nfft)
+            return spectra[(name, order)]
+
+        W = np.zeros((len(terms), nb))
+        Wf = np.zeros((len(terms), nfft//2 + 1), dtype=complex)
+        for k, term in enumerate(terms):
+            for name, it, factor in term:
+                R, L, Cinv, nm, W0, N0, W1, N1 = T[it]
+                bunch = currents[name]
+                if N0 > 0:
+                    Wf[k] -= factor/c*spectrum(name, 0)*self.wake_spectrum((it, 0), W0, xwi, nfft)
+                if N1 > 0:
+                    Wf[k] += factor*spectrum(name, 1)*self.wake_spectrum((it, 1), W1, xwi, nfft)
+                if R != 0:
+                    W[k] -= factor*bunch*R
+                if L != 0:
+                    W[k] += factor*derivative(name)*L*c
+                if Cinv != 0:
+                    W[k] -= factor*Int1(x, bunch)*Cinv/c
+        W += np.fft.irfft(Wf, nfft, axis=1)[:, :nb]*h
+        return W
+
+    def wake_weights(self, X, Y, q, H):
+        """
+        Charge weights of the generalized currents which are needed for the wake table
+
+        :param X: x-coordinates of particles
+        :param Y: y-coordinates of particles
+        :param q: charges of particles
+        :param H: matrix of the coefs place in T, see WakeTable
+        :return: (names, weights) - names of the currents and list of the weights
+        """
         X2 = X**2
         Y2 = Y**2
         XY = X*Y
         #generalized currents;
-        I00 = s2current(Z, q, Ns, NF, c)
-        Nw=I00.shape[0]
+        names = ["00"]
+        weights = [q]
         if (H[0,2]>0)or(H[2,3]>0)or(H[2,4]>0):
-            qn=q*Y
-            I01 = s2current(Z,qn,Ns,NF,c)
+            names.append("01")
+            weights.append(q*Y)
         if (H[0, 1] > 0)or(H[1, 3] > 0) or (H[1, 4] > 0):
-            qn=q*X
-            I10 = s2current(Z,qn,Ns,NF,c)
+            names.append("10")
+            weights.append(q*X)
         if H[1,2]>0:
-            qn=q*XY
-            I11 = s2current(Z,qn,Ns,NF,c)
+            names.append("11")
+            weights.append(q*XY)
         if H[1,1]>0:
-            qn=q*(X2-Y2)
-            I20_02 = s2current(Z, qn, Ns, NF, c)
-        #longitudinal wake
-        #mn=0
-        x, Wz = self.add_wake (I00, T[int(H[0, 0])])
-        if H[0, 1] > 0:
-            x, w = self.add_wake(I10, T[int(H[0, 1])])
-            Wz = Wz+w
-        if H[0,2]>0:
-            x, w = self.add_wake(I01, T[int(H[0, 2])])
-            Wz = Wz+w
-        if H[1,1]>0:
-            x, w = self.add_wake(I20_02, T[int(H[1, 1])])
-            Wz = Wz+w
-        if H[1,2]>0:
-            x, w = self.add_wake(I11, T[int(H[1, 2])])
-            Wz = Wz+2*w
-        Pz = np.interp(Z, x, Wz, 0, 0)
-        Py = np.zeros(Np)
-        Px = np.zeros(Np)
-        #mn=01
-        Wz[0:Nw] = 0
-        Wy = np.zeros(Nw)
-        if H[0, 4] > 0:
-            x, w = self.add_wake(I00, T[int(H[0, 4])])
-            Wz=Wz+w
-            Wy=Wy+w
-        if H[1,4]>0:
-            x, w = self.add_wake(I10, T[int(H[1, 4])])
-            Wz = Wz + 2*w
-            Wy = Wy + 2*w
-        if H[2,4]>0:
-            x, w = self.add_wake(I01, T[int(H[2, 4])])
-            Wz = Wz + 2*w
-            Wy = Wy + 2*w
-        Pz = Pz + np.interp(Z, x, Wz, 0, 0)*Y
+            names.append("20_02")
+            weights.append(q*(X2-Y2))
+        return names, weights
+
+    def wake_fields(self, x, I, names, H):
+        """
+        Wakes of the generalized currents on the grid
+
+        :param x: grid
+        :param I: (m, len(x)) - generalized currents, see s2currents()
+        :param names: names of the currents, see wake_weights()
+        :param H: matrix of the coefs place in T, see WakeTable
+        :return: list of the wakes on the grid, see wake_kicks()
+        """
+        currents = dict(zip(names, I))
+
+        def term(mn, name, factor=1):
+            return [(name, int(H[mn]), factor)] if H[mn] > 0 else []
+
+        terms = [
+            #mn=0, longitudinal wake
+            [("00", int(H[0, 0]), 1)] + term((0, 1), "10") + term((0, 2), "01") + term((1, 1), "20_02") +
+            term((1, 2), "11", 2),
+            #mn=01
+            term((0, 4), "00") + term((1, 4), "10", 2) + term((2, 4), "01", 2),
+            #mn=10
+            term((0, 3), "00") + term((1, 3), "10", 2) + term((2, 3), "01", 2),
+            #mn=11
+            term((3, 4), "00"),
+            #mn=02,20
+            term((3, 3), "00")]
+        Wz, W01, W10, W11, W20 = self.sum_wakes(x, currents, terms)
         h = x[1] - x[0]
-        Wy = -Int1h(h, Wy)
-        Py = Py + np.interp(Z, x, Wy, 0, 0)
+        Wy = -Int1h(h, W01)
+        Wx = -Int1h(h, W10)
+        W = [Wz, W01, Wy, W10, Wx]
+        if H[3,4]>0:
+            W += [W11, -2*Int1h(h, W11)]
+        if H[3,3]>0:
+            W += [W20, -2*Int1h(h, W20)]
+        return W
+
+    def wake_kicks(self, X, Y, Z, x, W, H):
+        """
+        Kicks of the particles from the wakes on the grid
+
+        :param X: x-coordinates of particles
+        :param Y: y-coordinates of particles
+        :param Z: s-coordinates of particles
+        :param x: grid
+        :param W: wakes on the grid, see wake_fields()
+        :param H: matrix of the coefs place in T, see WakeTable
+        :return: (Px, Py, Pz) in V
+        """
+        X2 = X**2
+        Y2 = Y**2
+        XY = X*Y
+        P = interp_on_grid(Z, x, np.array(W))
+
+        Pz = P[0]
+        #mn=01
+        Pz = Pz + P[1]*Y
+        Py = P[2]
         #mn=10
-        Wz[0:Nw] = 0
-        Wx = np.zeros(Nw)
-        if H[0, 3] > 0:
-            x, w = self.add_wake(I00, T[int(H[0, 3])])
-            Wz = Wz + w
-            Wx = Wx + w
-        if H[1,3]>0:
-            x, w = self.add_wake(I10, T[int(H[1, 3])])
-            Wz = Wz + 2*w
-            Wx = Wx + 2*w
-        if H[2,3]>0:
-            x, w = self.add_wake(I01, T[int(H[2, 3])])
-            Wz = Wz + 2*w
-            Wx = Wx + 2*w
-        Wx=-Int1h(h,Wx)
-        Pz = Pz + np.interp(Z, x, Wz, 0, 0)*X
-        Px = Px + np.interp(Z, x, Wx, 0, 0)
+        Pz = Pz + P[3]*X
+        Px = P[4]
         #mn=11
         if H[3,4]>0:
-            x, w = self.add_wake(I00, T[int(H[3, 4])])
-            Wx=-2*Int1h(h,w)
-            p=np.interp(Z,x,Wx,0,0)
+            p = P[6]
             Px = Px + p*Y
             Py = Py + p*X
-            Pz = Pz + 2*np.interp(Z, x, w, 0, 0)*XY
+            Pz = Pz + 2*P[5]*XY
         #mn=02,20
         if H[3,3]>0:
-            x, w = self.add_wake(I00, T[int(H[3, 3])])
-            Pz = Pz+np.interp(Z,x,w,0,0)*(X2-Y2)
-            Wx = -2*Int1h(h,w)
-            p = np.interp(Z,x,Wx,0,0)
+            Pz = Pz+P[-2]*(X2-Y2)
+            p = P[-1]
             Px = Px + p*X
             Py = Py - p*Y
+        return Px, Py, Pz
+
+    def add_total_wake(self, X, Y, Z, q, TH, Ns, NF, grid=None):
+        T, H = TH
+        if self.TH is not TH:
+            self.TH = TH
+            self.wake_spectra.clear()
+        c = speed_of_light
+        names, weights = self.wake_weights(X, Y, q, H)
+        x, I = s2currents(Z, np.array(weights), Ns, NF, c, grid=grid)
+        I00 = np.c_[x, I[0]]
+        W = self.wake_fields(x, I, names, H)
+        Px, Py, Pz = self.wake_kicks(X, Y, Z, x, W, H)
         I00[:,0] =- I00[:,0]
         #Z=-Z
         return Px, Py, Pz, I00
@@ -508,13 +673,19 @@ class Wake(PhysProc):
             _logger.info("Wake.wake_table is None! Please specify the WakeTable()")
         else:
             self.TH = self.wake_table.TH
+        self.wake_spectra.clear()
 
-    def apply(self, p_array, dz):
-        _logger.debug(" Wake: apply: dz = " + str(dz))
-
-        ps = p_array.rparticles
-        Px, Py, Pz, I00 = self.add_total_wake(ps[0], ps[2], ps[4], p_array.q_array, self.TH, self.w_sampling, self.filter_order)
+    def kick(self, p_array, Px, Py, Pz, dz):
+        """
+        Application of the kicks from add_total_wake() or wake_kicks() with the step dz
 
+        :param p_array: ParticleArray
+        :param Px: kicks in V
+        :param Py:
+        :param Pz:
+        :param dz: step
+        :return:
+        """
         L = self.s_stop - self.s_start
         if L == 0:
             dz = 1.0
@@ -525,9 +696,59 @@ class Wake(PhysProc):
         p_array.rparticles[3] = p_array.rparticles[3] + Py * dz*self.factor / (p_array.E * 1e9)
         p_array.rparticles[1] = p_array.rparticles[1] + Px * dz*self.factor / (p_array.E * 1e9)
 
+    def apply(self, p_array, dz):
+        _logger.debug(" Wake: apply: dz = " + str(dz))
+
+        ps = p_array.rparticles
+        grid = p_array.profile.grid(self.w_sampling, self.filter_order)
+        Px, Py, Pz, I00 = self.add_total_wake(ps[0], ps[2], ps[4], p_array.q_array, self.TH, self.w_sampling,
+                                              self.filter_order, grid=grid)
+        self.kick(p_array, Px, Py, Pz, dz)
+
+    def chunk_start(self, dz):
+        """
+        Out-of-core tracking, see PhysProc. Pass 0 - bounds of the beam, pass 1 - deposition of the generalized
+        currents on the grid of the whole beam, then the wakes are calculated and applied chunk by chunk.
+        """
+        self.chunk_data = {"min": np.inf, "max": -np.inf, "Ro": None}
+
+    def chunk_reduce(self, p_array, npass):
+        d = self.chunk_data
+        if p_array.n == 0:
+            return
+        ps = p_array.rparticles
+        if npass == 0:
+            d["min"] = min(d["min"], np.min(ps[4]))
+            d["max"] = max(d["max"], np.max(ps[4]))
+            return
+        s, I0, dI0, ds = s_to_grid(ps[4], self.w_sampling, self.filter_order, d["min"], d["max"])
+        d["names"], weights = self.wake_weights(ps[0], ps[2], p_array.q_array, self.TH[1])
+        if d["Ro"] is None:
+            d["Ro"] = np.zeros((len(weights), len(s)))
+            d["s"] = s
+            d["ds"] = ds
+        project_on_grid_multi(d["Ro"], I0, dI0, np.array(weights))
+
+    def chunk_reduce_end(self, npass, dz):
+        d = self.chunk_data
+        if npass == 0 or d["Ro"] is None:
+            return
+        Ro = d["Ro"]
+        if self.filter_order > 0:
+            triang_filter(Ro, self.filter_order)
+        I = Ro * speed_of_light / d["ds"]
+        d["W"] = self.wake_fields(d["s"], I, d["names"], self.TH[1])
+
+    def chunk_kick(self, p_array, dz):
+        ps = p_array.rparticles
+        Px, Py, Pz = self.wake_kicks(ps[0], ps[2], ps[4], self.chunk_data["s"], self.chunk_data["W"], self.TH[1])
+        self.kick(p_array, Px, Py, Pz, dz)
+
 
 
 class WakeKick(Wake):
+    n_chunk_passes = None
+
     def __init__(self, factor=1):
         print("WakeKick physics process is obsolete. Use Wake.")
         Wake.__init__(self)
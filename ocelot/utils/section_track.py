@@ -4,6 +4,7 @@ S.Tomin. XFEL/DESY. 2017
 """
 from ocelot import *
 from ocelot.adaptors.astra2ocelot import *
+from ocelot.cpbd.io import BeamWriter
 import numpy as np
 import copy
 
@@ -105,6 +106,7 @@ class SectionLattice:
                 p_array = None
             p_array = sec.tracking(particles=p_array)
             #twis_track.append(sec.load_twiss_file())
+        SectionTrack.beam_writer.flush()
         return p_array
 
     def load_twiss_track(self, sections):
@@ -126,6 +128,9 @@ class SectionLattice:
 
 
 class SectionTrack:
+    # beam files of all sections are written in one background thread, see save_beam_file()
+    beam_writer = BeamWriter()
+
     def __init__(self, data_dir, *args, **kwargs):
 
         self.lattice_name = ""
@@ -141,6 +146,7 @@ class SectionTrack:
         self.input_beam_file = None
         self.output_beam_file = None
         self.tws_file = None
+        self.background_io = False  # if True, output beam file is written in the background thread
 
         #self.data_dir = "."
         self.particle_dir = data_dir + "/particles/"
@@ -315,6 +321,8 @@ class SectionTrack:
         self.physics_processes_array.append([physics_process, start, stop])
 
     def read_beam_file(self):
+        # the input file can be the output file of the previous section which is still being written
+        SectionTrack.beam_writer.flush()
 
         particles = None
         #print(self.input_beam_file)
@@ -338,8 +346,10 @@ class SectionTrack:
         return particles
 
     def save_beam_file(self, particles):
-
-        save_particle_array(self.output_beam_file, particles)
+        if self.background_io:
+            SectionTrack.beam_writer.save(self.output_beam_file, particles)
+        else:
+            save_particle_array(self.output_beam_file, particles)
 
     def save_twiss_file(self, twiss_list):
         if self.tws_file == None:
@@ -347,6 +347,58 @@ def test_track_undulator_endings_with_csr(lattice, p_array, parameter=None, upda
     assert check_result(result1 + result2)
 
 
+def test_csr_kernel_cache(lattice, p_array, parameter=None, update_ref_values=False):
+    """CSR kernels from the cache vs the kernels calculated directly"""
+
+    csr = CSR()
+    navi = Navigator(lattice)
+    navi.add_physics_proc(csr, lattice.sequence[0], lattice.sequence[-1])
+    traj = csr.csr_traj
+    gamma = p_array.E / m_e_GeV
+    i = int(traj.shape[1] * 0.6)
+    st = 2.5e-5
+
+    K1 = csr.CSR_K1(i, traj, [300, st], gamma)
+    # kernel of the shorter mesh is the tail of the cached kernel
+    K1_short = csr.CSR_K1(i, traj, [150, st], gamma)
+    n_cache = len(csr.kernel_cache)
+    csr.clear_kernel_cache()
+    K1_short_ref = csr.CSR_K1(i, traj, [150, st], gamma)
+
+    # rescaled kernel of the quantized mesh step
+    csr.kernel_tol = 1e-2
+    csr.CSR_K1(i, traj, [300, st], gamma)
+    K1_tol = csr.CSR_K1(i, traj, [300, st * 1.002], gamma)
+    csr.kernel_tol = 0.
+    K1_ref = csr.CSR_K1(i, traj, [300, st * 1.002], gamma)
+    dK1 = np.linalg.norm(K1_tol - K1_ref) / np.linalg.norm(K1_ref)
+
+    result1 = check_matrix(K1_short, K1_short_ref, tolerance=1.0e-12, tolerance_type='relative', assert_info=' K1 - ')
+    result2 = check_value(n_cache, 1, assert_info=' cache size - ')
+    result3 = check_value(len(K1), 301, assert_info=' K1 length - ')
+    result4 = check_value(dK1, 0, tolerance=2.0e-2, tolerance_type='absolute', assert_info=' rescaled K1 - ')
+    assert check_result(result1 + [result2, result3, result4])
+
+
+def test_csr_kernel_multi(lattice, p_array, parameter=None, update_ref_values=False):
+    """batched CSR kernel calculation vs the kernels calculated one by one"""
+
+    csr = CSR()
+    navi = Navigator(lattice)
+    navi.add_physics_proc(csr, lattice.sequence[0], lattice.sequence[-1])
+    traj = csr.csr_traj
+    gamma = p_array.E / m_e_GeV
+    indices = np.arange(int(traj.shape[1] * 0.3), int(traj.shape[1] * 0.3) + 20, 3)
+    Ndw = [300, 2.5e-5]
+
+    K1s = csr.CSR_K1_multi(indices, traj, Ndw, gamma)
+    csr.clear_kernel_cache()
+    K1s_ref = [csr.CSR_K1(i, traj, Ndw, gamma) for i in indices]
+
+    result = check_matrix(np.array(K1s), np.array(K1s_ref), tolerance=1.0e-12, tolerance_type='relative', assert_info=' K1 - ')
+    assert check_result(result)
+
+
 def setup_module(module):
 
     f = open(pytest.TEST_RESULTS_FILE, 'a')
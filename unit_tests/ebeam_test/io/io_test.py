@@ -1,7 +1,9 @@
 """Test of the demo file demos/ebeam/csr_ex.py"""
 from ocelot.adaptors.astra2ocelot import exact_xxstg_2_xp_mad, exact_xp_2_xxstg_mad
+import io
 import os
 import sys
+import shutil
 import copy
 import time
 
@@ -11,6 +13,9 @@ REF_RES_DIR = FILE_DIR + '/ref_results/'
 from unit_tests.params import *
 
 from io_conf import *
+import ocelot.cpbd.io
+from ocelot.cpbd.io import load_particle_array_from_hdf5
+from ocelot.common.py_func import format_e7, read_text_array, write_text_array
 
 
 
@@ -34,6 +39,92 @@ def test_npz(p_array, parameter=None, update_ref_values=False):
     assert check_result(result2 )
 
 
+def test_npyd(p_array, parameter=None, update_ref_values=False):
+    """
+    save/load of the beam in the uncompressed directory, the loaded beam is memory-mapped in copy-on-write mode
+    """
+
+    p_array_ref = copy.deepcopy(p_array)
+
+    save_particle_array("test.npyd", p_array)
+    p_array_reload = load_particle_array("test.npyd")
+    mapped = isinstance(p_array_reload.rparticles.base, np.memmap)
+
+    p_rel = obj2dict(p_array_reload)
+    p_ref = obj2dict(p_array_ref)
+    result1 = check_dict(p_rel, p_ref, tolerance=TOL, assert_info=' p - ')
+
+    p_array_reload.rparticles[0] += 1.
+    p_array_reload2 = load_particle_array("test.npyd")
+    result2 = check_matrix(p_array_reload2.rparticles, p_array_ref.rparticles, tolerance=TOL,
+                           assert_info=' copy-on-write - ')
+    del p_array_reload, p_array_reload2
+
+    # modified beam is saved to the directory it is mapped from
+    p_array_reload = load_particle_array("test.npyd")
+    p_array_reload.rparticles[0] += 1.
+    save_particle_array("test.npyd", p_array_reload)
+    p_array_reload2 = load_particle_array("test.npyd")
+    result3 = check_matrix(p_array_reload2.rparticles, p_array_reload.rparticles, tolerance=TOL,
+                           assert_info=' resave - ')
+    result3 += check_matrix(p_array_reload.rparticles[1:], p_array_ref.rparticles[1:], tolerance=TOL,
+                            assert_info=' mapped beam after resave - ')
+    del p_array_reload, p_array_reload2
+    shutil.rmtree("test.npyd")
+    assert check_result(result1 + result2 + result3 + [None if mapped else "ParticleArray is not memory-mapped"])
+
+
+@pytest.mark.skipif(not ocelot.cpbd.io.h5py_flag, reason="h5py is not installed")
+def test_hdf5(p_array, parameter=None, update_ref_values=False):
+    """
+    save/load of the beam in HDF5 format and partial reads
+    """
+
+    p_array_ref = copy.deepcopy(p_array)
+
+    save_particle_array("test.h5", p_array)
+    p_array_reload = load_particle_array("test.h5")
+
+    p_rel = obj2dict(p_array_reload)
+    p_ref = obj2dict(p_array_ref)
+    result1 = check_dict(p_rel, p_ref, tolerance=TOL, assert_info=' p - ')
+
+    tau_min, tau_max = np.mean(p_array.tau()), np.max(p_array.tau())
+    p_part = load_particle_array_from_hdf5("test.h5", coordinates=["x", "tau"], nth=3, tau_range=(tau_min, tau_max),
+                                           block_size=1000)
+    inds = np.arange(0, p_array.n, 3)
+    inds = inds[np.logical_and(p_array.tau()[inds] >= tau_min, p_array.tau()[inds] < tau_max)]
+    os.remove("test.h5")
+
+    result2 = check_matrix(p_part.rparticles, np.array([p_array.x()[inds], 0 * inds, 0 * inds, 0 * inds,
+                                                        p_array.tau()[inds], 0 * inds]),
+                           tolerance=TOL, tolerance_type='absolute', assert_info=' rparticles - ')
+    result3 = [check_value(np.sum(p_part.q_array), np.sum(p_array.q_array[inds]) * 3, tolerance=1.0e-12,
+                           assert_info=' charge - ')]
+    assert check_result(result1 + result2 + result3)
+
+
+def test_write_text_array(p_array, parameter=None, update_ref_values=False):
+    """
+    vectorized text formatting gives the same file as np.savetxt(fmt='%.7e')
+    """
+    data = np.vstack((p_array.rparticles, p_array.q_array)).T
+    data[0, :4] = [0., -0., 100000005., 9.99999995e5]
+    data[1, :3] = [1e-99, 9.9999999999e7, 2 ** -16]
+
+    np.savetxt("test_savetxt.txt", data, fmt='%.7e')
+    write_text_array("test_fast.txt", data, block_size=3000)
+    with open("test_savetxt.txt", "rb") as f1, open("test_fast.txt", "rb") as f2:
+        identical = f1.read() == f2.read()
+    data_reload = read_text_array("test_fast.txt")
+    os.remove("test_savetxt.txt")
+    os.remove("test_fast.txt")
+
+    result = check_matrix(data_reload, np.loadtxt(io.StringIO(format_e7(data).decode())), tolerance=TOL,
+                          assert_info=' data - ')
+    assert check_result(result + [None if identical else "files are different"])
+
+
 def test_ast_mad_transf(p_array, parameter=None, update_ref_values=False):
     """
     testing applying one marker as start ans stop
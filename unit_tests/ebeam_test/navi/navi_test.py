@@ -404,6 +404,47 @@ def test_kick_with_one_elem(lattice, p_array, parameter=None, update_ref_values=
     assert check_result([result0] + result1 + result2 + result3 + result4 + result5)
 
 
+def test_adaptive_step(lattice, p_array, parameter=None, update_ref_values=False):
+    """
+    test adaptive step of physProc with constant beam quantity and kick process inside
+    """
+
+    p_array_track = copy.deepcopy(p_array)
+
+    navi = Navigator(lattice)
+    navi.unit_step = 0.05
+
+    t = LogProc()
+    t.adaptive_step = AdaptiveStep(step_min=1, step_max=4, rel_change=0.01, quantity=lambda p_array: 1.)
+    t_kick = LogProc()
+    navi.add_physics_proc(t, start, stop)
+    navi.add_physics_proc(t_kick, m_kick, m_kick)
+
+    tws_track_wo, p_array_wo = track(lattice, p_array_track, navi, calc_tws=False)
+    step = t.step
+    navi.go_to_start()
+
+    result1 = check_matrix(np.array(t.dz_list), np.array([0.05, 0.05, 0.1, 0.1, 0.2, 0.2, 0.2, 0.2, 0.2, 0.15]), tolerance=TOL, assert_info=' dz - ')
+    result2 = check_matrix(np.array(t.s_list), np.array([0.05, 0.1, 0.2, 0.3, 0.5, 0.7, 0.9, 1.1, 1.3, 1.45]), tolerance=TOL, assert_info=' p.s - ')
+    result3 = check_matrix(np.array([step, t.step, t.counter]), np.array([4, 1, 1]), tolerance=TOL, assert_info=' step - ')
+    assert check_result(result1 + result2 + result3)
+
+
+def test_transfer_R_steps(lattice, p_array, parameter=None, update_ref_values=False):
+    """
+    test incremental transfer matrices of the steps vs transfer matrices from the current position
+    """
+    navi = Navigator(lattice)
+    navi.go_to_start()
+    dz = 0.07
+    nsteps = int(lattice.totalLen / dz) + 3
+    R_steps = [R for k, R in zip(range(nsteps), navi.transfer_R_steps(dz, p_array.E))]
+    R_ref = [navi.transfer_R((k + 1) * dz, p_array.E) for k in range(nsteps)]
+    result = check_matrix(np.array(R_steps).flatten(), np.array(R_ref).flatten(), tolerance=1.0e-10,
+                          tolerance_type='absolute', assert_info=' R - ')
+    assert check_result(result)
+
+
 def setup_module(module):
 
     f = open(pytest.TEST_RESULTS_FILE, 'a')
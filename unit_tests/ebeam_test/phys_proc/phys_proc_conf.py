@@ -7,6 +7,7 @@ from ocelot import *
 from ocelot.cpbd.beam import generate_parray
 from ocelot.utils.acc_utils import chicane_RTU
 from ocelot.cpbd.sc import LSC
+from ocelot.cpbd.physics_proc import SaveBeam
 from ocelot.cpbd.wake3D import s2current
 
 """Lattice elements definition"""
@@ -4,12 +4,19 @@ import os
 import sys
 import copy
 import time
+import json
+import pickle
+import tracemalloc
 
 FILE_DIR = os.path.dirname(os.path.abspath(__file__))
 REF_RES_DIR = FILE_DIR + '/ref_results/'
 
 from unit_tests.params import *
 from phys_proc_conf import *
+from ocelot.cpbd.beam import s_to_cur, slice_analysis, moving_window_np, smooth_sorted, smooth_sorted_np
+from ocelot.cpbd.beam import envelope_coordinates, envelope_coordinates_np
+from ocelot.cpbd.wake3D import Int1, Int1h, s2currents, interp_on_grid, project_on_grid_multi_np
+from ocelot.cpbd.track import set_tracking_state
 
 
 def test_generate_parray(lattice, p_array, parameter=None, update_ref_values=False):
@@ -332,6 +339,509 @@ def test_dechirper_offaxis(lattice, p_array, parameter=None, update_ref_values=F
     assert check_result(result1 + result2)
 
 
+def test_wake_convolution(lattice, p_array, parameter=None, update_ref_values=False):
+    """batched FFT wake convolution vs the sum of add_wake() and the direct convolution"""
+
+    wake_table = WakeTableDechirperOffAxis(b=500 * 1e-6)
+    T, H = wake_table.TH
+    ws = Wake()
+    ws.TH = wake_table.TH
+    ps = p_array.rparticles
+    I00 = s2current(ps[4], p_array.q_array, 300, 10, speed_of_light)
+    x = I00[:, 0]
+
+    W = ws.sum_wakes(x, {"00": I00[:, 1]}, [[("00", int(H[0, 0]), 1), ("00", int(H[0, 3]), 2)]])[0]
+    x1, w1 = ws.add_wake(I00, T[int(H[0, 0])])
+    x2, w2 = ws.add_wake(I00, T[int(H[0, 3])])
+
+    xw = np.linspace(0, 1, 50)
+    w = np.exp(-xw)
+    xc, wc = ws.convolution(x, I00[:, 1], xw, w)
+    h = x[1] - x[0]
+
+    result1 = check_matrix(W, w1 + 2 * w2, tolerance=1.0e-10 * np.max(np.abs(W)), tolerance_type='absolute', assert_info=' W - ')
+    result2 = check_matrix(wc, np.convolve(I00[:, 1], w) * h, tolerance=1.0e-10 * np.max(np.abs(wc)), tolerance_type='absolute', assert_info=' conv - ')
+    result3 = check_matrix(Int1(xw, w), 1 - np.exp(-xw), tolerance=1.0e-4, tolerance_type='absolute', assert_info=' Int1 - ')
+    result4 = check_matrix(Int1h(xw[1], w), Int1(xw, w), tolerance=1.0e-12, tolerance_type='absolute', assert_info=' Int1h - ')
+    assert check_result(result1 + result2 + result3 + result4)
+
+
+def test_wake_multi_currents(lattice, p_array, parameter=None, update_ref_values=False):
+    """fused deposition of the generalized currents and interpolation on the grid vs s2current and np.interp"""
+
+    ps = p_array.rparticles
+    q = p_array.q_array
+    q_arrays = np.array([q, q * ps[0], q * ps[2], q * ps[0] * ps[2]])
+    x, I = s2currents(ps[4], q_arrays, 300, 10, speed_of_light)
+
+    I_ref = np.array([s2current(ps[4], qn, 300, 10, speed_of_light)[:, 1] for qn in q_arrays])
+    Ro_np = project_on_grid_multi_np(np.zeros((4, 10)), np.array([0, 3, 8, 3]), np.array([0.5, 0.1, 1., 0.]), np.ones((4, 4)))
+    Ro_ref = np.zeros(10)
+    Ro_ref[[0, 1, 3, 4, 9]] = [0.5, 0.5, 1.9, 0.1, 1.]
+
+    z = np.linspace(x[0] - 1e-5, x[-1] + 1e-5, 1001)
+    P = interp_on_grid(z, x, I)
+    P_ref = np.array([np.interp(z, x, Ik, 0, 0) for Ik in I])
+
+    result1 = check_matrix(I, I_ref, tolerance=1.0e-12 * np.max(np.abs(I)), tolerance_type='absolute', assert_info=' I - ')
+    result2 = check_matrix(Ro_np, np.tile(Ro_ref, (4, 1)), tolerance=1.0e-12, tolerance_type='absolute', assert_info=' Ro - ')
+    result3 = check_matrix(P, P_ref, tolerance=1.0e-12 * np.max(np.abs(I)), tolerance_type='absolute', assert_info=' interp - ')
+    assert check_result(result1 + result2 + result3)
+
+
+def test_beam_profile(lattice, p_array, parameter=None, update_ref_values=False):
+    """shared longitudinal profile of ParticleArray and its invalidation after change of tau"""
+
+    tau = p_array.tau()
+    inds = p_array.profile.argsort()
+    B = p_array.profile.current(sigma=0.05 * np.std(tau))
+    s, I0, dI0, ds = p_array.profile.grid(300, 10)
+
+    result1 = check_matrix(tau[inds], np.sort(tau), tolerance=1.0e-15, tolerance_type='absolute', assert_info=' sort - ')
+    result2 = check_matrix(B, s_to_cur(tau, 0.05 * np.std(tau), np.sum(p_array.q_array), speed_of_light),
+                           tolerance=1.0e-12, tolerance_type='relative', assert_info=' current - ')
+    result3 = check_matrix(np.c_[s, s2currents(tau, p_array.q_array[np.newaxis, :], 300, 10, speed_of_light, grid=(s, I0, dI0, ds))[1][0]],
+                           s2current(tau, p_array.q_array, 300, 10, speed_of_light),
+                           tolerance=1.0e-12, tolerance_type='relative', assert_info=' grid - ')
+    cached = p_array.profile.argsort() is inds
+    p_array.rparticles[5] += 0.01
+    cached = cached and p_array.profile.argsort() is inds
+    p_array.rparticles[4] *= -1
+    changed = p_array.profile.argsort() is not inds
+    result4 = check_matrix(p_array.tau()[p_array.profile.argsort()], np.sort(p_array.tau()), tolerance=1.0e-15,
+                           tolerance_type='absolute', assert_info=' sort after update - ')
+    # in-place change of a part of the particles, modified() without tau keeps the profile
+    inds = p_array.profile.argsort()
+    p_array.tau()[1::7] += 0.3 * np.std(p_array.tau())
+    partial = p_array.profile.argsort() is not inds
+    p_array.in_tracking = True
+    inds = p_array.profile.argsort()
+    p_array.modified(tau=False)
+    kept = p_array.profile.argsort() is inds
+    p_array.modified()
+    reset = p_array.profile.argsort() is not inds
+    p_array.in_tracking = False
+    result6 = check_matrix(p_array.tau()[p_array.profile.argsort()], np.sort(p_array.tau()), tolerance=1.0e-15,
+                           tolerance_type='absolute', assert_info=' sort after partial update - ')
+    result5 = [] if cached and changed and partial and kept and reset else [" cache is not updated correctly "]
+    assert check_result(result1 + result2 + result3 + result4 + result5 + result6)
+
+
+def test_moving_window_kernels(lattice, p_array, parameter=None, update_ref_values=False):
+    """vectorized moving window kernels of slice_analysis and SmoothBeam vs direct loops"""
+
+    z = np.sort(p_array.tau()[:2000])
+    x = p_array.x()[:2000]
+    N = len(z)
+
+    c = np.cumsum(x)
+    m = 50.
+    mx_ref = np.array([(c[min(N - 1, i + 50)] - c[max(0, i - 50)]) / (min(N - 1, i + 50) - max(0, i - 50)) for i in range(N)])
+
+    S = np.append(0, np.cumsum(z))
+    A = 0.5 * 300
+    z_ref = np.copy(z)
+    for i in range(1, N - 1):
+        xi = 0.5 * min(i, N - i + 1)
+        k = int(np.floor((xi - xi * xi / (4 * A) if xi < 2 * A else A) + 0.500001))
+        z_ref[i] = (S[i + k + 1] - S[i - k]) / (2 * k + 1)
+
+    mx = slice_analysis(z, x, x, 2 * m, False)[0]
+    result1 = check_matrix(moving_window_np(c, m), mx_ref, tolerance=1.0e-15, tolerance_type='absolute', assert_info=' window np - ')
+    result2 = check_matrix(mx, mx_ref, tolerance=1.0e-15, tolerance_type='absolute', assert_info=' window - ')
+    result3 = check_matrix(smooth_sorted_np(z, 300), z_ref, tolerance=1.0e-15, tolerance_type='absolute', assert_info=' smooth np - ')
+    result4 = check_matrix(smooth_sorted(z, 300), z_ref, tolerance=1.0e-15, tolerance_type='absolute', assert_info=' smooth - ')
+    assert check_result(result1 + result2 + result3 + result4)
+
+
+def test_track_checkpoint_resume(lattice, p_array, parameter=None, update_ref_values=False):
+    """tracking resumed from the last checkpoint vs uninterrupted tracking"""
+
+    filename = FILE_DIR + "/checkpoint.tmp"
+
+    navi = Navigator(lattice)
+    navi.unit_step = 0.1
+    lsc = LSC()
+    lsc.smooth_param = 0.1
+    navi.add_physics_proc(lsc, lattice.sequence[0], lattice.sequence[-1])
+
+    checkpoint = Checkpoint(filename, n_steps=5, background=True)
+    tws_track, p_array_track = track(lattice, copy.deepcopy(p_array), navi, print_progress=False,
+                                     checkpoint=checkpoint)
+
+    navi = Navigator(lattice)
+    navi.unit_step = 0.1
+    lsc = LSC()
+    lsc.smooth_param = 0.1
+    navi.add_physics_proc(lsc, lattice.sequence[0], lattice.sequence[-1])
+
+    tws_resume, p_array_resume = resume(lattice, navi, filename, print_progress=False)
+    os.remove(filename)
+
+    result1 = check_matrix(p_array_resume.rparticles, p_array_track.rparticles, tolerance=1.0e-14,
+                           tolerance_type='absolute', assert_info=' rparticles - ')
+    result2 = check_matrix(np.array([tw.s for tw in tws_resume]), np.array([tw.s for tw in tws_track]),
+                           tolerance=1.0e-12, tolerance_type='absolute', assert_info=' s - ')
+
+    # adaptive step with the function is saved, the exception of the background writing is raised
+    def navi_adaptive():
+        navi = Navigator(lattice)
+        navi.unit_step = 0.1
+        lsc = LSC()
+        lsc.adaptive_step = AdaptiveStep(step_max=5, quantity=lambda p: np.std(p.tau()))
+        navi.add_physics_proc(lsc, lattice.sequence[0], lattice.sequence[-1])
+        return navi
+
+    navi = navi_adaptive()
+    track(lattice, copy.deepcopy(p_array), navi, print_progress=False, calc_tws=False,
+          checkpoint=Checkpoint(filename, n_steps=5))
+    navi_res = navi_adaptive()
+    with open(filename, "rb") as f:
+        state = pickle.load(f)
+    set_tracking_state(state, navi_res)
+    os.remove(filename)
+    adaptive = navi_res.process_table.proc_list[0].adaptive_step
+    restored = adaptive.value == state["procs"][0]["adaptive_step"]["value"] and callable(adaptive.quantity)
+
+    try:
+        track(lattice, copy.deepcopy(p_array), navi_adaptive(), print_progress=False, calc_tws=False,
+              checkpoint=Checkpoint(FILE_DIR + "/no_dir/checkpoint.tmp", n_steps=5))
+        raised = False
+    except FileNotFoundError:
+        raised = True
+    result3 = [None if restored and raised else " adaptive step or exception of the checkpoint - "]
+    assert check_result(result1 + result2 + result3)
+
+
+def test_track_profiler(lattice, p_array, parameter=None, update_ref_values=False):
+    """profiler statistics and trace of the tracking with LSC"""
+
+    filename = FILE_DIR + "/trace.tmp"
+
+    navi = Navigator(lattice)
+    navi.unit_step = 0.1
+    lsc = LSC()
+    navi.add_physics_proc(lsc, lattice.sequence[0], lattice.sequence[-1])
+
+    profiler = TrackProfiler(timeline=True, memory=True)
+    tws_track, p_array_track = track(lattice, copy.deepcopy(p_array), navi, print_progress=False, profiler=profiler)
+    profiler.save_trace(filename)
+    with open(filename) as f:
+        events = json.load(f)["traceEvents"]
+    os.remove(filename)
+
+    types = profiler.stats("type")
+    elements = profiler.stats("element")
+    procs = profiler.stats("process")
+    ids = set([elem.id for elem in lattice.sequence if elem.l > 0])
+
+    result1 = [None] if procs["LSC"]["calls"] == len(tws_track) - 1 else [" number of LSC calls "]
+    result2 = [None] if profiler.stats("other")["get_envelope"]["calls"] == len(tws_track) - 1 else [" number of get_envelope calls "]
+    result3 = [None] if np.sum([r["calls"] for r in types.values()]) == np.sum([r["calls"] for r in elements.values()]) else [" element calls "]
+    result4 = [None] if ids.issubset(elements.keys()) and "SBend" in types else [" elements are missing "]
+    result5 = [None] if len(events) == np.sum([r["calls"] for g in ("type", "process", "other") for r in profiler.stats(g).values()]) else [" trace events "]
+    result6 = [None] if procs["LSC"]["peak_bytes"] > 0 and len(profiler.table("process").split("\n")) == 2 else [" table or memory "]
+    result7 = [None] if not tracemalloc.is_tracing() else [" tracemalloc is not stopped "]
+    assert check_result(result1 + result2 + result3 + result4 + result5 + result6 + result7)
+
+
+def test_beam_moments(lattice, p_array, parameter=None, update_ref_values=False):
+    """get_envelope and chunked BeamMoments vs direct calculation of the moments"""
+
+    tws_i = Twiss()
+    tws_i.Dx = 0.2
+    tws_i.Dxp = 0.01
+    disp = np.array([tws_i.Dx, tws_i.Dxp, tws_i.Dy, tws_i.Dyp])
+    X = envelope_coordinates(p_array.rparticles, disp, np.empty(0, dtype=bool))
+    tau = p_array.tau()
+    inds = np.abs(tau - np.mean(tau)) <= np.std(tau)
+
+    x = X[0, inds] - np.mean(X[0, inds])
+    px = X[1, inds] - np.mean(X[1, inds])
+    emit_x = np.sqrt(np.mean(x * x) * np.mean(px * px) - np.mean(x * px) ** 2)
+    tws = get_envelope(p_array, tws_i=tws_i, bounds=[-1, 1])
+
+    moments = BeamMoments()
+    for i in range(0, p_array.n, 3000):
+        moments.add_particles(p_array.rparticles[:, i:i + 3000], tws_i=tws_i, mask=inds[i:i + 3000])
+    moments_np = BeamMoments()
+    moments_np.add(X, weights=p_array.q_array)
+
+    result1 = [check_value(tws.emit_x, emit_x, tolerance=1.0e-10, assert_info=' emit_x - ')]
+    result2 = [check_value(tws.beta_x, np.mean(x * x) / emit_x, tolerance=1.0e-10, assert_info=' beta_x - ')]
+    result3 = check_matrix(moments.cov(), np.cov(X[:, inds], bias=True), tolerance=1.0e-10, assert_info=' chunks - ')
+    result4 = check_matrix(moments_np.cov(), np.cov(X, aweights=p_array.q_array, bias=True), tolerance=1.0e-10,
+                           assert_info=' weights - ')
+    result4 += check_matrix(envelope_coordinates_np(p_array.rparticles, disp, inds), X[:, inds], tolerance=1.0e-15,
+                            assert_info=' coordinates - ')
+
+    navi = Navigator(lattice)
+    navi.unit_step = 0.1
+    navi.add_physics_proc(PhysProc(), lattice.sequence[0], lattice.sequence[-1])
+    tws_all, _ = track(lattice, copy.deepcopy(p_array), navi, print_progress=False)
+    navi = Navigator(lattice)
+    navi.unit_step = 0.1
+    navi.add_physics_proc(PhysProc(), lattice.sequence[0], lattice.sequence[-1])
+    tws_5, _ = track(lattice, copy.deepcopy(p_array), navi, print_progress=False, tws_step=5)
+    navi = Navigator(lattice)
+    navi.unit_step = 0.1
+    navi.add_physics_proc(PhysProc(), lattice.sequence[0], lattice.sequence[-1])
+    tws_pos, _ = track(lattice, copy.deepcopy(p_array), navi, print_progress=False, tws_positions=[1.05, 2.])
+
+    s_all = np.array([tw.s for tw in tws_all])
+    s_5 = np.append(s_all[::5], s_all[-1]) if (len(s_all) - 1) % 5 else s_all[::5]
+    result5 = check_matrix(np.array([tw.s for tw in tws_5]), s_5, tolerance=1.0e-12, assert_info=' tws_step - ')
+    s_pos = np.array([s_all[0], s_all[s_all >= 1.05 - 1e-10][0], s_all[s_all >= 2. - 1e-10][0]])
+    result6 = check_matrix(np.array([tw.s for tw in tws_pos]), s_pos, tolerance=1.0e-12, assert_info=' tws_positions - ')
+    result7 = [None] if len(tws_5) == len(s_5) and len(tws_pos) == 3 else [" number of twiss "]
+    assert check_result(result1 + result2 + result3 + result4 + result5 + result6 + result7)
+
+
+def test_beam_statistics(lattice, p_array, parameter=None, update_ref_values=False):
+    """charge-weighted cached statistics of ParticleArray vs direct calculation"""
+
+    p_array = copy.deepcopy(p_array)
+    np.random.seed(11)
+    p_array.q_array = p_array.q_array * np.random.uniform(0.5, 1.5, p_array.n)
+    q = p_array.q_array
+    X = p_array.rparticles
+
+    S = p_array.stats.sigma_matrix()
+    S_ref = np.cov(X, aweights=q, bias=True)
+    emit_x = np.sqrt(S_ref[0, 0] * S_ref[1, 1] - S_ref[0, 1]**2)
+
+    result1 = check_matrix(p_array.stats.means(), np.average(X, axis=1, weights=q), tolerance=1.0e-12,
+                           tolerance_type='absolute', assert_info=' means - ')
+    result2 = check_matrix(S, S_ref, tolerance=1.0e-10, assert_info=' sigma matrix - ')
+    result3 = [check_value(p_array.stats.emittances()[0], emit_x, tolerance=1.0e-10, assert_info=' emit_x - ')]
+    result3 += check_matrix(p_array.stats.normal_emittances()[:2], np.sort(p_array.stats.emittances()[:2]),
+                            tolerance=1.0e-2, assert_info=' normal emittances - ')
+
+    slices = p_array.stats.slices(nslices=20)
+    tau = p_array.tau()
+    inds = (tau >= slices["tau"][10] - (slices["tau"][1] - slices["tau"][0]) / 2) * \
+           (tau < slices["tau"][10] + (slices["tau"][1] - slices["tau"][0]) / 2)
+    x_mean = np.average(p_array.x()[inds], weights=q[inds])
+    result4 = [check_value(np.sum(slices["q"]), np.sum(q), tolerance=1.0e-12, assert_info=' slice charge - ')]
+    result4 += [check_value(slices["means"][0][10], x_mean, tolerance=1.0e-9, assert_info=' slice mean - ')]
+    result4 += [check_value(slices["sigmas"][0][10], np.sqrt(np.average((p_array.x()[inds] - x_mean)**2, weights=q[inds])),
+                            tolerance=1.0e-9, assert_info=' slice sigma - ')]
+
+    cached = p_array.stats.sigma_matrix() is S and p_array.stats.slices(nslices=20) is slices
+    navi = Navigator(lattice)
+    tracking_step(lattice, p_array, 0.5, navi)
+    S1 = p_array.stats.sigma_matrix()
+    p_array.x()[:] *= 2
+    p_array.modified()
+    S2 = p_array.stats.sigma_matrix()
+    invalidated = S1 is not S and S2 is not S1 and np.abs(S2[0, 0] / S1[0, 0] - 4) < 1e-12
+    # in-place changes without modified()
+    means = np.copy(p_array.stats.means())
+    p_array.rparticles[0] += 1e-3
+    in_place = np.abs(p_array.stats.means()[0] - means[0] - 1e-3) < 1e-12
+    S = p_array.stats.sigma_matrix()
+    p_array.tau()[1::7] *= 2
+    in_place = in_place and np.abs(p_array.stats.sigma_matrix()[4, 4] / np.cov(p_array.tau(), aweights=q, bias=True) - 1) < 1e-10
+    result5 = [None] if cached and invalidated and in_place else [" cache is not updated correctly "]
+    assert check_result(result1 + result2 + result3 + result4 + result5)
+
+
+def test_track_float32(lattice, p_array, parameter=None, update_ref_values=False):
+    """single precision tracking with LSC vs double precision"""
+
+    def navi_func(lattice):
+        navi = Navigator(lattice)
+        navi.unit_step = 0.1
+        navi.add_physics_proc(LSC(), lattice.sequence[0], lattice.sequence[-1])
+        return navi
+
+    diff = precision_check(lattice, p_array, navi_func=navi_func, dtype=np.float32)
+
+    p32 = p_array.astype(np.float32)
+    track(lattice, p32, navi_func(lattice), print_progress=False)
+
+    result1 = [None if diff[key] < 1e-5 else key + " = " + str(diff[key]) for key in ["beta_x", "beta_y", "emit_x", "emit_y", "E"]]
+    result2 = [None if diff[key] < 1e-3 else key + " = " + str(diff[key]) for key in ["x", "px", "y", "py", "tau", "p"]]
+    result3 = [None] if p32.rparticles.dtype == np.float32 and p32.rparticles.nbytes * 2 == p_array.rparticles.nbytes else [" dtype "]
+    assert check_result(result1 + result2 + result3)
+
+
+def test_track_chunked(lattice, p_array, parameter=None, update_ref_values=False):
+    """out-of-core tracking of the beam in ParticleStore chunk by chunk vs tracking in memory"""
+
+    filename = FILE_DIR + "/store.tmp"
+
+    def navi_func(lattice):
+        navi = Navigator(lattice)
+        navi.unit_step = 0.1
+        navi.add_physics_proc(LSC(), lattice.sequence[0], lattice.sequence[-1])
+        sc = SpaceCharge(step=5)
+        sc.nmesh_xyz = [31, 31, 31]
+        navi.add_physics_proc(sc, lattice.sequence[0], lattice.sequence[-1])
+        wake = Wake()
+        wake.wake_table = WakeTableDechirperOffAxis(b=500 * 1e-6)
+        navi.add_physics_proc(wake, m1, m1)
+        return navi
+
+    tws_track, p_array_track = track(lattice, copy.deepcopy(p_array), navi_func(lattice), print_progress=False)
+
+    store = ParticleStore.from_particle_array(p_array, filename, chunk_size=7000)
+    tws_chunked, store = track_chunked(lattice, store, navi_func(lattice), print_progress=False)
+    p_array_chunked = ParticleStore(filename).to_particle_array()
+
+    navi = Navigator(lattice)
+    navi.add_physics_proc(SmoothBeam(), lattice.sequence[0], lattice.sequence[-1])
+    with pytest.raises(ValueError):
+        track_chunked(lattice, store, navi, print_progress=False)
+    del store
+    for ext in [".npy", "_q.npy", ".json"]:
+        os.remove(filename + ext)
+
+    diff = np.max(np.abs(p_array_chunked.rparticles - p_array_track.rparticles), axis=1) / np.std(p_array_track.rparticles, axis=1)
+    result1 = [None if d < 1e-10 else "coordinate " + str(i) + " diff = " + str(d) for i, d in enumerate(diff)]
+    result2 = check_matrix(np.array([tw.emit_x for tw in tws_chunked]), np.array([tw.emit_x for tw in tws_track]),
+                           tolerance=1.0e-10, assert_info=' emit_x - ')
+    result3 = [check_value(p_array_chunked.E, p_array_track.E, tolerance=1.0e-14, assert_info=' E - '),
+               check_value(p_array_chunked.s, p_array_track.s, tolerance=1.0e-14, assert_info=' s - ')]
+    assert check_result(result1 + result2 + result3)
+
+
+def test_track_chunked_csr(lattice, p_array, parameter=None, update_ref_values=False):
+    """out-of-core tracking with CSR vs tracking in memory, length (exact sub-bins) and charge binning (histogram)"""
+
+    filename = FILE_DIR + "/store.tmp"
+
+    def navi_func(lattice, x_qbin):
+        navi = Navigator(lattice)
+        navi.unit_step = 0.1
+        csr = CSR()
+        csr.x_qbin = x_qbin
+        navi.add_physics_proc(csr, lattice.sequence[0], lattice.sequence[-1])
+        return navi
+
+    result = []
+    for x_qbin, tol in [(0., 1e-10), (0.5, 1e-4)]:
+        tws_track, p_array_track = track(lattice, copy.deepcopy(p_array), navi_func(lattice, x_qbin),
+                                         print_progress=False)
+        store = ParticleStore.from_particle_array(p_array, filename, chunk_size=7000)
+        tws_chunked, store = track_chunked(lattice, store, navi_func(lattice, x_qbin), print_progress=False)
+        del store
+        p_array_chunked = ParticleStore(filename).to_particle_array()
+        for ext in [".npy", "_q.npy", ".json"]:
+            os.remove(filename + ext)
+
+        dp = p_array_track.p() - p_array.p()
+        diff = np.max(np.abs(p_array_chunked.p() - p_array_track.p())) / np.std(dp)
+        result.append(None if diff < tol else "x_qbin = " + str(x_qbin) + " p diff = " + str(diff))
+    assert check_result(result)
+
+
+def test_generate_parray_6d(lattice, p_array, parameter=None, update_ref_values=False):
+    """generation of the correlated 6D distribution from the sigma matrix with quasi-random numbers"""
+
+    tws = Twiss()
+    tws.emit_x, tws.beta_x, tws.alpha_x = 1e-9, 10., -1.
+    tws.emit_y, tws.beta_y, tws.alpha_y = 2e-9, 5., 0.5
+    tws.Dx = 0.1
+    sigma = sigma_from_twiss(tws, sigma_tau=1e-4, sigma_p=1e-4, chirp=0.01)
+    norm = np.sqrt(np.outer(np.diag(sigma), np.diag(sigma)))
+
+    p_sobol = generate_parray_6d(sigma, nparticles=100000, charge=1e-9, energy=0.13, method="sobol", seed=1,
+                                 chunk_size=30000, nthreads=2)
+    p_sobol_one = generate_parray_6d(sigma, nparticles=100000, charge=1e-9, energy=0.13, method="sobol", seed=1)
+
+    p_array_pre = ParticleArray(n=50000, dtype=np.float32)
+    p_halton = generate_parray_6d(sigma, p_array=p_array_pre, method="halton", seed=1)
+
+    result1 = [None if np.max(np.abs(np.cov(p_sobol.rparticles) - sigma) / norm) < 1e-3 else "sobol sigma",
+               None if np.max(np.abs(np.cov(p_halton.rparticles) - sigma) / norm) < 1e-2 else "halton sigma",
+               None if np.array_equal(p_sobol.rparticles, p_sobol_one.rparticles) else "chunks",
+               None if p_halton is p_array_pre and p_halton.rparticles.dtype == np.float32 else "preallocated"]
+    result2 = [check_value(np.sum(p_sobol.q_array), 1e-9, tolerance=1.0e-12, assert_info=' charge - ')]
+    assert check_result(result1 + result2)
+
+
+def test_resample(lattice, p_array, parameter=None, update_ref_values=False):
+    """merging and splitting of the macro-particles conserve charge, mean and second moments"""
+
+    def moments(p):
+        Q = np.sum(p.q_array)
+        mean = np.sum(p.rparticles * p.q_array, axis=1) / Q
+        D = p.rparticles - mean[:, None]
+        return Q, mean, np.dot(D * p.q_array, D.T) / Q
+
+    p_array_track = copy.deepcopy(p_array)
+    resample = Resample()
+    resample.cell = 1.
+    resample.n_merge = 24
+    navi = Navigator(lattice)
+    navi.add_physics_proc(resample, m1, m1)
+    n0 = p_array_track.n
+    track(lattice, p_array_track, navi, calc_tws=False, print_progress=False)
+    n_merged = p_array_track.n
+
+    p_array_res = copy.deepcopy(p_array)
+    Q0, mean0, sigma0 = moments(p_array_res)
+    resample.apply(p_array_res, 0)
+    Q1, mean1, sigma1 = moments(p_array_res)
+
+    split = Resample()
+    split.n_merge = None
+    split.n_split = 4
+    split.seed = 1
+    split.roi = lambda p: p.tau() > np.mean(p.tau())
+    n1 = p_array_res.n
+    split.apply(p_array_res, 0)
+    Q2, mean2, sigma2 = moments(p_array_res)
+
+    std = np.sqrt(np.diag(sigma0))
+    std[std == 0] = 1
+    result1 = [None if n_merged < n0 else "merging in tracking", None if p_array_res.n > n1 else "splitting"]
+    result2 = [check_value(Q1, Q0, tolerance=1.0e-12, assert_info=' charge merge - '),
+               check_value(Q2, Q0, tolerance=1.0e-12, assert_info=' charge split - ')]
+    result3 = check_matrix(np.array([mean1 / std, mean2 / std]), np.array([mean0 / std, mean0 / std]),
+                           tolerance=1.0e-12, tolerance_type='absolute', assert_info=' mean - ')
+    result4 = check_matrix(sigma1 / np.outer(std, std), sigma0 / np.outer(std, std), tolerance=1.0e-10,
+                           tolerance_type='absolute', assert_info=' sigma - ')
+
+    # beam without charges
+    p_array_q0 = copy.deepcopy(p_array)
+    p_array_q0.q_array = np.zeros(p_array_q0.n)
+    mean_q0 = np.mean(p_array_q0.rparticles, axis=1)
+    resample.apply(p_array_q0, 0)
+    result5 = [None if p_array_q0.n < n0 and np.all(np.isfinite(p_array_q0.rparticles)) else " zero charges - "]
+    result5 += check_matrix(np.mean(p_array_q0.rparticles, axis=1) / std, mean_q0 / std, tolerance=1.0e-2,
+                            tolerance_type='absolute', assert_info=' mean zero charges - ')
+    assert check_result(result1 + result2 + result3 + result4 + result5)
+
+
+def test_save_beam_background(lattice, p_array, parameter=None, update_ref_values=False):
+    """SaveBeam writes a snapshot of the beam in the background, the file is complete after tracking"""
+
+    p_array_track = copy.deepcopy(p_array)
+    filename_bg = FILE_DIR + "/save_beam_bg.npz"
+    filename = FILE_DIR + "/save_beam.npz"
+    navi = Navigator(lattice)
+    save_beam = SaveBeam(filename=filename_bg, background=True)
+    navi.add_physics_proc(save_beam, m1, m1)
+    navi.add_physics_proc(SaveBeam(filename=filename), m1, m1)
+    track(lattice, p_array_track, navi, calc_tws=False, print_progress=False)
+    # the process with the writer can be copied
+    save_beam_copy = copy.deepcopy(save_beam)
+
+    p_array_bg = load_particle_array(filename_bg)
+    p_array_ref = load_particle_array(filename)
+    os.remove(filename_bg)
+    os.remove(filename)
+
+    result = check_matrix(p_array_bg.rparticles, p_array_ref.rparticles, tolerance=1.0e-12,
+                          tolerance_type='absolute', assert_info=' rparticles - ')
+    result.append(check_value(np.sum(p_array_bg.q_array), np.sum(p_array_ref.q_array), tolerance=1.0e-12,
+                              assert_info=' charge - '))
+    result.append(None if save_beam.writer is not None and save_beam_copy.writer is None else " writer - ")
+    assert check_result(result)
+
+
 def setup_module(module):
 
     f = open(pytest.TEST_RESULTS_FILE, 'a')
@@ -7,6 +7,7 @@ from ocelot import *
 from ocelot.rad.radiation_py import und_field
 from ocelot.cpbd.beam import generate_parray
 from ocelot.cpbd.optics import RungeKuttaTM
+from ocelot.cpbd.field_map import FieldMap
 
 """Lattice elements definition"""
 
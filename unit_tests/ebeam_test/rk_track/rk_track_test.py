@@ -59,6 +59,65 @@ def test_track_undulator_with_diff_chirp(lattice, p_array, parameter, update_ref
     assert check_result(result)
 
 
+def test_track_undulator_threads(lattice, p_array, parameter=None, update_ref_values=False):
+    """application of the transfer maps to the blocks of particles in several threads vs one thread"""
+
+    p_array_serial = copy.deepcopy(p_array)
+    p_array_threads = copy.deepcopy(p_array)
+
+    t_maps = get_map(lattice, lattice.totalLen, Navigator(lattice))
+    apply_maps(t_maps, p_array_serial)
+    apply_maps(t_maps, p_array_threads, nthreads=4, min_block=2000)
+
+    result1 = check_matrix(p_array_threads.rparticles, p_array_serial.rparticles, tolerance=1.0e-14,
+                           tolerance_type='absolute', assert_info=' rparticles - ')
+    result2 = [check_value(p_array_threads.E, p_array_serial.E, assert_info=' E - '),
+               check_value(p_array_threads.s, p_array_serial.s, assert_info=' s - ')]
+    assert check_result(result1 + result2)
+
+
+def test_track_undulator_compiled_field(lattice, p_array, parameter=None, update_ref_values=False):
+    """compiled Runge-Kutta tracking through CompiledField vs tracking through python mag_field"""
+
+    und_c = Undulator(lperiod=0.4, nperiods=9, Kx=44.81)
+    und_c.mag_field = CompiledField.undulator(lperiod=und_c.lperiod, Kx=und_c.Kx)
+    und_c.npoints = 3000
+    method = MethodTM()
+    method.params[Undulator] = RungeKuttaTM
+    method.global_method = SecondTM
+    lat_c = MagneticLattice((d1, und_c, d2), method=method)
+
+    p_array_track = copy.deepcopy(p_array)
+    p_array_track.p()[:] = 0
+    tws_track_wo, p_array_after = track(lat_c, p_array_track, Navigator(lat_c), calc_tws=False)
+
+    p = obj2dict(p_array_after)
+    p_array_ref = json_read(REF_RES_DIR + 'test_track_undulator_with_diff_chirp2.json')
+    result = check_dict(p, p_array_ref['p_array'], tolerance=1.0e-12, tolerance_type='absolute', assert_info=' p - ')
+    assert check_result(result)
+
+
+def test_field_map_compiled_field(lattice, p_array, parameter=None, update_ref_values=False):
+    """interpolation of the tabulated field map in CompiledField"""
+
+    filename = FILE_DIR + "/field_map_test.txt"
+    z = np.linspace(0, 1200, num=301)
+    np.savetxt(filename, np.array([z, np.sin(z / 100.)]).T)
+    field_map = FieldMap(filename)
+    os.remove(filename)
+
+    field = CompiledField.from_field_map(field_map)
+    z_test = np.linspace(-0.1, 1.3, num=1001)
+    Bx, By, Bz = field(0.001, -0.001, z_test)
+    By_ref = np.interp(z_test, z * 0.001, np.sin(z / 100.), left=0, right=0)
+
+    result1 = check_matrix(np.array([Bx, By, Bz]), np.array([0 * z_test, By_ref, 0 * z_test]), tolerance=1.0e-12,
+                           tolerance_type='absolute', assert_info=' B - ')
+    result2 = [check_value(field(0.001, -0.001, 0.5)[1], np.interp(0.5, z * 0.001, np.sin(z / 100.)),
+                           tolerance=1.0e-12, tolerance_type='absolute', assert_info=' By(z) - ')]
+    assert check_result(result1 + result2)
+
+
 def setup_module(module):
 
     f = open(pytest.TEST_RESULTS_FILE, 'a')
@@ -10,6 +10,8 @@ REF_RES_DIR = FILE_DIR + '/ref_results/'
 
 from unit_tests.params import *
 from space_charge_conf import *
+from ocelot.common.globals import epsilon_0
+from ocelot.cpbd.sc import cic_deposit, cic_deposit_np, tsc_deposit, tsc_deposit_np
 
 
 def test_track_without_sp(lattice, p_array, parameter=None, update_ref_values=False):
@@ -124,6 +126,110 @@ def test_track_with_lsc(lattice, p_array, parameter=None, update_ref_values=Fals
                          assert_info=' p_array - ')
     assert check_result(result1 + result2)
 
+
+def test_sc_kernel_cache(lattice, p_array, parameter=None, update_ref_values=False):
+    """cached FFT of the Green's function vs direct calculation"""
+    np.random.seed(1)
+    q = np.random.rand(15, 17, 19)
+    steps = np.array([1e-4, 1.3e-4, 2e-5])
+
+    sc = SpaceCharge()
+    nx, ny, nz = q.shape
+    K1 = sc.sym_kernel(q.shape, steps)
+    K2 = np.zeros((2 * nx - 1, 2 * ny - 1, 2 * nz - 1))
+    K2[0:nx, 0:ny, 0:nz] = K1
+    K2[0:nx, 0:ny, nz:2 * nz - 1] = K2[0:nx, 0:ny, nz - 1:0:-1]
+    K2[0:nx, ny:2 * ny - 1, :] = K2[0:nx, ny - 1:0:-1, :]
+    K2[nx:2 * nx - 1, :, :] = K2[nx - 1:0:-1, :, :]
+    out = np.zeros(K2.shape)
+    out[:nx, :ny, :nz] = q
+    p_ref = np.real(np.fft.ifftn(np.fft.fftn(out) * np.fft.fftn(K2)))[:nx, :ny, :nz]
+    p_ref = p_ref / (4 * pi * epsilon_0 * steps[0] * steps[1] * steps[2])
+
+    p1 = sc.potential(q, steps)
+    # uniformly scaled mesh reuses the cached kernel
+    p2 = sc.potential(q, steps * 2.) * 2.
+
+    assert len(sc.kernel_cache) == 1
+    result1 = check_matrix(p1, p_ref, tolerance=1.0e-10, tolerance_type='relative', assert_info=' p1 - ')
+    result2 = check_matrix(p2, p_ref, tolerance=1.0e-10, tolerance_type='relative', assert_info=' p2 - ')
+    assert check_result(result1 + result2)
+
+
+@pytest.mark.parametrize('parameter', ["cic", "tsc"])
+def test_sc_deposit(lattice, p_array, parameter, update_ref_values=False):
+    """charge deposition on the mesh: total charge and first moment are conserved"""
+    np.random.seed(2)
+    nxyz = np.array([33, 35, 37])
+    X = np.random.rand(10000, 3) * (nxyz - 3)
+    Q = np.random.rand(10000)
+    if parameter == "cic":
+        q = cic_deposit(X, Q, nxyz)
+        q_np = cic_deposit_np(X, Q, nxyz)
+    else:
+        q = tsc_deposit(X, Q, nxyz)
+        q_np = tsc_deposit_np(X, Q, nxyz)
+
+    x_mesh = np.arange(nxyz[0]) - 0.5
+    x_mean = np.sum(np.sum(q, axis=(1, 2)) * x_mesh) / np.sum(Q)
+
+    result1 = check_matrix(q, q_np, tolerance=1.0e-12, tolerance_type='absolute', assert_info=' q - ')
+    result2 = check_value(np.sum(q), np.sum(Q), tolerance=1.0e-12, assert_info=' charge - ')
+    result3 = check_value(x_mean, np.sum(X[:, 0] * Q) / np.sum(Q), tolerance=1.0e-12, assert_info=' <x> - ')
+    assert check_result(result1 + [result2, result3])
+
+
+def test_sc_solver_25d(lattice, p_array, parameter=None, update_ref_values=False):
+    """2.5D solver vs 3D solver for a long bunch and automatic choice of the solver"""
+    np.random.seed(3)
+    N = 200000
+    X = np.random.randn(N, 3) * np.array([1e-4, 1e-4, 3e-3])
+    Q = np.ones(N) * 1e-9 / N
+    nxyz = np.array([31, 31, 63])
+    Exyz = {}
+    for solver in ["3d", "2.5d", "auto"]:
+        sc = SpaceCharge()
+        sc.solver = solver
+        sc.deposit = "cic"
+        Exyz[solver] = sc.el_field(X.copy(), Q, 1., nxyz)
+
+    core = np.abs(X[:, 2]) < 3e-3
+    dEx = np.linalg.norm(Exyz["2.5d"][core, 0] - Exyz["3d"][core, 0]) / np.linalg.norm(Exyz["3d"][core, 0])
+    dEz = np.linalg.norm(Exyz["2.5d"][core, 2] - Exyz["3d"][core, 2]) / np.linalg.norm(Exyz["3d"][core, 2])
+
+    result1 = check_value(dEx, 0, tolerance=3.0e-2, tolerance_type='absolute', assert_info=' Ex - ')
+    result2 = check_value(dEz, 0, tolerance=0.2, tolerance_type='absolute', assert_info=' Ez - ')
+    result3 = check_matrix(Exyz["auto"], Exyz["2.5d"], tolerance=1.0e-12, tolerance_type='relative', assert_info=' auto - ')
+    assert check_result([result1, result2] + result3)
+
+
+def test_lsc_impedance_cache(lattice, p_array, parameter=None, update_ref_values=False):
+    """LSC wake with the cached impedance and the real FFT vs the full complex FFT"""
+    s = np.linspace(-1e-4, 1e-4, 501)
+    bunch = np.exp(-s**2 / (2 * 3e-5**2))
+    lsc = LSC()
+    nb = len(s)
+    dt = (s[1] - s[0]) / speed_of_light
+    f = 1 / dt * np.arange(0, 2 * nb) / (2 * nb)
+    Za = lsc.imp_lsc(250., 1e-4, w=f[0:nb] * 2 * np.pi, dz=0.1)
+    f, Zb = lsc.wake2impedance(s[0] + np.arange(1, 2 * nb + 1) * (s[1] - s[0]), np.append(bunch, np.zeros(nb)) * speed_of_light)
+    Z = np.zeros(2 * nb, dtype=complex)
+    Z[0:nb] = Za * Zb[0:nb]
+    Z[nb:] = np.flipud(np.conj(Z[0:nb]))
+    w_ref = -lsc.impedance2wake(f, Z)[1][0:nb]
+
+    w1 = lsc.wake_lsc(s, bunch, 250., 1e-4, 0.1)
+    lsc.imp_tol = 1e-3
+    w2 = lsc.wake_lsc(s, bunch, 250., 1e-4, 0.1)
+    w3 = lsc.wake_lsc(s, bunch, 250. * (1 + 1e-4), 1e-4, 0.1)
+
+    result1 = check_matrix(w1, w_ref, tolerance=1.0e-12 * np.max(np.abs(w_ref)), tolerance_type='absolute', assert_info=' wake - ')
+    result2 = check_matrix(w2, w_ref, tolerance=1.0e-3 * np.max(np.abs(w_ref)), tolerance_type='absolute', assert_info=' wake tol - ')
+    result3 = check_value(len(lsc.imp_cache), 2, tolerance=1.0e-12, tolerance_type='absolute', assert_info=' cache - ')
+    result4 = check_matrix(w3, w2, tolerance=1.0e-12 * np.max(np.abs(w_ref)), tolerance_type='absolute', assert_info=' cached wake - ')
+    assert check_result(result1 + result2 + [result3] + result4)
+
+
 @pytest.mark.parametrize('parameter', [0, 1])
 def test_get_current(lattice, p_array, parameter, update_ref_values=False):
     """Get current function test